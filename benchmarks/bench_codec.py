@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of the Connector message codecs.
+
+Encodes and decodes messages through Connector without a server, for
+the former json documents and each registered codec (msgpack when
+installed), over payloads of growing size. Payloads a codec can not
+carry are skipped.
+
+    python benchmarks/bench_codec.py [--rounds 200]
+"""
+
+import argparse
+import time
+
+from desir.codec import CODECS
+from desir.sugar import Connector
+
+
+def payloads():
+    yield "small dict", dict(args=[1, 2, 3], kwargs={"key": "value"})
+    yield "1k strings", ["value %d" % i for i in range(1000)]
+    yield "100KB bytes", b"x" * 100000
+    yield "10MB bytes", b"x" * 10000000
+    try:
+        import numpy
+    except ImportError:
+        return
+    yield "10MB ndarray", numpy.zeros(1250000)
+
+
+def run(connector, val, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        msg = connector._encode("dst", val, None, "func", False)
+        connector._decode(msg, None)
+    return (time.perf_counter() - start) / rounds, len(msg)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--secret", default=None)
+    args = parser.parse_args()
+
+    codecs = [None] + sorted(set(c for c in CODECS if isinstance(c, str)))
+    for name, val in payloads():
+        rounds = max(1, args.rounds // 100) if "MB" in name else args.rounds
+        for codec in codecs:
+            connector = Connector("bench", codec=codec, secret=args.secret)
+            try:
+                elapsed, size = run(connector, val, rounds)
+            except (TypeError, ValueError):
+                continue
+            print("%-14s %-8s %10.1fus %10d bytes" % (
+                name, codec or "legacy", elapsed * 1e6, size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Benchmark of Counter id generation against a redis server.
+
+Compares one INCR per id with the block reserving Counter (INCRBY of an
+adaptive block), from one thread and from several threads sharing the
+counter. The counter key is overwritten.
+
+    python benchmarks/bench_counter.py [--ids 100000] [--threads 4]
+"""
+
+import argparse
+import threading
+import time
+
+import desir
+
+
+def run(counter, ids, threads):
+    per_thread = ids // threads
+    results = []
+
+    def work():
+        results.append([next(counter) for i in range(per_thread)])
+
+    workers = [threading.Thread(target=work) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    values = [value for result in results for value in result]
+    assert len(set(values)) == len(values), "duplicated ids"
+    return len(values) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--key", default="bench:counter")
+    parser.add_argument("--ids", type=int, default=100000)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    r = desir.Redis(args.host, args.port)
+    for threads in (1, args.threads):
+        # one INCR per id is slow, use less ids
+        incr = run(r.Counter(args.key), args.ids // 10, threads)
+        block = run(r.Counter(args.key, block=16), args.ids, threads)
+        print("%d thread(s)  INCR %10.0f ids/s  block %10.0f ids/s  x%.1f" % (
+            threads, incr, block, block / incr))
+    r.delete(args.key)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of the import time of desir.
+
+Runs "import desir" in fresh interpreters and reports the median wall
+time of the import, with the compiled command table cache in place
+(warm) and removed before every run (cold), then the cost of the first
+and following accesses to a command method.
+
+    python benchmarks/bench_import.py [--rounds 20]
+"""
+
+import argparse
+import glob
+import os
+import statistics
+import subprocess
+import sys
+
+IMPORT = """
+import time
+start = time.perf_counter()
+import desir
+print(time.perf_counter() - start)
+"""
+
+ACCESS = """
+import time
+import desir
+start = time.perf_counter()
+desir.Redis.get
+first = time.perf_counter() - start
+start = time.perf_counter()
+desir.Redis.get
+print(first, time.perf_counter() - start)
+"""
+
+
+def run(code):
+    out = subprocess.check_output([sys.executable, "-c", code])
+    return [float(v) for v in out.split()]
+
+
+def clear_cache():
+    import desir
+    pattern = os.path.join(os.path.dirname(desir.__file__), "__pycache__",
+                           "commands-*")
+    for path in glob.glob(pattern):
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    # compile the package and the command table once
+    run(IMPORT)
+    warm = [run(IMPORT)[0] for i in range(args.rounds)]
+    cold = []
+    for i in range(args.rounds):
+        clear_cache()
+        cold.append(run(IMPORT)[0])
+    access = [run(ACCESS) for i in range(args.rounds)]
+    print("import desir (warm)   %8.2fms" % (statistics.median(warm) * 1000))
+    print("import desir (cold)   %8.2fms" % (statistics.median(cold) * 1000))
+    print("first command access  %8.3fms" % (
+        statistics.median(a[0] for a in access) * 1000))
+    print("next command access   %8.3fms" % (
+        statistics.median(a[1] for a in access) * 1000))
+
+
+if __name__ == "__main__":
+    main()
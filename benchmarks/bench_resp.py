@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of the RESP readers on large replies.
+
+Compares the former readline based SocketReader with the buffered
+RespReader on LRANGE like flat arrays and HGETALL like arrays, fed
+through a socketpair by a writer thread.
+
+    python benchmarks/bench_resp.py [--elements 10000] [--rounds 20]
+"""
+
+import argparse
+import socket
+import threading
+import time
+
+from desir.resp import SocketReader, RespReader
+
+
+def flat_array(n, size):
+    value = b"v" * size
+    frame = b"$%d\r\n%s\r\n" % (size, value)
+    return b"*%d\r\n" % n + frame * n
+
+
+def pairs_array(n, size):
+    out = [b"*%d\r\n" % (2 * n)]
+    for i in range(n):
+        field = b"field:%d" % i
+        out.append(b"$%d\r\n%s\r\n" % (len(field), field))
+        out.append(b"$%d\r\n%s\r\n" % (size, b"v" * size))
+    return b"".join(out)
+
+
+def run(readerclass, payload, rounds):
+    rsock, wsock = socket.socketpair()
+    writer = threading.Thread(target=wsock.sendall, args=(payload * rounds,))
+    writer.start()
+    reader = readerclass(rsock)
+    start = time.perf_counter()
+    for i in range(rounds):
+        reader.parse()
+    elapsed = time.perf_counter() - start
+    writer.join()
+    rsock.close()
+    wsock.close()
+    return elapsed / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--elements", type=int, default=10000)
+    parser.add_argument("--size", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    cases = [
+        ("lrange %d" % args.elements, flat_array(args.elements, args.size)),
+        ("hgetall %d" % args.elements, pairs_array(args.elements, args.size)),
+    ]
+    for name, payload in cases:
+        old = run(SocketReader, payload, args.rounds)
+        new = run(RespReader, payload, args.rounds)
+        print("%-16s SocketReader %8.2fms  RespReader %8.2fms  x%.2f" % (
+            name, old * 1000, new * 1000, old / new))
+
+
+if __name__ == "__main__":
+    main()
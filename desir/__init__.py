@@ -1,8 +1,12 @@
 from sys import version_info
 if version_info[0] == 3:
     from .desir3 import (SubAsync, Node, Redis, RedisError,
-                         NodeError, RedisInner)
-    from .sugar import ConnectorError, SWM, Connector
+                         NodeError, RedisInner, Pipeline)
+    from .pool import ConnectionPool, PoolTimeoutError
+    from .pubsub import PubSub
+    from .memory import MemoryBackend
+    from .metrics import Metrics
+    from .sugar import ConnectorError, SWM, Connector, StreamConnector
 else:
     from .desir import SubAsync, Node, Redis, RedisError
     from .desir import NodeError, ConnectorError, SWM, RedisInner
@@ -0,0 +1,681 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+"""
+asyncio client, commands are generated from commands.json by MetaRedis
+like for the blocking Redis class and return coroutines.
+"""
+
+import asyncio
+import collections
+import contextvars
+import time
+
+from .desir3 import (MetaRedis, Node, Pipeline, PINNED_COMMANDS,
+                     PUSH_COMMANDS, DEFAULT_SENTINEL_TIMEOUT, scan_options, SentinelError,
+                     SentinelErrorNoMaster)
+from .pool import DEFAULT_IDLE_TIMEOUT, DEFAULT_HEALTH_CHECK_INTERVAL
+from .metrics import Metrics
+from .pool import PoolTimeoutError
+from .pubsub import pubsub_message
+from .resp import (RedisError, NodeError, Push, RespReader, NOREPLY,
+                   DEFAULT_BUFFER_SIZE, pack_commands)
+
+
+class AsyncNode(object):
+    """
+    Manage an asyncio stream connection to a redis node
+    """
+
+    _error = Node._error
+    onpush = None
+    metrics = None
+
+    def __init__(self, host="localhost", port=6379, db=0,
+                 password=None, timeout=None, protocol=2):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.password = password
+        self.db = db
+        self.protocol = protocol
+        self.pushes = collections.deque()
+        self._reader = None
+        self._writer = None
+        self._parser = None
+
+    def __connected__(self):
+        return self._writer is not None
+
+    async def connect(self):
+        if self._writer is not None:
+            return
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+        except asyncio.TimeoutError:
+            raise NodeError("Timeout connecting %s:%s." % (
+                self.host, self.port))
+        except OSError as msg:
+            raise self._error(msg)
+        self._parser = RespReader()
+        if self.metrics is not None:
+            self.metrics.connected(self)
+        if self.protocol == 3:
+            if self.password:
+                await self.runcmd("HELLO", 3, "AUTH", "default",
+                                  self.password)
+            else:
+                await self.runcmd("HELLO", 3)
+        elif self.password:
+            if not await self.runcmd("auth", self.password):
+                raise RedisError("Authentication error: Invalid password")
+        if self.db:
+            await self.runcmd("select", str(self.db))
+
+    def disconnect(self):
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except OSError:
+                pass
+            finally:
+                self._reader = None
+                self._writer = None
+                self._parser = None
+
+    async def sendcommands(self, commands):
+        await self.sendbuffers(pack_commands(commands))
+
+    async def sendbuffers(self, buffers):
+        await self.connect()
+        try:
+            self._writer.writelines(buffers)
+            await self._writer.drain()
+        except OSError as msg:
+            self.disconnect()
+            raise self._error(msg)
+
+    async def sendcmd(self, *args):
+        await self.sendcommands([(args[0], args[1:])])
+
+    async def parse_resp(self, raise_errors=True):
+        while True:
+            reply = await self._parse(raise_errors)
+            if type(reply) is not Push:
+                return reply
+            if self.onpush is not None:
+                self.onpush(reply)
+            else:
+                self.pushes.append(reply)
+
+    async def parse_push(self):
+        if self.pushes:
+            return self.pushes.popleft()
+        return await self._parse(True)
+
+    async def _parse(self, raise_errors):
+        parser = self._parser
+        try:
+            while True:
+                reply = parser.gets(raise_errors)
+                if reply is not NOREPLY:
+                    return reply
+                data = await asyncio.wait_for(
+                    self._reader.read(DEFAULT_BUFFER_SIZE), self.timeout)
+                if not data:
+                    raise ConnectionError("Connection closed by server")
+                parser.feed(data)
+        except asyncio.TimeoutError:
+            self.disconnect()
+            raise NodeError("Timeout reading from %s:%s." % (
+                self.host, self.port))
+        except OSError as msg:
+            self.disconnect()
+            raise self._error(msg)
+        except NodeError:
+            self.disconnect()
+            raise
+
+    async def runcmd(self, cmdname, *args):
+        if self.metrics is not None:
+            request = await self.request([(cmdname, args)], cmdname)
+            if self.protocol == 3 and cmdname in PUSH_COMMANDS:
+                return await self._measured(request, self.parse_push())
+            return await self._measured(request, self.parse_resp())
+        await self.sendcmd(cmdname, *args)
+        if self.protocol == 3 and cmdname in PUSH_COMMANDS:
+            return await self.parse_push()
+        return await self.parse_resp()
+
+    async def runcommands(self, commands, name="PIPELINE"):
+        """
+        see Node.runcommands
+        """
+        if self.metrics is not None:
+            return await self.replies(await self.request(commands, name),
+                                      len(commands), False)
+        await self.sendcommands(commands)
+        return await self._parse_many(len(commands), False)
+
+    async def request(self, commands, name="PIPELINE"):
+        """
+        see Node.request
+        """
+        metrics = self.metrics
+        if metrics is None:
+            await self.sendcommands(commands)
+            return None
+        for hook in metrics.before:
+            hook(name, self)
+        buffers = pack_commands(commands)
+        sent = sum(memoryview(buf).nbytes for buf in buffers)
+        start = time.perf_counter()
+        try:
+            await self.sendbuffers(buffers)
+        except Exception as e:
+            self._record(name, start, sent, 0, e)
+            raise
+        return name, start, sent
+
+    async def replies(self, request, count=None, raise_errors=True):
+        """
+        see Node.replies
+        """
+        if count is None:
+            reading = self.parse_resp(raise_errors)
+        else:
+            reading = self._parse_many(count, raise_errors)
+        if request is None:
+            return await reading
+        return await self._measured(request, reading)
+
+    async def _parse_many(self, count, raise_errors):
+        replies = []
+        for i in range(count):
+            replies.append(await self.parse_resp(raise_errors))
+        return replies
+
+    async def _measured(self, request, reading):
+        name, start, sent = request
+        parser = self._parser
+        before = parser.received
+        error = None
+        try:
+            return await reading
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._record(name, start, sent, parser.received - before, error)
+
+    def _record(self, name, start, sent, received, error):
+        metrics = self.metrics
+        elapsed = time.perf_counter() - start
+        metrics.record(name, self, elapsed, sent, received, error)
+        for hook in metrics.after:
+            hook(name, self, elapsed, error)
+
+
+class AsyncConnectionPool(object):
+    """
+    Bounded pool of AsyncNode for a single event loop, same behaviour as
+    ConnectionPool. factory is a coroutine function returning a new node.
+    """
+
+    def __init__(self, factory, max_connections=None, timeout=None,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL):
+        self.factory = factory
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self._idle = []
+        self._generations = {}
+        self._created = 0
+        self._generation = 0
+        self._waiters = collections.deque()
+
+    def __len__(self):
+        return self._created
+
+    def idle(self):
+        return len(self._idle)
+
+    def _notify(self, n=1):
+        while n and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                n -= 1
+
+    def _reap(self, now):
+        if self.idle_timeout is None:
+            return
+        limit = now - self.idle_timeout
+        n = 0
+        while n < len(self._idle) and self._idle[n][2] < limit:
+            n += 1
+        if n:
+            for node, generation, used in self._idle[:n]:
+                node.disconnect()
+            del self._idle[:n]
+            self._created -= n
+
+    async def _wait(self, deadline):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            if deadline is None:
+                await waiter
+            else:
+                await asyncio.wait_for(
+                    waiter, max(0, deadline - time.monotonic()))
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    async def checkout(self):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        while True:
+            now = time.monotonic()
+            self._reap(now)
+            if self._idle:
+                node, generation, used = self._idle.pop()
+                if (self.health_check_interval is not None and
+                        now - used > self.health_check_interval and
+                        node.__connected__()):
+                    try:
+                        await node.runcmd("PING")
+                    except (NodeError, RedisError):
+                        # not handed out yet, discard would ignore it
+                        node.disconnect()
+                        self._created -= 1
+                        self._notify()
+                        continue
+            elif (self.max_connections is None or
+                  self._created < self.max_connections):
+                self._created += 1
+                generation = self._generation
+                try:
+                    node = await self.factory()
+                except BaseException:
+                    self._created -= 1
+                    self._notify()
+                    raise
+            else:
+                try:
+                    await self._wait(deadline)
+                except asyncio.TimeoutError:
+                    raise PoolTimeoutError(
+                        "No connection available after %ss" % (
+                            self.timeout))
+                continue
+            self._generations[id(node)] = generation
+            return node
+
+    def release(self, node):
+        generation = self._generations.pop(id(node), None)
+        if generation is None:
+            # not handed out by the pool or already released
+            return
+        if generation != self._generation:
+            node.disconnect()
+            self._created -= 1
+        else:
+            self._idle.append((node, generation, time.monotonic()))
+        self._notify()
+
+    def discard(self, node):
+        if self._generations.pop(id(node), None) is None:
+            return
+        node.disconnect()
+        self._created -= 1
+        self._notify()
+
+    def reset(self):
+        self._generation += 1
+        for node, generation, used in self._idle:
+            node.disconnect()
+        self._created -= len(self._idle)
+        self._idle = []
+        self._notify(len(self._waiters))
+
+    disconnect = reset
+
+
+class AsyncPipeline(Pipeline):
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        if not commands and not self.transaction:
+            return []
+        return await self._redis.runbatch(commands, self.transaction)
+
+
+class AsyncRedis(object, metaclass=MetaRedis):
+    """
+    asyncio client interface to Redis, every command is a coroutine:
+
+    r = AsyncRedis()
+    await r.set("key", "value")
+
+    Connections are checked out of an AsyncConnectionPool per command,
+    a task keeps its connection from MULTI/WATCH to EXEC/DISCARD/UNWATCH
+    and while subscribed, the same way a thread does with Redis.
+    """
+
+    def __init__(self, host="localhost", port=6379, db=0,
+                 password=None, timeout=None, sentinels=None,
+                 service_name=None, debug=False, pool=None,
+                 max_connections=None, pool_timeout=None, protocol=2,
+                 metrics=None):
+        self.host = host
+        if metrics is True:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.port = port
+        self.timeout = timeout
+        self.db = db
+        self.password = password
+        self.debug = debug
+        self.protocol = protocol
+        self.service_name = service_name
+        if sentinels:
+            self.sentinels = [
+                AsyncNode(host, port, 0, None,
+                          timeout or DEFAULT_SENTINEL_TIMEOUT)
+                for host, port in sentinels]
+            self.master = None
+        else:
+            self.sentinels = None
+            self.master = (self.host, self.port)
+        self._discovered = False
+        self._sentinel_lock = None
+        # (pinned node, transaction, subscribed) of the running task
+        self._state = contextvars.ContextVar("desir_state_%d" % id(self),
+                                             default=(None, False, False))
+        if pool is None:
+            pool = AsyncConnectionPool(self._newnode, max_connections,
+                                       pool_timeout)
+        self.pool = pool
+
+    @property
+    def transaction(self):
+        return self._state.get()[1]
+
+    @property
+    def subscribed(self):
+        return self._state.get()[2]
+
+    async def _discover(self):
+        """
+        find the service name and the other sentinels
+        """
+        if self.service_name is None:
+            for node in self.sentinels:
+                try:
+                    res = await node.runcmd('sentinel', 'masters')
+                except NodeError:
+                    continue
+                if res:
+                    self.service_name = res[0][1].decode('utf8')
+                    if self.debug:
+                        print('discovered master', self.service_name)
+                    break
+            if not self.service_name:
+                raise SentinelError(
+                    'no master detected, please specify master')
+        known = set((node.host, node.port) for node in self.sentinels)
+        for node in list(self.sentinels):
+            try:
+                res = await node.runcmd('sentinel', 'sentinels',
+                                        self.service_name)
+            except NodeError:
+                continue
+            for _val in res:
+                val = [v.decode('utf8') for v in _val]
+                dv = dict(zip(val[::2], val[1::2]))
+                addr = (dv['ip'], int(dv['port']))
+                if addr not in known:
+                    known.add(addr)
+                    self.sentinels.append(AsyncNode(
+                        addr[0], addr[1], 0, None,
+                        self.timeout or DEFAULT_SENTINEL_TIMEOUT))
+                    if self.debug:
+                        print('discovered sentinel %s %d' % addr)
+        self._discovered = True
+
+    async def _master(self):
+        if self.master is not None:
+            return self.master
+        if self._sentinel_lock is None:
+            self._sentinel_lock = asyncio.Lock()
+        async with self._sentinel_lock:
+            if self.master is not None:
+                return self.master
+            if not self._discovered:
+                await self._discover()
+            empty_master_result = False
+            for node in self.sentinels:
+                try:
+                    res = await node.runcmd('sentinel',
+                                            'get-master-addr-by-name',
+                                            self.service_name)
+                except NodeError:
+                    continue
+                if (type(res) is list) and len(res) == 2:
+                    bhost, bport = res
+                    self.host = bhost.decode('utf8')
+                    self.port = int(bport)
+                    self.master = (self.host, self.port)
+                    return self.master
+                empty_master_result = True
+            if empty_master_result:
+                raise SentinelErrorNoMaster(
+                    'unable to get master from a sentinel')
+            raise SentinelError('unable to connect to any sentinel')
+
+    async def _newnode(self):
+        host, port = await self._master()
+        node = AsyncNode(host, port, self.db, self.password, self.timeout,
+                         protocol=self.protocol)
+        node.metrics = self.metrics
+        return node
+
+    def _nodeerror(self, node):
+        self.pool.discard(node)
+        if self.sentinels:
+            self.master = None
+            self.pool.reset()
+
+    async def __node__(self):
+        node, transaction, subscribed = self._state.get()
+        if node is None:
+            node = await self.pool.checkout()
+            self._state.set((node, transaction, subscribed))
+        return node
+
+    def _unpin(self, node):
+        self._state.set((None, False, False))
+        node.pushes.clear()
+        self.pool.release(node)
+
+    async def listen(self, todict=False):
+        while self.subscribed:
+            node = await self.__node__()
+            try:
+                r = await node.parse_push()
+            except NodeError:
+                self._state.set((None, False, False))
+                self._nodeerror(node)
+                raise
+            r = pubsub_message(r)
+            if r.type == b'unsubscribe' and r.data == 0:
+                self._unpin(node)
+            yield r.todict() if todict else r
+
+    async def runcmd(self, cmdname, *args):
+        node, transaction, subscribed = self._state.get()
+        if node is None and cmdname not in PINNED_COMMANDS:
+            node = await self.pool.checkout()
+            try:
+                rsp = await node.runcmd(cmdname, *args)
+            except RedisError:
+                self.pool.release(node)
+                raise
+            except NodeError:
+                self._nodeerror(node)
+                raise
+            except BaseException:
+                # cancelled while waiting for the reply
+                self.pool.discard(node)
+                raise
+            self.pool.release(node)
+            return rsp
+
+        node = await self.__node__()
+        if cmdname in ["MULTI", "WATCH"]:
+            transaction = True
+        if cmdname in ["DISCARD", "EXEC", "UNWATCH"]:
+            transaction = False
+        try:
+            rsp = await node.runcmd(cmdname, *args)
+            if cmdname in ["SUBSCRIBE", "PSUBSCRIBE"]:
+                subscribed = True
+            elif (cmdname in ["UNSUBSCRIBE", "PUNSUBSCRIBE"] and
+                  isinstance(rsp, list) and rsp[2] == 0):
+                subscribed = False
+        except RedisError:
+            if not transaction and not subscribed:
+                self._unpin(node)
+            else:
+                self._state.set((node, transaction, subscribed))
+            raise
+        except BaseException:
+            self._state.set((None, False, False))
+            self._nodeerror(node)
+            raise
+        if not transaction and not subscribed:
+            self._unpin(node)
+        else:
+            self._state.set((node, transaction, subscribed))
+        return rsp
+
+    def pipeline(self, transaction=False):
+        return AsyncPipeline(self, transaction)
+
+    async def runbatch(self, commands, transaction=False):
+        """
+        send a list of (cmdname, args) in one write and read back their
+        replies in order, see Redis.runbatch
+        """
+        if transaction:
+            commands = [("MULTI", ())] + list(commands) + [("EXEC", ())]
+        pinned, intransaction, subscribed = self._state.get()
+        node = pinned or await self.pool.checkout()
+        try:
+            replies = await node.runcommands(
+                commands, "MULTI" if transaction else "PIPELINE")
+        except BaseException:
+            self._state.set((None, False, False))
+            self._nodeerror(node)
+            raise
+        if transaction:
+            intransaction = False
+        if pinned is None or not (intransaction or subscribed):
+            self._unpin(node)
+        if transaction:
+            replies = replies[-1]
+            if isinstance(replies, RedisError):
+                raise replies
+        return replies
+
+    def scan_iter(self, match=None, count=None, type=None):
+        """
+        async iterator over the keys, see Redis.scan_iter
+        """
+        return self._scan("SCAN", (), scan_options(match, count, type))
+
+    def hscan_iter(self, key, match=None, count=None):
+        return self._scan("HSCAN", (key,), scan_options(match, count), True)
+
+    def sscan_iter(self, key, match=None, count=None):
+        return self._scan("SSCAN", (key,), scan_options(match, count))
+
+    def zscan_iter(self, key, match=None, count=None):
+        return self._scan("ZSCAN", (key,), scan_options(match, count), True)
+
+    async def _scan(self, cmdname, args, options, pairs=False):
+        node = await self.pool.checkout()
+        pending = False
+        try:
+            request = await node.request(
+                [(cmdname, args + (0,) + options)], cmdname)
+            pending = True
+            while pending:
+                cursor, items = await node.replies(request)
+                pending = False
+                if cursor != b"0":
+                    request = await node.request(
+                        [(cmdname, args + (cursor,) + options)], cmdname)
+                    pending = True
+                if pairs:
+                    items = zip(items[::2], items[1::2])
+                for item in items:
+                    yield item
+        except NodeError:
+            self._nodeerror(node)
+            node = None
+            raise
+        except RedisError:
+            pending = False
+            raise
+        finally:
+            if node is None:
+                pass
+            elif pending:
+                self.pool.discard(node)
+            else:
+                self.pool.release(node)
+
+    async def _select(self, cmdname, *args):
+        resp = await self.runcmd(cmdname, *args)
+        if resp == b"OK":
+            self.db = int(args[0])
+            self.pool.reset()
+        return resp
+
+    def close(self):
+        self.pool.reset()
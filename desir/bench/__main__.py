@@ -0,0 +1,114 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Run the benchmark scenarios and write their results as JSON.
+
+    python -m desir.bench [--server auto|standin|redis|PATH|HOST:PORT]
+                          [--scenarios set_get,mset,...] [--ops 20000]
+                          [--output results.json]
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from .scenarios import SCENARIOS, run_scenarios
+from .server import start_server
+
+
+def _ints(value):
+    return [int(v) for v in value.split(",")]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m desir.bench",
+        description="desir benchmark suite, writes its results as JSON")
+    parser.add_argument(
+        "--server", default="auto",
+        help="auto (redis-server when on the PATH, the stand-in "
+             "otherwise), standin, redis, a redis-server path or the "
+             "HOST:PORT of a running server (default: auto)")
+    parser.add_argument(
+        "--scenarios", default=",".join(SCENARIOS),
+        help="comma separated scenarios among %s" % ", ".join(SCENARIOS))
+    parser.add_argument("--ops", type=int, default=20000,
+                        help="operations per measure (default: 20000)")
+    parser.add_argument("--concurrency", type=_ints, default=[1, 8],
+                        help="threads of set_get (default: 1,8)")
+    parser.add_argument("--sizes", type=_ints,
+                        default=[100 << 10, 1 << 20, 10 << 20],
+                        help="value sizes of large_values")
+    parser.add_argument("--output", help="JSON file of the results")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    names = [name for name in options.scenarios.split(",") if name]
+    for name in names:
+        if name not in SCENARIOS:
+            sys.exit("unknown scenario %s" % name)
+    server = start_server(options.server)
+    print("server: %s %s at %s:%d" % (server.kind, server.version or "",
+                                      server.host, server.port))
+
+    def report(entry):
+        params = " ".join("%s=%s" % item for item in entry["params"].items())
+        print("%-14s %-30s %12.0f ops/s  p50 %9.1fus  p99 %9.1fus" % (
+            entry["scenario"], params, entry["ops_per_sec"],
+            entry["p50_us"], entry["p99_us"]))
+
+    try:
+        results = run_scenarios(server.host, server.port, options, names,
+                                report)
+    finally:
+        server.stop()
+    if options.output:
+        document = dict(
+            time=time.time(),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            server=dict(kind=server.kind, version=server.version),
+            options=dict(ops=options.ops, concurrency=options.concurrency,
+                         sizes=options.sizes),
+            results=results)
+        with open(options.output, "w") as f:
+            json.dump(document, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
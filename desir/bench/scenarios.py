@@ -0,0 +1,297 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Benchmark scenarios, each one gives a list of results:
+
+    {"scenario": name, "params": {...}, "ops": n, "seconds": wall time,
+     "ops_per_sec": ..., "p50_us": ..., "p99_us": ..., "mean_us": ...}
+
+Keys are created under "desir:bench:" and deleted afterwards.
+"""
+
+import threading
+import time
+
+from .. import Redis
+
+PREFIX = "desir:bench:"
+
+SCENARIOS = {}
+
+
+def scenario(func):
+    SCENARIOS[func.__name__] = func
+    return func
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    index = min(int(len(samples) * q / 100.0), len(samples) - 1)
+    return samples[index]
+
+
+def result(name, params, latencies, seconds, **extra):
+    """
+    result entry of latencies (in seconds) measured over seconds
+    """
+    latencies = sorted(latencies)
+    n = len(latencies)
+    entry = dict(scenario=name, params=params, ops=n, seconds=seconds,
+                 ops_per_sec=n / seconds if seconds else 0.0,
+                 p50_us=percentile(latencies, 50) * 1e6,
+                 p99_us=percentile(latencies, 99) * 1e6,
+                 mean_us=sum(latencies) / n * 1e6 if n else 0.0)
+    entry.update(extra)
+    return entry
+
+
+def in_threads(concurrency, target):
+    """
+    run target(i) in concurrency threads, returns the latencies they
+    returned (concatenated) and the wall time
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def run(i):
+        samples = target(i)
+        with lock:
+            latencies.extend(samples)
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+@scenario
+def set_get(r, options):
+    """
+    SET then GET of a small value, by concurrency level
+    """
+    value = b"v" * 64
+    for concurrency in options.concurrency:
+        per_thread = max(options.ops // concurrency, 1)
+
+        def work(i, command):
+            key = "%sk:%d" % (PREFIX, i)
+            if command == "SET":
+                return [timed(r.set, key, value) for j in range(per_thread)]
+            return [timed(r.get, key) for j in range(per_thread)]
+
+        for command in ("SET", "GET"):
+            latencies, seconds = in_threads(
+                concurrency, lambda i: work(i, command))
+            yield result("set_get", dict(command=command,
+                                         concurrency=concurrency),
+                         latencies, seconds)
+        r.delete(*["%sk:%d" % (PREFIX, i) for i in range(concurrency)])
+
+
+@scenario
+def mset(r, options):
+    """
+    MSET of 100 small keys
+    """
+    args = []
+    for i in range(100):
+        args.extend(("%sm:%d" % (PREFIX, i), b"v" * 16))
+    ops = max(options.ops // 20, 1)
+    latencies, seconds = in_threads(
+        1, lambda i: [timed(r.mset, *args) for j in range(ops)])
+    yield result("mset", dict(keys=100), latencies, seconds)
+    r.delete(*args[::2])
+
+
+@scenario
+def large_values(r, options):
+    """
+    SET and GET of large values
+    """
+    key = PREFIX + "large"
+    for size in options.sizes:
+        value = b"x" * size
+        ops = max(min(options.ops, (256 << 20) // size) // 4, 3)
+        for command in ("SET", "GET"):
+            if command == "SET":
+                latencies = [timed(r.set, key, value) for i in range(ops)]
+            else:
+                latencies = [timed(r.get, key) for i in range(ops)]
+            seconds = sum(latencies)
+            yield result("large_values", dict(command=command, size=size),
+                         latencies, seconds,
+                         mb_per_sec=size * ops / seconds / 1e6)
+    r.delete(key)
+
+
+@scenario
+def deep_arrays(r, options):
+    """
+    LRANGE of whole lists: parsing of large array replies
+    """
+    key = PREFIX + "list"
+    for length in (100, 10000):
+        r.delete(key)
+        for start in range(0, length, 1000):
+            r.rpush(key, *[b"element:%d" % i
+                           for i in range(start, min(start + 1000, length))])
+        ops = max(options.ops * 10 // length, 3)
+        latencies = [timed(r.lrange, key, 0, -1) for i in range(ops)]
+        yield result("deep_arrays", dict(length=length), latencies,
+                     sum(latencies),
+                     elements_per_sec=length * ops / sum(latencies))
+    r.delete(key)
+
+
+@scenario
+def pubsub_fanout(r, options):
+    """
+    PUBLISH to a channel with several subscribers, latency from publish
+    to delivery
+    """
+    channel = PREFIX + "channel"
+    for subscribers in (1, 10, 50):
+        messages = max(options.ops // subscribers, 10)
+        ready = threading.Barrier(subscribers + 1)
+        latencies = []
+        lock = threading.Lock()
+
+        def subscriber():
+            s = Redis(r.host, r.port)
+            s.subscribe(channel)
+            ready.wait()
+            samples = []
+            for batch in s.listen_batch(1000):
+                now = time.perf_counter()
+                for message in batch:
+                    if message.type != b"message":
+                        continue
+                    if message.data == b"stop":
+                        s.unsubscribe(channel)
+                        break
+                    samples.append(now - float(message.data))
+            with lock:
+                latencies.extend(samples)
+
+        threads = [threading.Thread(target=subscriber)
+                   for i in range(subscribers)]
+        for thread in threads:
+            thread.start()
+        ready.wait()
+        start = time.perf_counter()
+        for i in range(messages):
+            r.publish(channel, b"%.9f" % time.perf_counter())
+        r.publish(channel, b"stop")
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+        yield result("pubsub_fanout", dict(subscribers=subscribers),
+                     latencies, seconds)
+
+
+@scenario
+def connector_rpc(r, options):
+    """
+    Connector calls to a worker by payload size and calls in flight
+    """
+    name = PREFIX + "worker"
+    for size in (16, 1024, 65536):
+        payload = "p" * size
+        for inflight in (1, 16, 64):
+            calls = max(min(options.ops // 4, (64 << 20) // size), 10)
+            worker = r.Connector(name)
+            worker.register(echo)
+            running = threading.Event()
+            running.set()
+            thread = threading.Thread(
+                target=worker.worker, args=(running.is_set,),
+                kwargs=dict(concurrency=inflight))
+            thread.start()
+            client = r.Connector(timeout=30)
+            slots = threading.Semaphore(inflight)
+            latencies = []
+
+            def done(future, sent):
+                latencies.append(time.perf_counter() - sent)
+                future.result()
+                slots.release()
+
+            start = time.perf_counter()
+            futures = []
+            for i in range(calls):
+                slots.acquire()
+                sent = time.perf_counter()
+                future = client.run_async(name, "echo", payload)
+                future.add_done_callback(
+                    lambda f, sent=sent: done(f, sent))
+                futures.append(future)
+            for future in futures:
+                future.result()
+            seconds = time.perf_counter() - start
+            running.clear()
+            thread.join()
+            client.close()
+            yield result("connector_rpc", dict(size=size, inflight=inflight),
+                         latencies, seconds)
+    r.delete(name)
+
+
+def echo(value):
+    return value
+
+
+def run_scenarios(host, port, options, names=None, report=None):
+    """
+    results of the scenarios names (all by default) against host:port,
+    report is called with each result as it comes
+    """
+    r = Redis(host, port)
+    results = []
+    for name in names or SCENARIOS:
+        for entry in SCENARIOS[name](r, options):
+            results.append(entry)
+            if report is not None:
+                report(entry)
+    return results
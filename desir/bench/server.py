@@ -0,0 +1,530 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Servers the benchmarks run against: a redis-server subprocess or an
+asyncio RESP stand-in serving the commands used by the scenarios
+"""
+
+import asyncio
+import collections
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+from ..resp import NOREPLY, RedisError, RespReader
+
+
+class Status(str):
+    """
+    simple string reply
+    """
+
+
+class Replies(list):
+    """
+    several replies to one command (SUBSCRIBE of several channels)
+    """
+
+
+# nil multi bulk reply (BRPOP timeout)
+NIL_ARRAY = object()
+
+OK = Status("OK")
+
+
+def encode(value):
+    """
+    RESP2 encoding of a reply
+    """
+    if value is None:
+        return b"$-1\r\n"
+    t = type(value)
+    if t is bytes:
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if t is int:
+        return b":%d\r\n" % value
+    if t is Status:
+        return b"+%s\r\n" % value.encode("utf-8")
+    if t is Replies:
+        return b"".join(encode(v) for v in value)
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode(v) for v in value)
+    if value is NIL_ARRAY:
+        return b"*-1\r\n"
+    if isinstance(value, RedisError):
+        return b"-%s\r\n" % str(value).encode("utf-8")
+    raise TypeError("can not encode %r" % (value,))
+
+
+def _error(msg):
+    return RedisError(msg)
+
+
+def _wrongtype():
+    return RedisError("WRONGTYPE Operation against a key holding the wrong "
+                      "kind of value")
+
+
+class _Client(object):
+    def __init__(self, writer):
+        self.writer = writer
+        self.channels = set()
+
+
+class StandinServer(object):
+    """
+    Tiny RESP2 server on asyncio, run in a background thread: strings,
+    lists with blocking pops and pub/sub, enough for the benchmark
+    scenarios (no expiry, persistence or transactions). Other commands
+    get an error reply.
+    """
+
+    kind = "standin"
+    version = None
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.data = {}
+        # key -> futures of the clients blocked in BRPOP
+        self._waiters = collections.defaultdict(collections.deque)
+        self._channels = collections.defaultdict(set)
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """
+        listen and serve in a background thread, returns (host, port)
+        """
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._serve, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+        return self.host, self.port
+
+    def stop(self):
+        if self._loop is None:
+            return
+
+        async def close():
+            self._server.close()
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    async def _serve(self, reader, writer):
+        parser = RespReader()
+        client = _Client(writer)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                parser.feed(data)
+                out = []
+                while True:
+                    command = parser.gets(False)
+                    if command is NOREPLY:
+                        break
+                    reply = self.execute(client, command)
+                    if asyncio.iscoroutine(reply):
+                        # blocking command, answer what came before
+                        writer.write(b"".join(out))
+                        out = []
+                        reply = await reply
+                    out.append(encode(reply))
+                if out:
+                    writer.write(b"".join(out))
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            for channel in client.channels:
+                self._channels[channel].discard(client)
+            writer.close()
+
+    def execute(self, client, command):
+        if not isinstance(command, list) or not command:
+            return _error("ERR Protocol error")
+        name = command[0].decode("utf-8", "replace").lower()
+        method = getattr(self, "cmd_" + name, None)
+        if method is None:
+            return _error("ERR unknown command '%s'" % name)
+        try:
+            return method(client, *command[1:])
+        except TypeError:
+            return _error("ERR wrong number of arguments for '%s' command"
+                          % name)
+
+    # connection
+
+    def cmd_ping(self, client, message=None):
+        return Status("PONG") if message is None else message
+
+    def cmd_echo(self, client, message):
+        return message
+
+    def cmd_select(self, client, db):
+        return OK
+
+    def cmd_client(self, client, *args):
+        # CLIENT ID, other subcommands (TRACKING, SETNAME...) are accepted
+        # and ignored: the stand-in sends no invalidation messages
+        if args and args[0].upper() == b"ID":
+            return id(client) & 0xffffffff
+        return OK
+
+    def cmd_flushdb(self, client, *args):
+        self.data.clear()
+        return OK
+
+    cmd_flushall = cmd_flushdb
+
+    # keys and strings
+
+    def cmd_del(self, client, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def cmd_exists(self, client, *keys):
+        return sum(key in self.data for key in keys)
+
+    def cmd_get(self, client, key):
+        value = self.data.get(key)
+        if value is not None and type(value) is not bytes:
+            return _wrongtype()
+        return value
+
+    def cmd_set(self, client, key, value, *options):
+        self.data[key] = value
+        return OK
+
+    def cmd_mget(self, client, *keys):
+        data = self.data
+        return [v if type(v) is bytes else None
+                for v in (data.get(k) for k in keys)]
+
+    def cmd_mset(self, client, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise TypeError
+        self.data.update(zip(pairs[::2], pairs[1::2]))
+        return OK
+
+    def cmd_incrby(self, client, key, increment):
+        value = self.data.get(key, b"0")
+        if type(value) is not bytes:
+            return _wrongtype()
+        try:
+            value = int(value) + int(increment)
+        except ValueError:
+            return _error("ERR value is not an integer or out of range")
+        self.data[key] = b"%d" % value
+        return value
+
+    def cmd_incr(self, client, key):
+        return self.cmd_incrby(client, key, b"1")
+
+    # lists
+
+    def _list(self, key, create=False):
+        value = self.data.get(key)
+        if value is None:
+            if create:
+                value = self.data[key] = collections.deque()
+            return value
+        if type(value) is not collections.deque:
+            raise RedisError("WRONGTYPE")
+        return value
+
+    def _push(self, key, values, left):
+        try:
+            lst = self._list(key, True)
+        except RedisError:
+            return _wrongtype()
+        if left:
+            lst.extendleft(values)
+        else:
+            lst.extend(values)
+        n = len(lst)
+        waiters = self._waiters.get(key)
+        while waiters and lst:
+            future = waiters.popleft()
+            if not future.done():
+                future.set_result([key, lst.pop()])
+        if not lst:
+            del self.data[key]
+        return n
+
+    def cmd_lpush(self, client, key, *values):
+        if not values:
+            raise TypeError
+        return self._push(key, values, True)
+
+    def cmd_rpush(self, client, key, *values):
+        if not values:
+            raise TypeError
+        return self._push(key, values, False)
+
+    def cmd_llen(self, client, key):
+        try:
+            lst = self._list(key)
+        except RedisError:
+            return _wrongtype()
+        return len(lst) if lst else 0
+
+    def cmd_lrange(self, client, key, start, stop):
+        try:
+            lst = self._list(key)
+        except RedisError:
+            return _wrongtype()
+        if not lst:
+            return []
+        start, stop = int(start), int(stop)
+        n = len(lst)
+        if start < 0:
+            start = max(n + start, 0)
+        if stop < 0:
+            stop += n
+        return list(lst)[start:stop + 1]
+
+    def _pop(self, key, count=None):
+        lst = self._list(key)
+        if not lst:
+            return None
+        if count is None:
+            value = lst.pop()
+        else:
+            value = [lst.pop() for i in range(min(count, len(lst)))]
+        if not lst:
+            del self.data[key]
+        return value
+
+    def cmd_rpop(self, client, key, count=None):
+        try:
+            return self._pop(key, None if count is None else int(count))
+        except RedisError:
+            return _wrongtype()
+
+    def cmd_brpop(self, client, *args):
+        if len(args) < 2:
+            raise TypeError
+        keys, timeout = args[:-1], float(args[-1])
+        try:
+            for key in keys:
+                value = self._pop(key)
+                if value is not None:
+                    return [key, value]
+        except RedisError:
+            return _wrongtype()
+        return self._block(keys, timeout)
+
+    async def _block(self, keys, timeout):
+        future = asyncio.get_running_loop().create_future()
+        for key in keys:
+            self._waiters[key].append(future)
+        try:
+            return await asyncio.wait_for(future, timeout or None)
+        except asyncio.TimeoutError:
+            return NIL_ARRAY
+        finally:
+            for key in keys:
+                waiters = self._waiters.get(key)
+                if waiters is not None:
+                    try:
+                        waiters.remove(future)
+                    except ValueError:
+                        pass
+                    if not waiters:
+                        del self._waiters[key]
+
+    # pub/sub
+
+    def cmd_subscribe(self, client, *channels):
+        if not channels:
+            raise TypeError
+        replies = Replies()
+        for channel in channels:
+            client.channels.add(channel)
+            self._channels[channel].add(client)
+            replies.append([b"subscribe", channel, len(client.channels)])
+        return replies
+
+    def cmd_unsubscribe(self, client, *channels):
+        replies = Replies()
+        for channel in channels or list(client.channels):
+            client.channels.discard(channel)
+            self._channels[channel].discard(client)
+            replies.append([b"unsubscribe", channel, len(client.channels)])
+        return replies
+
+    def cmd_publish(self, client, channel, message):
+        subscribers = self._channels.get(channel)
+        if not subscribers:
+            return 0
+        frame = encode([b"message", channel, message])
+        for subscriber in subscribers:
+            subscriber.writer.write(frame)
+        return len(subscribers)
+
+
+def find_redis_server():
+    """
+    path of redis-server when it is on the PATH
+    """
+    return shutil.which("redis-server")
+
+
+def _free_port(host):
+    sock = socket.socket()
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+class RedisServer(object):
+    """
+    redis-server subprocess without persistence on a free port
+    """
+
+    kind = "redis-server"
+
+    def __init__(self, path=None, host="127.0.0.1", port=None):
+        self.path = path or find_redis_server()
+        self.host = host
+        self.port = port
+        self.version = None
+        self._process = None
+
+    def start(self, timeout=10):
+        from .. import Node, NodeError
+        if self.port is None:
+            self.port = _free_port(self.host)
+        self._process = subprocess.Popen(
+            [self.path, "--port", str(self.port), "--bind", self.host,
+             "--save", "", "--appendonly", "no"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + timeout
+        while True:
+            node = Node(self.host, self.port)
+            try:
+                info = node.runcmd("INFO", "server").decode("utf-8")
+                break
+            except NodeError:
+                if (time.monotonic() > deadline or
+                        self._process.poll() is not None):
+                    self.stop()
+                    raise
+                time.sleep(0.05)
+            finally:
+                node.disconnect()
+        for line in info.splitlines():
+            if line.startswith("redis_version:"):
+                self.version = line.split(":", 1)[1]
+        return self.host, self.port
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+            self._process = None
+
+
+class ExternalServer(object):
+    """
+    server already running at host:port, left untouched
+    """
+
+    kind = "external"
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.version = None
+
+    def start(self):
+        from .. import Node
+        node = Node(self.host, self.port)
+        try:
+            info = node.runcmd("INFO", "server").decode("utf-8")
+            for line in info.splitlines():
+                if line.startswith("redis_version:"):
+                    self.version = line.split(":", 1)[1]
+        finally:
+            node.disconnect()
+        return self.host, self.port
+
+    def stop(self):
+        pass
+
+
+def start_server(server="auto"):
+    """
+    start the server named by server: "auto" (redis-server when on the
+    PATH, the stand-in otherwise), "standin", "redis", a redis-server path
+    or host:port of a running server. Returns the started server.
+    """
+    if server == "auto":
+        server = "redis" if find_redis_server() else "standin"
+    if server == "standin":
+        instance = StandinServer()
+    elif server == "redis":
+        if not find_redis_server():
+            raise RuntimeError("redis-server is not on the PATH")
+        instance = RedisServer()
+    elif ":" in server and not server.startswith(("/", ".")):
+        host, port = server.rsplit(":", 1)
+        instance = ExternalServer(host, int(port))
+    else:
+        instance = RedisServer(server)
+    instance.start()
+    return instance
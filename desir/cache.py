@@ -0,0 +1,299 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Server assisted client side caching (CLIENT TRACKING)
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from .resp import NodeError, RedisError
+
+DEFAULT_CACHE_SIZE = 10000
+
+INVALIDATE_CHANNEL = b"__redis__:invalidate"
+
+# read only commands whose reply only depends on their keys
+CACHEABLE_COMMANDS = frozenset([
+    "GET", "MGET", "STRLEN", "GETRANGE", "GETBIT", "BITCOUNT", "BITPOS",
+    "EXISTS", "TYPE",
+    "HGET", "HMGET", "HGETALL", "HKEYS", "HVALS", "HLEN", "HEXISTS",
+    "HSTRLEN",
+    "LRANGE", "LLEN", "LINDEX",
+    "SMEMBERS", "SISMEMBER", "SCARD",
+    "ZRANGE", "ZREVRANGE", "ZRANGEBYSCORE", "ZREVRANGEBYSCORE",
+    "ZRANGEBYLEX", "ZREVRANGEBYLEX", "ZSCORE", "ZRANK", "ZREVRANK",
+    "ZCARD", "ZCOUNT", "ZLEXCOUNT",
+])
+
+# commands dropping every key of a database
+FLUSH_COMMANDS = frozenset(["FLUSHDB", "FLUSHALL", "SWAPDB"])
+
+
+def _copy(reply):
+    # cached aggregates are handed out as copies
+    t = type(reply)
+    if t is list or t is dict or t is set:
+        return t(reply)
+    return reply
+
+
+def _keybytes(key):
+    if type(key) is bytes:
+        return key
+    if isinstance(key, (bytearray, memoryview)):
+        return bytes(key)
+    return str(key).encode("utf-8")
+
+
+class ClientCache(object):
+    """
+    Bounded LRU of read only command replies kept in sync with the server
+    through CLIENT TRACKING invalidation messages.
+
+    Invalidations are received on a dedicated connection subscribed to
+    __redis__:invalidate, every pooled connection redirects its tracking
+    to it. When prefixes are given the broadcast mode is used instead:
+    only the invalidation connection registers, and every change to a key
+    starting with one of the prefixes is notified (only commands on such
+    keys are then cached).
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, prefixes=None,
+                 commands=CACHEABLE_COMMANDS):
+        self.maxsize = maxsize
+        self.prefixes = tuple(_keybytes(p) for p in prefixes or ())
+        self.commands = commands
+        self.client_id = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # (cmdname, args) -> (keys, reply), least recently used first
+        self._data = OrderedDict()
+        # key -> set of entries depending on it
+        self._keys = {}
+        # keys being fetched -> count, and those invalidated meanwhile
+        self._inflight = {}
+        self._stale = set()
+        self._lock = threading.Lock()
+        self._node = None
+        self._thread = None
+        self._closed = False
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return dict(size=len(self._data), maxsize=self.maxsize,
+                    hits=self.hits, misses=self.misses,
+                    evictions=self.evictions,
+                    invalidations=self.invalidations)
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._keys.clear()
+            self._stale.update(self._inflight)
+
+    def invalidate(self, keys):
+        """
+        drop the entries depending on keys, everything when keys is None
+        """
+        if keys is None:
+            self.clear()
+            return
+        with self._lock:
+            for key in keys:
+                if key in self._inflight:
+                    self._stale.add(key)
+                for entry in self._keys.pop(key, ()):
+                    if self._data.pop(entry, None) is not None:
+                        self.invalidations += 1
+
+    def written(self, cmdname, args):
+        """
+        drop the entries depending on the keys of a command which may
+        change them, before it is sent and once it ran: the invalidation
+        message of the server may only come after the next read
+        """
+        if cmdname in self.commands:
+            return
+        if cmdname in FLUSH_COMMANDS:
+            self.clear()
+            return
+        if not (self._keys or self._inflight):
+            return
+        from .desir3 import command_keys
+        try:
+            keys = command_keys(cmdname, args)
+        except (IndexError, ValueError, TypeError):
+            # malformed, the server will reject it
+            return
+        if keys:
+            self.invalidate([_keybytes(k) for k in keys])
+
+    def _evict(self):
+        entry, (keys, reply) = self._data.popitem(last=False)
+        self.evictions += 1
+        for key in keys:
+            entries = self._keys.get(key)
+            if entries is not None:
+                entries.discard(entry)
+                if not entries:
+                    del self._keys[key]
+
+    def fetch(self, runcmd, cmdname, args):
+        """
+        cached reply of cmdname args, calling runcmd on a miss
+        """
+        entry = (cmdname, args)
+        try:
+            with self._lock:
+                cached = self._data.get(entry)
+                if cached is not None:
+                    self._data.move_to_end(entry)
+                    self.hits += 1
+                    return _copy(cached[1])
+        except TypeError:
+            # unhashable argument
+            return runcmd(cmdname, *args)
+        from .desir3 import command_keys
+        keys = [_keybytes(k) for k in command_keys(cmdname, args)]
+        if not keys or (self.prefixes and not all(
+                k.startswith(self.prefixes) for k in keys)):
+            return runcmd(cmdname, *args)
+        with self._lock:
+            self.misses += 1
+            for key in keys:
+                self._inflight[key] = self._inflight.get(key, 0) + 1
+        stored = False
+        try:
+            reply = runcmd(cmdname, *args)
+            stored = True
+        finally:
+            with self._lock:
+                for key in keys:
+                    if key in self._stale:
+                        stored = False
+                for key in keys:
+                    count = self._inflight[key] - 1
+                    if count:
+                        self._inflight[key] = count
+                    else:
+                        del self._inflight[key]
+                        self._stale.discard(key)
+                if stored and self.maxsize:
+                    if entry not in self._data:
+                        while len(self._data) >= self.maxsize:
+                            self._evict()
+                        for key in keys:
+                            self._keys.setdefault(key, set()).add(entry)
+                    self._data[entry] = (keys, reply)
+        return _copy(reply)
+
+    def tracking(self):
+        """
+        CLIENT TRACKING arguments for a data connection, None when the
+        connection does not need tracking
+        """
+        if self.prefixes:
+            return None
+        return ("ON", "REDIRECT", self.client_id)
+
+    def onconnect(self, node):
+        args = self.tracking()
+        if args is not None:
+            node.runcmd("CLIENT TRACKING", *args)
+
+    def ondisconnect(self, node):
+        # the server forgets what was read through this connection
+        self.clear()
+
+    def start(self, factory, onreset):
+        """
+        open the invalidation connection with factory and start listening,
+        onreset is called when it had to reconnect
+        """
+        self._factory = factory
+        self._onreset = onreset
+        self._connect()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _connect(self):
+        node = self._factory()
+        # this connection does not track its own reads
+        node.onconnect = node.ondisconnect = None
+        node.timeout = None
+        self.client_id = node.runcmd("CLIENT", "ID")
+        if self.prefixes:
+            args = ["ON", "REDIRECT", self.client_id, "BCAST"]
+            for prefix in self.prefixes:
+                args.extend(("PREFIX", prefix))
+            node.runcmd("CLIENT TRACKING", *args)
+        node.runcmd("SUBSCRIBE", INVALIDATE_CHANNEL)
+        self._node = node
+
+    def _run(self):
+        while not self._closed:
+            try:
+                msg = self._node.parse_push()
+            except (NodeError, RedisError):
+                if self._closed:
+                    break
+                self.clear()
+                while not self._closed:
+                    try:
+                        self._connect()
+                        break
+                    except (NodeError, RedisError):
+                        time.sleep(0.5)
+                self._onreset()
+                continue
+            if msg[0] == b"message" and msg[1] == INVALIDATE_CHANNEL:
+                self.invalidate(msg[2])
+            elif msg[0] == b"invalidate":
+                # RESP3 connections get invalidations as push frames
+                self.invalidate(msg[1])
+
+    def close(self):
+        self._closed = True
+        if self._node is not None:
+            self._node.disconnect()
+        self.clear()
@@ -0,0 +1,375 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Redis Cluster client routing commands on the hash slot of their first key
+"""
+
+import random
+import threading
+import time
+
+from .desir3 import MetaRedis, Node, Pipeline, PINNED_COMMANDS, command_keys
+from .metrics import Metrics
+from .pool import ConnectionPool
+from .resp import RedisError, NodeError
+
+SLOTS = 16384
+
+DEFAULT_MAX_REDIRECTS = 16
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for i in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+        table.append(crc)
+    return table
+
+
+_CRC16 = _crc16_table()
+
+
+def crc16(data):
+    """
+    CRC16-CCITT (XMODEM) as used by redis cluster
+    """
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xff00) ^ _CRC16[((crc >> 8) ^ byte) & 0xff]
+    return crc
+
+
+def key_slot(key):
+    """
+    hash slot of a key, only the {hashtag} part is hashed when present
+    """
+    if type(key) is not bytes:
+        if isinstance(key, (bytearray, memoryview)):
+            key = bytes(key)
+        else:
+            key = str(key).encode("utf-8")
+    start = key.find(b"{")
+    if start >= 0:
+        end = key.find(b"}", start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return crc16(key) % SLOTS
+
+
+def _address(hostport, current):
+    host, port = hostport.rsplit(":", 1)
+    # an empty host means the node we talked to
+    return (host or current[0], int(port))
+
+
+class RedisCluster(object, metaclass=MetaRedis):
+    """
+    Redis Cluster client.
+
+    The slot map is bootstrapped from CLUSTER SLOTS (CLUSTER SHARDS when
+    available) on one of the startup nodes, each master gets its own
+    ConnectionPool. Commands go to the master serving the slot of their
+    first key, keyless commands to any master. MOVED redirects update the
+    slot map entry, ASK redirects are followed once with ASKING.
+    """
+
+    def __init__(self, startup_nodes=(("localhost", 7000),), password=None,
+                 timeout=None, max_connections=None, pool_timeout=None,
+                 max_redirects=DEFAULT_MAX_REDIRECTS, debug=False,
+                 metrics=None):
+        self.startup_nodes = [tuple(addr) for addr in startup_nodes]
+        if metrics is True:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.password = password
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.max_redirects = max_redirects
+        self.debug = debug
+        self.pools = {}
+        self.slots = [None] * SLOTS
+        self._lock = threading.Lock()
+        self.refresh_slots()
+
+    def pool(self, addr):
+        """
+        ConnectionPool of the node at addr (host, port)
+        """
+        pool = self.pools.get(addr)
+        if pool is None:
+            with self._lock:
+                pool = self.pools.get(addr)
+                if pool is None:
+                    pool = self.pools[addr] = ConnectionPool(
+                        self._factory(addr), self.max_connections,
+                        self.pool_timeout)
+        return pool
+
+    def _factory(self, addr):
+        def factory():
+            node = Node(addr[0], addr[1], 0, self.password, self.timeout)
+            node.metrics = self.metrics
+            return node
+        return factory
+
+    def _slots_map(self, node):
+        """
+        [(start, end, (host, port))] read from a node
+        """
+        try:
+            shards = node.runcmd("CLUSTER", "SHARDS")
+        except RedisError:
+            shards = None
+        ranges = []
+        if shards is None:
+            for entry in node.runcmd("CLUSTER", "SLOTS"):
+                start, end, master = entry[0], entry[1], entry[2]
+                host = master[0].decode("utf-8") or node.host
+                ranges.append((start, end, (host, int(master[1]))))
+            return ranges
+        for shard in shards:
+            shard = dict(zip(shard[::2], shard[1::2]))
+            slots = shard[b"slots"]
+            for info in shard[b"nodes"]:
+                info = dict(zip(info[::2], info[1::2]))
+                if info.get(b"role") != b"master":
+                    continue
+                if info.get(b"health", b"online") != b"online":
+                    continue
+                host = (info.get(b"ip") or info.get(b"endpoint")).decode(
+                    "utf-8") or node.host
+                port = int(info.get(b"port") or info.get(b"tls-port"))
+                for i in range(0, len(slots), 2):
+                    ranges.append((int(slots[i]), int(slots[i + 1]),
+                                   (host, port)))
+        return ranges
+
+    def refresh_slots(self):
+        """
+        reload the whole slot map from the first node answering
+        """
+        candidates = list(self.pools) + [
+            addr for addr in self.startup_nodes if addr not in self.pools]
+        for addr in candidates:
+            pool = self.pool(addr)
+            try:
+                node = pool.checkout()
+            except NodeError:
+                continue
+            try:
+                ranges = self._slots_map(node)
+            except NodeError:
+                pool.discard(node)
+                continue
+            pool.release(node)
+            slots = [None] * SLOTS
+            for start, end, master in ranges:
+                slots[start:end + 1] = [master] * (end - start + 1)
+            self.slots = slots
+            if self.debug:
+                print("cluster slot map loaded from %s:%d" % addr)
+            return
+        raise NodeError("unable to load the slot map from any cluster node")
+
+    def nodes(self):
+        """
+        addresses of the masters serving slots
+        """
+        return sorted(set(addr for addr in self.slots if addr is not None))
+
+    def _keyaddr(self, cmdname, args):
+        """
+        address serving the first key of a command, None when it has no
+        key or its slot is not mapped yet
+        """
+        try:
+            keys = command_keys(cmdname, args)
+        except (ValueError, IndexError):
+            keys = None
+        if keys:
+            return self.slots[key_slot(keys[0])]
+        return None
+
+    def _addr(self, cmdname, args):
+        addr = self._keyaddr(cmdname, args)
+        if addr is not None:
+            return addr
+        return random.choice(self.nodes() or self.startup_nodes)
+
+    def runcmd(self, cmdname, *args):
+        if cmdname in PINNED_COMMANDS:
+            raise RedisError(
+                "%s is not supported by RedisCluster, use "
+                "pipeline(transaction=True) for transactions" % cmdname)
+        return self.runcmdon(self._addr(cmdname, args), cmdname, *args)
+
+    def runcmdon(self, addr, cmdname, *args):
+        """
+        run a command on the node at addr following cluster redirects
+        """
+        asking = False
+        for attempt in range(self.max_redirects):
+            pool = self.pool(addr)
+            node = pool.checkout()
+            try:
+                if asking:
+                    node.runcmd("ASKING")
+                rsp = node.runcmd(cmdname, *args)
+            except NodeError:
+                pool.discard(node)
+                pool.reset()
+                # the node may have failed over, reload the map
+                time.sleep(0.1 * attempt)
+                try:
+                    self.refresh_slots()
+                except NodeError:
+                    pass
+                addr = self._addr(cmdname, args)
+                asking = False
+                continue
+            except RedisError as e:
+                pool.release(node)
+                redirect = self._redirect(e, addr)
+                if redirect is None:
+                    raise
+                addr, asking = redirect
+                continue
+            pool.release(node)
+            return rsp
+        raise RedisError("Too many cluster redirections for %s" % cmdname)
+
+    def _redirect(self, error, addr):
+        """
+        (new address, asking) when error is a MOVED/ASK redirect
+        """
+        msg = str(error).split()
+        if not msg:
+            return None
+        if msg[0] == "MOVED" and len(msg) == 3:
+            newaddr = _address(msg[2], addr)
+            # incremental refresh of the map
+            self.slots[int(msg[1])] = newaddr
+            return newaddr, False
+        if msg[0] == "ASK" and len(msg) == 3:
+            return _address(msg[2], addr), True
+        if msg[0] in ("TRYAGAIN", "CLUSTERDOWN"):
+            time.sleep(0.05)
+            if msg[0] == "CLUSTERDOWN":
+                self.refresh_slots()
+            return addr, False
+        return None
+
+    def pipeline(self, transaction=False):
+        return Pipeline(self, transaction)
+
+    def runbatch(self, commands, transaction=False):
+        """
+        send a batch of (cmdname, args), grouped by node: every node gets
+        one write then the replies are read back and put back in order.
+        Redirected commands are run again one by one.
+        A transaction must only touch keys served by a single node.
+        """
+        commands = list(commands)
+        groups = {}
+        anywhere = []
+        for i, (cmdname, args) in enumerate(commands):
+            addr = self._keyaddr(cmdname, args)
+            if addr is None:
+                anywhere.append(i)
+            else:
+                groups.setdefault(addr, []).append(i)
+        if anywhere:
+            # commands without a known node join the first group
+            if groups:
+                addr = next(iter(groups))
+            else:
+                addr = random.choice(self.nodes() or self.startup_nodes)
+            groups[addr] = sorted(groups.get(addr, []) + anywhere)
+        if transaction:
+            if len(groups) > 1:
+                raise RedisError(
+                    "CROSSSLOT transaction keys served by several nodes")
+            addr = next(iter(groups)) if groups else self._addr("PING", ())
+            batch = [("MULTI", ())] + commands + [("EXEC", ())]
+            pool = self.pool(addr)
+            node = pool.checkout()
+            try:
+                replies = node.runcommands(batch, "MULTI")
+            except NodeError:
+                pool.discard(node)
+                raise
+            pool.release(node)
+            replies = replies[-1]
+            if isinstance(replies, RedisError):
+                raise replies
+            return replies
+        replies = [None] * len(commands)
+        sent = []
+        requests = []
+        try:
+            for addr, indexes in groups.items():
+                pool = self.pool(addr)
+                node = pool.checkout()
+                sent.append((pool, node, indexes))
+                requests.append(node.request([commands[i] for i in indexes]))
+            for (pool, node, indexes), request in zip(sent, requests):
+                for i, reply in zip(indexes, node.replies(
+                        request, len(indexes), False)):
+                    replies[i] = reply
+        except NodeError:
+            for pool, node, indexes in sent:
+                pool.discard(node)
+            raise
+        for pool, node, indexes in sent:
+            pool.release(node)
+        for i, reply in enumerate(replies):
+            if isinstance(reply, RedisError):
+                msg = str(reply)
+                if msg.startswith(("MOVED ", "ASK ", "TRYAGAIN",
+                                   "CLUSTERDOWN")):
+                    cmdname, args = commands[i]
+                    try:
+                        replies[i] = self.runcmd(cmdname, *args)
+                    except RedisError as e:
+                        replies[i] = e
+        return replies
+
+    def close(self):
+        for pool in list(self.pools.values()):
+            pool.reset()
@@ -0,0 +1,262 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Connector payload codecs and binary message envelope
+"""
+
+import json
+import pickle
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# first byte of a binary envelope, json envelopes start with "{"
+MAGIC = 0xde
+VERSION = 1
+
+# magic, version, codec id, flags, time, lengths of src, srctype, dst
+# and funcname, number of out of band buffers, length of the value
+_HEADER = struct.Struct("!BBBBdHHHHHI")
+_BUFFER = struct.Struct("!I")
+# correlation id of a call, follows the fixed header when FLAG_CID is set
+_CID = struct.Struct("!Q")
+
+FLAG_EXCEPTION = 1
+FLAG_FUNCNAME = 2
+FLAG_CID = 4
+
+
+class Codec(object):
+    """
+    encode gives (data, out of band buffers), decode takes them back
+    """
+    name = None
+    id = None
+
+    def encode(self, val):
+        raise NotImplementedError
+
+    def decode(self, data, buffers):
+        raise NotImplementedError
+
+
+class RawCodec(Codec):
+    """
+    bytes like values sent as is
+    """
+    name = "raw"
+    id = 0
+
+    def encode(self, val):
+        return val, ()
+
+    def decode(self, data, buffers):
+        return bytes(data)
+
+
+class JsonCodec(Codec):
+    name = "json"
+    id = 1
+
+    def encode(self, val):
+        return json.dumps(val).encode("utf-8"), ()
+
+    def decode(self, data, buffers):
+        return json.loads(str(data, "utf-8"))
+
+
+class PickleCodec(Codec):
+    """
+    pickle protocol 5, buffers of objects supporting out of band pickling
+    (numpy arrays, PickleBuffer...) are appended to the message without
+    going through the pickle stream and come back as views of it
+    """
+    name = "pickle"
+    id = 2
+
+    def encode(self, val):
+        buffers = []
+        data = pickle.dumps(val, protocol=5, buffer_callback=buffers.append)
+        return data, [buf.raw() for buf in buffers]
+
+    def decode(self, data, buffers):
+        return pickle.loads(data, buffers=buffers)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+    id = 3
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("the msgpack codec needs the msgpack package")
+
+    def encode(self, val):
+        return msgpack.packb(val, use_bin_type=True), ()
+
+    def decode(self, data, buffers):
+        return msgpack.unpackb(data, raw=False)
+
+
+# name and id -> codec instance
+CODECS = {}
+
+
+def register_codec(codec):
+    """
+    make a Codec instance available by name and id to every Connector
+    """
+    CODECS[codec.name] = codec
+    CODECS[codec.id] = codec
+    return codec
+
+
+def get_codec(codec):
+    """
+    registered codec from its name or id, codec itself when a Codec
+    """
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise ValueError("Unknown codec %r" % (codec,))
+
+
+for _codec in (RawCodec, JsonCodec, PickleCodec):
+    register_codec(_codec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+
+
+def _text(value):
+    if value is None:
+        return b""
+    if type(value) is bytes:
+        return value
+    return str(value).encode("utf-8")
+
+
+def pack_envelope(codec, src, srctype, dst, time, val, funcname=None,
+                  exception=False, cid=None):
+    """
+    binary message: fixed header, correlation id, header strings, value
+    then its out of band buffers
+    """
+    data, buffers = codec.encode(val)
+    src, srctype, dst = _text(src), _text(srctype), _text(dst)
+    flags = FLAG_EXCEPTION if exception else 0
+    if funcname:
+        flags |= FLAG_FUNCNAME
+    if cid is not None:
+        flags |= FLAG_CID
+    funcname = _text(funcname)
+    parts = [_HEADER.pack(MAGIC, VERSION, codec.id, flags, time, len(src),
+                          len(srctype), len(dst), len(funcname),
+                          len(buffers), memoryview(data).nbytes)]
+    if cid is not None:
+        parts.append(_CID.pack(cid))
+    parts.extend((src, srctype, dst, funcname))
+    for buf in buffers:
+        parts.append(_BUFFER.pack(memoryview(buf).nbytes))
+    parts.append(data)
+    parts.extend(buffers)
+    return b"".join(parts)
+
+
+def is_envelope(data):
+    return len(data) > 1 and data[0] == MAGIC
+
+
+def accepted_codecs(codecs):
+    """
+    codec id -> Codec of the codecs (names, ids or Codec instances) an
+    envelope may be decoded with
+    """
+    accepted = {}
+    for codec in codecs:
+        codec = get_codec(codec)
+        accepted[codec.id] = codec
+    return accepted
+
+
+def unpack_envelope(data, codecs):
+    """
+    dict of the fields of a binary message, out of band buffers are
+    memoryview slices of data. codecs maps the ids of the codecs accepted
+    to them (accepted_codecs): the codec named by the envelope is chosen
+    by its sender, an unsafe one (pickle) must never be picked unasked.
+    """
+    (magic, version, codecid, flags, time, nsrc, nsrctype, ndst, nfuncname,
+     nbuffers, ndata) = _HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError("Unsupported envelope version %d" % version)
+    codec = codecs.get(codecid)
+    if codec is None:
+        raise ValueError("Envelope codec %d not accepted" % codecid)
+    pos = _HEADER.size
+    cid = None
+    if flags & FLAG_CID:
+        cid = _CID.unpack_from(data, pos)[0]
+        pos += _CID.size
+    end = pos + nsrc + nsrctype + ndst + nfuncname
+    header = bytes(data[pos:end])
+    fields = []
+    pos = 0
+    for n in (nsrc, nsrctype, ndst, nfuncname):
+        fields.append(header[pos:pos + n].decode("utf-8"))
+        pos += n
+    pos = end
+    view = memoryview(data)
+    sizes = []
+    for i in range(nbuffers):
+        sizes.append(_BUFFER.unpack_from(data, pos)[0])
+        pos += _BUFFER.size
+    value = view[pos:pos + ndata]
+    pos += ndata
+    buffers = []
+    for n in sizes:
+        buffers.append(view[pos:pos + n])
+        pos += n
+    msg = dict(src=fields[0], srctype=fields[1], dst=fields[2], time=time,
+               val=codec.decode(value, buffers))
+    if flags & FLAG_FUNCNAME:
+        msg["funcname"] = fields[3]
+    if flags & FLAG_EXCEPTION:
+        msg["exception"] = True
+    if cid is not None:
+        msg["cid"] = cid
+    return msg
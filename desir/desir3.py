@@ -31,28 +31,227 @@
 #  POSSIBILITY OF SUCH DAMAGE.
 
 
+import select
 import socket
 import time
-import urllib
 import threading
-import json
-from pkg_resources import resource_string
+import marshal
+import os
+import zlib
+from collections import deque
 import builtins
-from .sugar import Counter, String, Connector, Hash
+from .sugar import Counter, String, Connector, StreamConnector, Hash
+from .cache import ClientCache
+from .pool import ConnectionPool
+from .memory import MemoryBackend, MemoryNode
+from .metrics import Metrics
+from .pubsub import PubSub, pubsub_message
+from .replicas import Replicas
+from .sentinel import SentinelWatcher
+from .resp import (RedisError, NodeError, Push, RespReader, NOREPLY,
+                   command_header, pack_command, pack_commands, sendbuffers)
 
 redisCommands = None
+# python method name -> command name
+commandMethods = {}
 
 DEFAULT_SENTINEL_TIMEOUT = 0.1
 
+# commands name which requires renaming
+cmdmap = {"del": "delete", "exec": "execute"}
+
+# bumped when the layout of the compiled command table changes
+COMMANDS_CACHE_VERSION = 1
+
+
+class SentinelErrorNoMaster(Exception):
+    pass
+
+class SentinelError(Exception):
+    pass
+
+
+class RedisInner(object):
+    def __init__(self, cls):
+        self.cls = cls
+
+    def __get__(self, instance, outerclass):
+        class Wrapper(self.cls):
+            _redis = instance
+        Wrapper.__name__ = self.cls.__name__
+        return Wrapper
+
+
+# key positions which can not be derived from the arguments description
+KEYSPEC_OVERRIDES = {
+    "XREAD": ("streams",),
+    "XREADGROUP": ("streams",),
+    "XGROUP": ("range", 1, 1, 1),
+    "XINFO": ("range", 1, 1, 1),
+    "OBJECT": ("range", 1, 1, 1),
+    "MIGRATE": ("range", 2, 2, 1),
+}
+
+_keyspecs = {}
+
+
+def _keyspec(redisCommand):
+    """
+    derive where keys are in the arguments of a command from the types
+    of its arguments description, returns one of
+    ("range", first, last, step) with last < 0 counted from the end,
+    ("numkeys", index of the numkeys argument, positions of the keys before
+    it) or None without keys
+    """
+    args = redisCommand.get("arguments", [])
+    keys = []
+    i = 0
+    for n, arg in enumerate(args):
+        types = arg.get("type")
+        if not isinstance(types, list):
+            types = [types]
+        prefixed = arg.get("optional") or arg.get("command")
+        if arg.get("multiple") and "key" in types and not prefixed:
+            if len(types) > 1:
+                return ("range", i + types.index("key"), -1, len(types))
+            if n and args[n - 1].get("name") == "numkeys":
+                return ("numkeys", i - 1, tuple(keys))
+            first = keys[0] if keys and keys[-1] == i - 1 else i
+            last = -1
+            for following in args[n + 1:]:
+                if (following.get("optional") or following.get("command")
+                        or following.get("multiple")):
+                    break
+                last -= 1
+            return ("range", first, last, 1)
+        if prefixed or arg.get("multiple") or arg.get("variadic"):
+            break
+        if "key" in types:
+            if keys and keys[-1] != i - 1:
+                break
+            keys.append(i + types.index("key"))
+        i += len(types)
+    if keys:
+        return ("range", keys[0], keys[-1], 1)
+    return None
+
+
+def keyspec(cmdname):
+    """
+    key positions of a command, see _keyspec
+    """
+    try:
+        return _keyspecs[cmdname]
+    except KeyError:
+        pass
+    name = cmdname.upper()
+    if name in KEYSPEC_OVERRIDES:
+        spec = KEYSPEC_OVERRIDES[name]
+    elif name in redisCommands:
+        spec = _keyspec(redisCommands[name])
+    else:
+        spec = None
+    _keyspecs[cmdname] = spec
+    return spec
+
+
+def command_keys(cmdname, args):
+    """
+    keys among the arguments of a command
+    """
+    spec = keyspec(cmdname)
+    if spec is None:
+        return []
+    if spec[0] == "numkeys":
+        kind, idx, fixed = spec
+        return ([args[i] for i in fixed] +
+                list(args[idx + 1:idx + 1 + int(args[idx])]))
+    if spec[0] == "streams":
+        for i, arg in enumerate(args):
+            if isinstance(arg, bytes):
+                arg = arg.decode("utf-8", "replace")
+            if str(arg).upper() == "STREAMS":
+                rest = args[i + 1:]
+                return list(rest[:len(rest) // 2])
+        return []
+    kind, first, last, step = spec
+    if last < 0:
+        last += len(args)
+    return list(args[first:last + 1:step])
+
+
+def _methodname(cmdname):
+    name = cmdname.lower()
+    return cmdmap.get(name, name.replace(" ", "_"))
+
+
+def _compile_commands(data):
+    """
+    compiled command table of a commands.json content: the commands, the
+    method name mapping and the key positions of every command
+    """
+    import json
+    commands = json.loads(data.decode("utf-8"))
+    methods = dict((_methodname(k), k) for k in commands)
+    keyspecs = {}
+    for k, redisCommand in commands.items():
+        keyspecs[k] = KEYSPEC_OVERRIDES.get(k) or _keyspec(redisCommand)
+    return commands, methods, keyspecs
+
+
+def _cachepath(data):
+    digest = "%08x%x" % (zlib.crc32(data), len(data))
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "__pycache__", "commands-%d-%s.marshal" % (
+                            COMMANDS_CACHE_VERSION, digest))
+
+
+def loadCommands(data):
+    """
+    install the command table of a commands.json content, the compiled
+    table is marshalled in __pycache__ under the hash of the content
+    """
+    global redisCommands, commandMethods
+    path = _cachepath(data)
+    try:
+        with open(path, "rb") as f:
+            table = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        table = _compile_commands(data)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "%s.%d" % (path, os.getpid())
+            with open(tmp, "wb") as f:
+                marshal.dump(table, f)
+            os.replace(tmp, path)
+        except OSError:
+            # read only install, compile at each import
+            pass
+    redisCommands, commandMethods, keyspecs = table
+    _keyspecs.clear()
+    _keyspecs.update(keyspecs)
+
+
 def reloadCommands(url):
-    global redisCommands
+    import urllib.request
     try:
         u = urllib.request.urlopen(url)
-        redisCommands = json.load(u)
+        loadCommands(u.read())
     except urllib.request.HTTPError:
         raise Exception("Error unable to load commmands json file")
 
 
+def _package_data(name):
+    # the package loader reads files next to the module (or in the zip
+    # archive), importlib.resources costs more than the whole import
+    try:
+        return __spec__.loader.get_data(
+            os.path.join(os.path.dirname(__spec__.origin), name))
+    except (AttributeError, OSError):
+        from importlib import resources
+        return resources.files(__package__).joinpath(name).read_bytes()
+
+
 if "urlCommands" in dir(builtins):
     reloadCommands(builtins.urlCommands)
 
@@ -63,96 +262,178 @@ if "urlCommands" in dir(builtins):
 
 if not redisCommands:
     try:
-        redisCommands = json.loads(
-            resource_string(__name__, "commands.json").decode("utf-8"))
+        loadCommands(_package_data("commands.json"))
     except IOError:
         raise Exception("Error unable to load commmands json file")
 
 
-class RedisError(Exception):
-    pass
+# groups of commands.json whose read only commands replicas can serve
+READ_GROUPS = frozenset(["generic", "string", "bitmap", "hash", "list",
+                         "set", "sorted_set", "hyperloglog", "geo",
+                         "stream"])
 
+# read only commands of these groups, used when commands.json does not
+# carry the command flags
+READ_COMMANDS = frozenset([
+    "GET", "MGET", "STRLEN", "GETRANGE", "SUBSTR", "GETBIT", "BITCOUNT",
+    "BITPOS", "STRALGO", "LCS",
+    "EXISTS", "TYPE", "TTL", "PTTL", "EXPIRETIME", "PEXPIRETIME", "DUMP",
+    "KEYS", "SCAN", "RANDOMKEY", "SORT_RO", "TOUCH",
+    "HGET", "HMGET", "HGETALL", "HKEYS", "HVALS", "HLEN", "HEXISTS",
+    "HSTRLEN", "HSCAN", "HRANDFIELD",
+    "LRANGE", "LLEN", "LINDEX", "LPOS",
+    "SMEMBERS", "SISMEMBER", "SMISMEMBER", "SCARD", "SRANDMEMBER", "SSCAN",
+    "SINTER", "SINTERCARD", "SUNION", "SDIFF",
+    "ZRANGE", "ZREVRANGE", "ZRANGEBYSCORE", "ZREVRANGEBYSCORE",
+    "ZRANGEBYLEX", "ZREVRANGEBYLEX", "ZSCORE", "ZMSCORE", "ZRANK",
+    "ZREVRANK", "ZCARD", "ZCOUNT", "ZLEXCOUNT", "ZSCAN", "ZRANDMEMBER",
+    "ZUNION", "ZINTER", "ZINTERCARD", "ZDIFF",
+    "PFCOUNT",
+    "GEOPOS", "GEODIST", "GEOHASH", "GEOSEARCH", "GEORADIUS_RO",
+    "GEORADIUSBYMEMBER_RO",
+    "XRANGE", "XREVRANGE", "XLEN", "XREAD",
+])
 
-class NodeError(Exception):
-    pass
 
-class SentinelErrorNoMaster(Exception):
-    pass
+def readonly_commands(commands):
+    """
+    read only data commands of a command table, from their READONLY flag
+    when described (commands.json of redis >= 7) or from READ_COMMANDS
+    """
+    readonly = set()
+    for k, redisCommand in commands.items():
+        flags = redisCommand.get("command_flags")
+        if flags is None:
+            continue
+        if ("READONLY" in (f.upper() for f in flags) and
+                redisCommand.get("group") in READ_GROUPS):
+            readonly.add(k)
+    return frozenset(readonly) or READ_COMMANDS
 
-class SentinelError(Exception):
-    pass
 
+# commands answered with push frames in RESP3
+PUSH_COMMANDS = frozenset(["SUBSCRIBE", "PSUBSCRIBE", "UNSUBSCRIBE",
+                           "PUNSUBSCRIBE"])
 
-class RedisInner(object):
-    def __init__(self, cls):
-        self.cls = cls
+# commands keeping the connection bound to the calling thread
+PINNED_COMMANDS = frozenset(["MULTI", "WATCH", "SUBSCRIBE", "PSUBSCRIBE"])
 
-    def __get__(self, instance, outerclass):
-        class Wrapper(self.cls):
-            _redis = instance
-        Wrapper.__name__ = self.cls.__name__
-        return Wrapper
+
+def scan_options(match=None, count=None, type=None):
+    """
+    MATCH/COUNT/TYPE arguments of the SCAN family
+    """
+    options = ()
+    if match is not None:
+        options += ("MATCH", match)
+    if count is not None:
+        options += ("COUNT", count)
+    if type is not None:
+        options += ("TYPE", type)
+    return options
 
 
-# commands name which requires renaming
-cmdmap = {"del": "delete", "exec": "execute"}
+def _pairs(items):
+    # flat field, value sequence of HSCAN/ZSCAN as pairs
+    items = iter(items)
+    return zip(items, items)
+
+
+def _wrapper(name, redisCommand, methoddct):
+    runcmd = "runcmd"
+    if name == "SELECT" and "_select" in methoddct:
+        runcmd = "_select"
+
+    def _rediscmd(self, *args):
+        return methoddct[runcmd](self, name, *args)
+
+    _rediscmd.__name__ = _methodname(name)
+    _rediscmd.__redisname__ = name
+    # warm the header table pack_commands looks command names up in
+    command_header(name)
+    _rediscmd._json = redisCommand
+    if "summary" in redisCommand:
+        _doc = redisCommand["summary"]
+        if "arguments" in redisCommand:
+            _doc += "\nParameters:\n"
+            for d in redisCommand["arguments"]:
+                if "name" in d:
+                    _doc += ("Name: %s,\tType: %s,\t"
+                             "Multiple parameter:%s\n") % (
+                                 d["name"], d.get("type", "?"),
+                                 d.get("multiple", "False"))
+        _rediscmd.__doc__ = _doc
+    _rediscmd.__dict__.update(methoddct[runcmd].__dict__)
+    return _rediscmd
+
+
+def _getcommand(self, attr):
+    # instance attribute miss, the class creates the command method
+    try:
+        method = getattr(type(self), attr)
+    except AttributeError:
+        raise AttributeError("%r object has no attribute %r" % (
+            type(self).__name__, attr))
+    return method.__get__(self, type(self))
+
+
+def _dircommands(self):
+    return sorted(set(object.__dir__(self)) | set(commandMethods))
+
 
 class MetaRedis(type):
+    """
+    Classes defining their own runcmd get a method per command of
+    commands.json, created on first access and then stored on the class.
+    """
+
     def __new__(metacls, name, bases, dct):
-        def _wrapper(name, redisCommand, methoddct):
-            runcmd = "runcmd"
-            if name == "SELECT":
-                runcmd = "_select"
-
-            def _rediscmd(self, *args):
-                return methoddct[runcmd](self, name, *args)
-
-            _rediscmd.__name__ = cmdmap.get(
-                name.lower(), str(name.lower().replace(" ", "_")))
-            _rediscmd.__redisname__ = name
-            _rediscmd._json = redisCommand
-            if "summary" in redisCommand:
-                _doc = redisCommand["summary"]
-                if "arguments" in redisCommand:
-                    _doc += "\nParameters:\n"
-                    for d in redisCommand["arguments"]:
-                        if "name" in d:
-                            _doc += ("Name: %s,\tType: %s,\t"
-                                     "Multiple parameter:%s\n") % (
-                                         d["name"], d.get("type", "?"),
-                                         d.get("multiple", "False"))
-                _rediscmd.__doc__ = _doc
-            _rediscmd.__dict__.update(methoddct[runcmd].__dict__)
-            return _rediscmd
-
-        if name != "Redis":
-            return type.__new__(metacls, name, bases, dct)
-
-        newDct = {}
-        for k in redisCommands.keys():
-            newDct[cmdmap.get(k.lower(), str(k.lower().replace(" ", "_")))] = \
-                _wrapper(k, redisCommands[k], dct)
-        newDct.update(dct)
-        return type.__new__(metacls, name, bases, newDct)
-
-
-class Redis(threading.local, metaclass=MetaRedis):
+        if "runcmd" in dct:
+            dct.setdefault("__getattr__", _getcommand)
+            dct.setdefault("__dir__", _dircommands)
+        return type.__new__(metacls, name, bases, dct)
+
+    def __getattr__(cls, attr):
+        cmdname = commandMethods.get(attr)
+        if cmdname is None:
+            raise AttributeError("type object %r has no attribute %r" % (
+                cls.__name__, attr))
+        for klass in cls.__mro__:
+            if "runcmd" in klass.__dict__ and isinstance(klass, MetaRedis):
+                break
+        method = _wrapper(cmdname, redisCommands[cmdname], klass.__dict__)
+        type.__setattr__(klass, attr, method)
+        return method
+
+    def __dir__(cls):
+        return sorted(set(type.__dir__(cls)) | set(commandMethods))
+
+
+class Redis(object, metaclass=MetaRedis):
     """
     class providing a client interface to Redis
     this class is a minimalist implementation of
     http://code.google.com/p/redis/wiki/CommandReference
     except for the DEL and EXEC command which are renamed delete and execute
     because they are reserved names in python
+
+    A Redis instance can be shared across threads, connections are checked
+    out of a ConnectionPool for each command, pipeline or transaction.
+    A thread keeps its connection from MULTI/WATCH until EXEC/DISCARD/UNWATCH
+    and while it is subscribed to a channel.
     """
 
     String = RedisInner(String)
     Counter = RedisInner(Counter)
     Connector = RedisInner(Connector)
+    StreamConnector = RedisInner(StreamConnector)
     Hash = RedisInner(Hash)
 
     def __init__(self, host="localhost", port=6379, db=0,
                  password=None, timeout=None, safe=False, sentinels=None, service_name=None,
-                 debug=False):
+                 debug=False, pool=None, max_connections=None, pool_timeout=None,
+                 client_cache=None, protocol=2, watch_sentinels=True,
+                 read_from_replicas=False, metrics=None, backend=None):
         self.host = host
         self.port = port
         self.timeout = timeout
@@ -161,6 +442,24 @@ class Redis(threading.local, metaclass=MetaRedis):
         self.safe = safe
         self.safewait = 0.1
         self.debug = debug
+        self.protocol = protocol
+        # desir.metrics.Metrics of the commands run, True creates one
+        if metrics is True:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.service_name = None
+        # "memory" (shared by the process) or a MemoryBackend runs the
+        # commands in process instead of on a server
+        self.backend = None
+        if backend is not None:
+            if backend == "memory":
+                backend = MemoryBackend.default()
+            elif not isinstance(backend, MemoryBackend):
+                raise ValueError("Unknown backend %r" % (backend,))
+            if sentinels or read_from_replicas or client_cache is not None:
+                raise ValueError("sentinels, replicas and client side "
+                                 "caching need a server")
+            self.backend = backend
         if sentinels:
             self.sentinels = [Node(host, port, 0, None, timeout or DEFAULT_SENTINEL_TIMEOUT)
                               for host,port in sentinels]
@@ -190,96 +489,462 @@ class Redis(threading.local, metaclass=MetaRedis):
                     )
                 if self.debug:
                     print('discovered sentinel %s %d' % (host, port))
-            self.node = None
+            self.master = None
         else:
-            self.node = Node(self.host, self.port, self.db, self.password, self.timeout)
-        self.transaction = False
-        self.subscribed = False
+            self.sentinels = None
+            self.master = (self.host, self.port)
+        self._sentinel_lock = threading.Lock()
+        # follows failovers announced by the sentinels
+        self.sentinel_watcher = None
+        self._local = threading.local()
+        if pool is None:
+            pool = ConnectionPool(self._newnode, max_connections, pool_timeout)
+        self.pool = pool
+        # client_cache is a ClientCache or the max number of cached replies
+        self.cache = None
+        if client_cache is not None:
+            if not isinstance(client_cache, ClientCache):
+                client_cache = ClientCache(client_cache)
+            client_cache.start(self._newnode, self.pool.reset)
+            self.cache = client_cache
+            self.pool.reset()
+        # read only commands sent to replicas: True/"round-robin" or
+        # "latency", or a Replicas
+        self.replicas = None
+        if read_from_replicas:
+            if isinstance(read_from_replicas, Replicas):
+                self.replicas = read_from_replicas
+            else:
+                self.replicas = Replicas(self, read_from_replicas)
+        if self.sentinels and watch_sentinels:
+            self.sentinel_watcher = SentinelWatcher(self)
 
-    def __node__(self):
-        if self.node is None:
-            if self.sentinels:
-                empty_master_result = False
-                for node in self.sentinels:
-                    try:
-                        res = node.runcmd('sentinel','get-master-addr-by-name', self.service_name)
-                        if (type(res) is list) and len(res) == 2:
-                            bhost, bport = res
-                            self.host = bhost.decode('utf8')
-                            self.port = int(bport)
-                            self.node = Node(
-                                self.host, self.port, self.db, self.password, self.timeout)
-                            break
-                        else:
-                            empty_master_result = True
-                    except NodeError:
-                        continue
-                if self.node is None:
-                    if empty_master_result:
-                        raise SentinelErrorNoMaster('unable to get master from a sentinel')
+    # transaction/subscription state and pinned connection are per thread
+    @property
+    def transaction(self):
+        return getattr(self._local, "transaction", False)
+
+    @transaction.setter
+    def transaction(self, value):
+        self._local.transaction = value
+
+    @property
+    def subscribed(self):
+        return getattr(self._local, "subscribed", False)
+
+    @subscribed.setter
+    def subscribed(self, value):
+        self._local.subscribed = value
+
+    def _master(self):
+        """
+        address of the master, asked to the sentinels when unknown
+        """
+        with self._sentinel_lock:
+            if self.master is not None:
+                return self.master
+            empty_master_result = False
+            for node in self.sentinels:
+                try:
+                    res = node.runcmd('sentinel','get-master-addr-by-name', self.service_name)
+                    if (type(res) is list) and len(res) == 2:
+                        bhost, bport = res
+                        self.host = bhost.decode('utf8')
+                        self.port = int(bport)
+                        self.master = (self.host, self.port)
+                        return self.master
                     else:
-                        raise SentinelError('unable to connect to any sentinel')
+                        empty_master_result = True
+                except NodeError:
+                    continue
+            if empty_master_result:
+                raise SentinelErrorNoMaster('unable to get master from a sentinel')
             else:
-                self.node = Node(
-                    self.host, self.port, self.db, self.password, self.timeout)
-        return self.node
+                raise SentinelError('unable to connect to any sentinel')
+
+    def _newnode(self):
+        if self.backend is not None:
+            node = MemoryNode(self.backend, self.db, self.timeout)
+            node.metrics = self.metrics
+            return node
+        host, port = self._master()
+        node = Node(host, port, self.db, self.password, self.timeout,
+                    protocol=self.protocol)
+        node.metrics = self.metrics
+        if self.cache is not None and self.cache.tracking() is not None:
+            node.onconnect = self.cache.onconnect
+            node.ondisconnect = self.cache.ondisconnect
+        return node
+
+    def _nodeerror(self, node):
+        """
+        drop a failed connection, with sentinels the master is looked up
+        again and every pooled connection to the former one is closed
+        """
+        self.pool.discard(node)
+        if self.sentinels:
+            self.master = None
+            self.pool.reset()
+
+    def __node__(self):
+        """
+        connection bound to the current thread, checked out if needed
+        """
+        node = getattr(self._local, "node", None)
+        if node is None:
+            node = self._local.node = self.pool.checkout()
+        return node
+
+    def pubsub(self, workers=4):
+        """
+        PubSub multiplexing subscriptions over a single connection, its
+        callbacks run on workers threads
+        """
+        return PubSub(self, workers)
+
+    def _unpin(self, node=None):
+        node = node or getattr(self._local, "node", None)
+        self._local.node = None
+        if node is not None:
+            node.pushes.clear()
+            self.pool.release(node)
 
     def listen(self, todict=False):
+        """
+        Message of each pub/sub reply received, dicts with todict
+        """
+        while self.subscribed:
+            r = pubsub_message(self.__node__().parse_push())
+            self._unsubscribed(r)
+            yield r.todict() if todict else r
+
+    def listen_batch(self, max_messages=1000, max_wait=None):
+        """
+        lists of up to max_messages Messages: every message already
+        received is taken at once, waiting up to max_wait seconds for the
+        first one (forever when None, an empty list is given on timeout)
+        """
         while self.subscribed:
-            r = self.__node__().parse_resp()
-            if r[0] == 'unsubscribe' and r[2] == 0:
+            batch = [pubsub_message(r) for r in
+                     self.__node__().parse_pushes(max_messages, max_wait)]
+            for r in batch:
+                self._unsubscribed(r)
+            yield batch
+
+    def _unsubscribed(self, r):
+        if r.type == b'unsubscribe' and r.data == 0:
+            self.subscribed = False
+            if not self.transaction:
+                self._unpin()
+
+    def runcmd_into(self, out, cmdname, *args):
+        """
+        run a command replying a bulk string and receive it into the
+        writable buffer out (bytearray, memoryview, numpy array...),
+        returns the number of bytes written or None for a nil reply
+        """
+        return self._runraw(cmdname, args, out=out)
+
+    def runcmd_views(self, cmdname, *args):
+        """
+        run a command, bulk strings of its reply are memoryview slices
+        of a single buffer instead of bytes objects
+        """
+        return self._runraw(cmdname, args, views=True)
+
+    def get_into(self, key, out):
+        """
+        read the value of key straight into the writable buffer out
+        """
+        return self._runraw("GET", (key,), out=out)
+
+    def _runraw(self, cmdname, args, **options):
+        node = getattr(self._local, "node", None)
+        pinned = node is not None
+        if not pinned:
+            node = self.pool.checkout()
+        try:
+            rsp = node.replies(node.request([(cmdname, args)], cmdname),
+                               **options)
+        except NodeError:
+            if pinned:
+                self._local.node = None
+                self.transaction = False
                 self.subscribed = False
-            if todict:
-                if r[0] == "pmessage":
-                    r = dict(type=r[0], pattern=r[1], channel=r[2], data=r[3])
-                else:
-                    r = dict(type=r[0], pattern=None, channel=r[1], data=r[2])
-            yield r
+            self._nodeerror(node)
+            raise
+        except (RedisError, ValueError):
+            if not pinned:
+                self.pool.release(node)
+            raise
+        except BaseException:
+            # the reply may be left half read
+            if pinned:
+                self._local.node = None
+                self.transaction = False
+                self.subscribed = False
+            self.pool.discard(node)
+            raise
+        if not pinned:
+            self.pool.release(node)
+        return rsp
 
-    def runcmd(self, cmdname, *args):
-        # cluster not implemented
-        if cmdname in ["MULTI", "WATCH"]:
-            self.transaction = True
-        if self.safe and not self.transaction and not self.subscribed:
+    def _runpooled(self, cmdname, *args):
+        """
+        run a command on a connection checked out for its duration
+        """
+        node = self.pool.checkout()
+        if self.safe:
             try:
-                return self.__node__().runcmd(cmdname, *args)
+                rsp = node.runcmd(cmdname, *args)
             except NodeError:
-                if self.sentinels:
-                    self.node = None
-                else:
+                self._nodeerror(node)
+                if not self.sentinels:
                     time.sleep(self.safewait)
+                node = self.pool.checkout()
+            except RedisError:
+                self.pool.release(node)
+                raise
+            else:
+                self.pool.release(node)
+                return rsp
+        try:
+            rsp = node.runcmd(cmdname, *args)
+        except NodeError:
+            self._nodeerror(node)
+            raise
+        except RedisError:
+            self.pool.release(node)
+            raise
+        self.pool.release(node)
+        return rsp
+
+    def _runmemory(self, cmdname, *args):
+        """
+        run a command on the MemoryNode of the calling thread, no pool
+        checkout is needed in process
+        """
+        node = getattr(self._local, "memory", None)
+        if node is None or node.db != self.db:
+            node = self._local.memory = self._newnode()
+        return node.runcmd(cmdname, *args)
+
+    def runcmd(self, cmdname, *args):
+        # cluster is handled by desir.cluster.RedisCluster
+        node = getattr(self._local, "node", None)
+        if node is None and cmdname not in PINNED_COMMANDS:
+            if self.backend is not None:
+                return self._runmemory(cmdname, *args)
+            cache = self.cache
+            if cache is not None:
+                if cmdname in cache.commands:
+                    return cache.fetch(self._runpooled, cmdname, args)
+                # the client reads its own writes without waiting for
+                # the invalidation message
+                cache.written(cmdname, args)
+            try:
+                if (self.replicas is not None and
+                        cmdname in self.replicas.commands):
+                    return self.replicas.runcmd(cmdname, *args)
+                return self._runpooled(cmdname, *args)
+            finally:
+                if cache is not None:
+                    cache.written(cmdname, args)
 
+        node = self.__node__()
+        if cmdname in ["MULTI", "WATCH"]:
+            self.transaction = True
         if cmdname in ["DISCARD", "EXEC", "UNWATCH"]:
             self.transaction = False
+        if self.cache is not None:
+            self._written(cmdname, args)
         try:
-            if cmdname in ["SUBSCRIBE", "PSUBSCRIBE",
-                           "UNSUBSCRIBE", "PUNSUBSCRIBE"]:
-                self.__node__().sendcmd(cmdname, *args)
-                rsp = self.__node__().parse_resp()
-            else:
-                rsp = self.__node__().runcmd(cmdname, *args)
+            rsp = node.runcmd(cmdname, *args)
             if cmdname in ["SUBSCRIBE", "PSUBSCRIBE"]:
                 self.subscribed = True
-            return rsp
+            elif (cmdname in ["UNSUBSCRIBE", "PUNSUBSCRIBE"] and
+                  isinstance(rsp, list) and rsp[2] == 0):
+                self.subscribed = False
         except NodeError as e:
-            if self.sentinels:
-                self.node = None
+            self._local.node = None
+            self._nodeerror(node)
             self.transaction = False
             self.subscribed = False
             raise
+        except RedisError:
+            if not self.transaction and not self.subscribed:
+                self._unpin(node)
+            raise
+        if not self.transaction and not self.subscribed:
+            self._unpin(node)
+        return rsp
 
-    def pipeline(self):
-        self.multi()
-        return self
+    def _written(self, cmdname, args):
+        """
+        drop the cached replies of the keys of a command run on the pinned
+        connection, commands queued by MULTI are dropped again on EXEC
+        """
+        cache = self.cache
+        cache.written(cmdname, args)
+        queued = getattr(self._local, "queued", None)
+        if self.transaction and cmdname not in cache.commands:
+            if queued is None:
+                queued = self._local.queued = []
+            queued.append((cmdname, args))
+        elif not self.transaction and queued:
+            self._local.queued = None
+            for cmdname, args in queued:
+                cache.written(cmdname, args)
+
+    def pipeline(self, transaction=False):
+        return Pipeline(self, transaction)
+
+    def runbatch(self, commands, transaction=False):
+        """
+        send a list of (cmdname, args) in one write and read back their
+        replies in order, errors are returned in place.
+        when transaction is True the batch is wrapped in MULTI/EXEC and
+        the EXEC reply is returned (None if a WATCHed key changed)
+        """
+        if transaction:
+            commands = [("MULTI", ())] + list(commands) + [("EXEC", ())]
+        pinned = getattr(self._local, "node", None)
+        node = pinned or self.pool.checkout()
+        cache = self.cache
+        if cache is not None:
+            for cmdname, args in commands:
+                cache.written(cmdname, args)
+        try:
+            replies = node.runcommands(
+                commands, "MULTI" if transaction else "PIPELINE")
+        except NodeError:
+            self._local.node = None
+            self._nodeerror(node)
+            self.transaction = False
+            raise
+        finally:
+            if cache is not None:
+                for cmdname, args in commands:
+                    cache.written(cmdname, args)
+        if transaction:
+            self.transaction = False
+        if pinned is None or not (self.transaction or self.subscribed):
+            self._unpin(node)
+        if transaction:
+            replies = replies[-1]
+            if isinstance(replies, RedisError):
+                raise replies
+        return replies
+
+    def scan_iter(self, match=None, count=None, type=None):
+        """
+        iterate over the keys with SCAN, optionally only those matching
+        the glob style pattern match or of the given type
+        """
+        return self._scan("SCAN", (), scan_options(match, count, type))
+
+    def hscan_iter(self, key, match=None, count=None):
+        """
+        iterate over the (field, value) pairs of a hash with HSCAN
+        """
+        return _pairs(self._scan("HSCAN", (key,), scan_options(match, count)))
+
+    def sscan_iter(self, key, match=None, count=None):
+        """
+        iterate over the members of a set with SSCAN
+        """
+        return self._scan("SSCAN", (key,), scan_options(match, count))
+
+    def zscan_iter(self, key, match=None, count=None):
+        """
+        iterate over the (member, score) pairs of a sorted set with ZSCAN
+        """
+        return _pairs(self._scan("ZSCAN", (key,), scan_options(match, count)))
+
+    def _scan(self, cmdname, args, options):
+        """
+        walk a SCAN family cursor on a dedicated connection, the next page
+        is requested before the current one is handed out
+        """
+        node = self.pool.checkout()
+        pending = False
+        try:
+            request = node.request([(cmdname, args + (0,) + options)],
+                                   cmdname)
+            pending = True
+            while pending:
+                cursor, items = node.replies(request)
+                pending = False
+                if cursor != b"0":
+                    request = node.request(
+                        [(cmdname, args + (cursor,) + options)], cmdname)
+                    pending = True
+                for item in items:
+                    yield item
+        except NodeError:
+            self._nodeerror(node)
+            node = None
+            raise
+        except RedisError:
+            # the error reply was read
+            pending = False
+            raise
+        finally:
+            if node is None:
+                pass
+            elif pending:
+                # left before the end, the requested page is not read
+                self.pool.discard(node)
+            else:
+                self.pool.release(node)
 
     def _select(self, cmdname, *args):
         resp = self.runcmd(cmdname, *args)
-        if resp == "OK":
+        if resp == b"OK":
+            # pooled connections are reopened on the new database
             self.db = int(args[0])
+            self.pool.reset()
         return resp
 
     def runcmdon(self, node, cmdname, *args):
-        return self.node.runcmd(cmdname, *args)
+        return node.runcmd(cmdname, *args)
+
+
+class Pipeline(object, metaclass=MetaRedis):
+    """
+    Queue commands locally and send them to redis in one batch on execute.
+    Every generated command is available and returns the pipeline so calls
+    can be chained, execute returns the replies in order with a failing
+    command giving its RedisError in place.
+    With transaction=True the batch is wrapped in MULTI/EXEC.
+    """
+
+    def __init__(self, redis, transaction=False):
+        self._redis = redis
+        self.transaction = transaction
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def runcmd(self, cmdname, *args):
+        self.commands.append((cmdname, args))
+        return self
+
+    def reset(self):
+        self.commands = []
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        if not commands and not self.transaction:
+            return []
+        return self._redis.runbatch(commands, self.transaction)
 
 
 class Node(object):
@@ -287,19 +952,44 @@ class Node(object):
     Manage TCP connections to a redis node
     """
 
+    # reader used to parse replies, SocketReader gives the former
+    # readline based parser
+    readerclass = RespReader
+    # optional callables receiving the node once connected/disconnected
+    onconnect = None
+    ondisconnect = None
+    # optional callable receiving RESP3 push frames, they are queued in
+    # pushes otherwise
+    onpush = None
+    # desir.metrics.Metrics recording the commands run
+    metrics = None
+
     def __init__(self, host="localhost", port=6379, db=0,
-                 password=None, timeout=None):
+                 password=None, timeout=None, readerclass=None, protocol=2):
         self.host = host
         self.port = port
         self.timeout = timeout
         self.password = password
         self._sock = None
-        self._fp = None
+        self._reader = None
         self.db = db
+        if readerclass is not None:
+            self.readerclass = readerclass
+        # 3 negotiates RESP3 with HELLO on connect
+        self.protocol = protocol
+        self.pushes = deque()
 
     def __connected__(self):
         return bool(self._sock)
-    
+
+    def _error(self, msg):
+        if len(msg.args) == 1:
+            return NodeError("Error connecting %s:%s. %s." % (
+                self.host, self.port, msg.args[0]))
+        else:
+            return NodeError("Error %s connecting %s:%s. %s." % (
+                msg.args[0], self.host, self.port, msg.args[1]))
+
     def connect(self):
         if self._sock:
             return
@@ -313,24 +1003,28 @@ class Node(object):
             sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
             sock.settimeout(self.timeout)
             self._sock = sock
-            self._fp = sock.makefile('rb')
+            self._reader = self.readerclass(sock)
 
         except socket.error as msg:
-            if len(msg.args) == 1:
-                raise NodeError("Error connecting %s:%s. %s." % (
-                    self.host, self.port, msg.args[0]))
-            else:
-                raise NodeError("Error %s connecting %s:%s. %s." % (
-                    msg.args[0], self.host, self.port, msg.args[1]))
+            raise self._error(msg)
         finally:
             if self._sock is None:
                 raise NodeError("Unable to connect")
-            if self.password:
+            if self.protocol == 3:
+                if self.password:
+                    self.runcmd("HELLO", 3, "AUTH", "default", self.password)
+                else:
+                    self.runcmd("HELLO", 3)
+            elif self.password:
                 if not self.runcmd("auth", self.password):
                     raise RedisError("Authentication error: Invalid password")
             if self._sock:
+                if self.metrics is not None:
+                    self.metrics.connected(self)
                 if self.db:
                     self.runcmd("select", str(self.db))
+                if self.onconnect is not None:
+                    self.onconnect(self)
 
     def disconnect(self):
         if self._sock:
@@ -340,31 +1034,23 @@ class Node(object):
                 pass
             finally:
                 self._sock = None
-                self._fp = None
+                self._reader = None
+                if self.ondisconnect is not None:
+                    self.ondisconnect(self)
 
     def read(self, length):
         try:
-            return self._fp.read(length)
+            return self._reader.read(length)
         except socket.error as msg:
-            self.disconnet()
-            if len(msg.args) == 1:
-                raise NodeError("Error connecting %s:%s. %s." % (
-                    self.host, self.port, msg.args[0]))
-            else:
-                raise NodeError("Error %s connecting %s:%s. %s." % (
-                    msg.args[0], self.host, self.port, msg.args[1]))
+            self.disconnect()
+            raise self._error(msg)
 
     def readline(self):
         try:
-            return self._fp.readline()
+            return self._reader.readline()
         except socket.error as msg:
             self.disconnect()
-            if len(msg.args) == 1:
-                raise NodeError("Error connecting %s:%s. %s." % (
-                    self.host, self.port, msg.args[0]))
-            else:
-                raise NodeError("Error %s connecting %s:%s. %s." % (
-                    msg.args[0], self.host, self.port, msg.args[1]))
+            raise self._error(msg)
 
     def sendline(self, message):
         self.connect()
@@ -372,70 +1058,247 @@ class Node(object):
             self._sock.send(message+b"\r\n")
         except socket.error as msg:
             self.disconnect()
-            if len(msg.args) == 1:
-                raise NodeError("Error connecting %s:%s. %s." % (
-                    self.host, self.port, msg.args[0]))
-            else:
-                raise NodeError("Error %s connecting %s:%s. %s." % (
-                    msg.args[0], self.host, self.port, msg.args[1]))
+            raise self._error(msg)
+
+    def sendbuffers(self, buffers):
+        self.connect()
+        try:
+            sendbuffers(self._sock, buffers)
+        except socket.error as msg:
+            self.disconnect()
+            raise self._error(msg)
 
     def sendcmd(self, *args):
-        args2 = args[0].split()
-        args2.extend(args[1:])
-        cmd = b""
-        cmd += b"*%d" % (len(args2))
-        for carg in args2:
-            arg = None
-            if type(carg) is bytes:
-                arg = carg
-            else:
-                arg = bytes(str(carg), "utf-8")
-            cmd += b"\r\n"
-            cmd += b"$%d\r\n" % (len(arg))
-            cmd += arg
-        self.sendline(cmd)
-
-    def parse_resp(self):
-        resp = self.readline()
-        if not resp:
-            raise NodeError('Empty response')
-            # resp empty what is happening ? to be investigated
-            return None
-        if resp[:-2] in [b"$-1", b"*-1"]:
-            return None
-        fb, resp = resp[0], resp[1:]
-        if fb == 43:  # +
-            return resp[:-2]
-        if fb == 45:  # -
-            raise RedisError(resp.decode("UTF-8").strip())
-        if fb == 58:  # :
-            return int(resp)
-        if fb == 36:  # $
-            if int(resp) != -1:
-                resp = self.read(int(resp))
-                self.read(2)
-                return resp
-            else:
-                return None
-        if fb == 42:  # *
-            return [self.parse_resp() for i in range(int(resp))]
+        self.sendbuffers(pack_command(*args))
+
+    def sendcommands(self, commands):
+        """
+        send a batch of (cmdname, args) in one go
+        """
+        self.sendbuffers(pack_commands(commands))
+
+    def parse_resp(self, raise_errors=True, out=None, views=False):
+        """
+        read the next reply, RESP3 push frames met on the way are handed
+        to onpush or queued in pushes.
+        With out a bulk string reply is received straight into that
+        writable buffer and its length is returned, with views bulk
+        strings are memoryview slices of a single receive buffer.
+        """
+        reader = self._reader
+        try:
+            while True:
+                if out is not None:
+                    reply = reader.parse_into(out, raise_errors)
+                elif views:
+                    reply = reader.parse_views(raise_errors)
+                else:
+                    reply = reader.parse(raise_errors)
+                if type(reply) is not Push:
+                    return reply
+                if self.onpush is not None:
+                    self.onpush(reply)
+                else:
+                    self.pushes.append(reply)
+        except socket.error as msg:
+            self.disconnect()
+            raise self._error(msg)
+        except NodeError:
+            self.disconnect()
+            raise
+
+    def parse_push(self):
+        """
+        next RESP3 push frame (the next reply with RESP2)
+        """
+        if self.pushes:
+            return self.pushes.popleft()
+        try:
+            return self._reader.parse()
+        except socket.error as msg:
+            self.disconnect()
+            raise self._error(msg)
+        except NodeError:
+            self.disconnect()
+            raise
+
+    def parse_pushes(self, max_count, timeout=None):
+        """
+        up to max_count push frames (replies with RESP2) already queued or
+        received, waiting up to timeout seconds when there are none
+        """
+        pushes = self.pushes
+        frames = []
+        while pushes and len(frames) < max_count:
+            frames.append(pushes.popleft())
+        reader = self._reader
+        if not hasattr(reader, "gets"):
+            # readers parsing from a file object block until a whole
+            # frame is read, only parse once some data is there
+            while len(frames) < max_count:
+                if frames or timeout is not None:
+                    if not self._wait_push(reader, 0 if frames else timeout):
+                        break
+                frames.append(self.parse_push())
+            return frames
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        try:
+            while len(frames) < max_count:
+                reply = reader.gets()
+                if reply is not NOREPLY:
+                    frames.append(reply)
+                    continue
+                if frames:
+                    break
+                if deadline is None:
+                    reader.fill()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._sock.settimeout(remaining)
+                try:
+                    reader.fill()
+                except socket.timeout:
+                    break
+                finally:
+                    if self._sock is not None:
+                        self._sock.settimeout(self.timeout)
+        except socket.error as msg:
+            self.disconnect()
+            raise self._error(msg)
+        except NodeError:
+            self.disconnect()
+            raise
+        return frames
+
+    def _wait_push(self, reader, timeout):
+        try:
+            if hasattr(reader, "wait"):
+                return reader.wait(timeout)
+            return bool(select.select([self._sock], [], [], timeout)[0])
+        except (socket.error, ValueError) as msg:
+            self.disconnect()
+            raise self._error(msg)
 
     def runcmd(self, cmdname, *args):
+        if self.metrics is not None:
+            request = self.request([(cmdname, args)], cmdname)
+            if self.protocol == 3 and cmdname in PUSH_COMMANDS:
+                return self._measured(request, self.parse_push)
+            return self._measured(request, self.parse_resp)
         self.sendcmd(cmdname, *args)
+        if self.protocol == 3 and cmdname in PUSH_COMMANDS:
+            # confirmed by a push frame instead of a reply
+            return self.parse_push()
         return self.parse_resp()
 
+    def runcommands(self, commands, name="PIPELINE"):
+        """
+        send a batch of (cmdname, args) in one go and read their replies,
+        errors are returned in place. The batch is recorded as one name
+        command by metrics.
+        """
+        if self.metrics is not None:
+            return self.replies(self.request(commands, name),
+                                len(commands), False)
+        self.sendcommands(commands)
+        return [self.parse_resp(raise_errors=False)
+                for i in range(len(commands))]
+
+    def request(self, commands, name="PIPELINE"):
+        """
+        send a batch of (cmdname, args) whose replies are read later by
+        replies, with the returned request. The batch is recorded as one
+        name command by metrics, timed until its replies are read.
+        """
+        metrics = self.metrics
+        if metrics is None:
+            self.sendcommands(commands)
+            return None
+        if metrics.before:
+            for hook in metrics.before:
+                hook(name, self)
+        buffers = pack_commands(commands)
+        if len(buffers) == 1:
+            sent = len(buffers[0])
+        else:
+            sent = sum(memoryview(buf).nbytes for buf in buffers)
+        start = time.perf_counter()
+        try:
+            self.sendbuffers(buffers)
+        except Exception as e:
+            self._record(name, start, sent, 0, e)
+            raise
+        return name, start, sent
+
+    def replies(self, request, count=None, raise_errors=True, out=None,
+                views=False):
+        """
+        read the replies of a request: a list of count replies, the reply
+        alone (parsed as parse_resp does with out and views) when count
+        is None
+        """
+        if count is None:
+            read = self.parse_resp
+            args = (raise_errors, out, views)
+        else:
+            read = self._parse_many
+            args = (count, raise_errors)
+        if request is None:
+            return read(*args)
+        return self._measured(request, read, *args)
+
+    def _parse_many(self, count, raise_errors):
+        return [self.parse_resp(raise_errors) for i in range(count)]
+
+    def _measured(self, request, read, *args):
+        # replies read with metrics
+        name, start, sent = request
+        reader = self._reader
+        before = getattr(reader, "received", 0)
+        error = None
+        try:
+            return read(*args)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._record(name, start, sent,
+                         getattr(reader, "received", 0) - before, error)
+
+    def _record(self, name, start, sent, received, error):
+        metrics = self.metrics
+        elapsed = time.perf_counter() - start
+        metrics.record(name, self, elapsed, sent, received, error)
+        if metrics.after:
+            for hook in metrics.after:
+                hook(name, self, elapsed, error)
+
+
+class SubAsync(object):
+    """
+    call callback with each message of channel. Subscriptions made with
+    the same redis parameters share the connection and threads of one
+    PubSub.
+    """
+
+    _pubsubs = {}
+    _lock = threading.Lock()
 
-class SubAsync(threading.Thread):
     def __init__(self, channel, callback, **redis_param):
-        threading.Thread.__init__(self)
-        self.setDaemon(1)
         self.channel = channel
         self.callback = callback
         self.param = redis_param
-        self.start()
+        key = repr(sorted(redis_param.items()))
+        with self._lock:
+            pubsub = self._pubsubs.get(key)
+            if pubsub is None:
+                pubsub = self._pubsubs[key] = Redis(**redis_param).pubsub()
+        self.pubsub = pubsub
+        pubsub.subscribe(channel, callback)
 
-    def run(self):
-        self._redis = Redis(**self.param)
-        self._redis.subscribe(self.channel)
-        for v in self._redis.listen():
-            self.callback(v)
+    def unsubscribe(self):
+        self.pubsub.unsubscribe(self.channel, self.callback)
@@ -0,0 +1,1711 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+In process backend of Redis(backend="memory"): the common string, hash,
+list, set, sorted set, pub/sub, expiry and transaction commands run on
+python data structures and give the replies parse_resp would (RESP2
+shapes), other commands get an error reply naming them.
+"""
+
+import bisect
+import fnmatch
+import heapq
+import inspect
+import random
+import threading
+import time
+from collections import deque
+
+from .resp import NOREPLY, NodeError, RedisError, arg_bytes as _bytes
+
+DATABASES = 16
+
+OK = b"OK"
+QUEUED = b"QUEUED"
+
+WRONGTYPE = ("WRONGTYPE Operation against a key holding the wrong kind of "
+             "value")
+NOT_INTEGER = "ERR value is not an integer or out of range"
+NOT_FLOAT = "ERR value is not a valid float"
+SYNTAX = "ERR syntax error"
+
+# run at once inside MULTI instead of being queued
+TRANSACTION_COMMANDS = frozenset(["MULTI", "EXEC", "DISCARD", "WATCH",
+                                  "UNWATCH"])
+
+# allowed to a subscribed client
+SUBSCRIBED_COMMANDS = frozenset(["SUBSCRIBE", "PSUBSCRIBE", "UNSUBSCRIBE",
+                                 "PUNSUBSCRIBE", "PING"])
+
+_INT64 = 1 << 63
+
+
+class Replies(list):
+    """
+    several replies to one command (SUBSCRIBE of several channels)
+    """
+
+
+def _int(value):
+    try:
+        n = int(value)
+    except ValueError:
+        raise RedisError(NOT_INTEGER)
+    if not -_INT64 <= n < _INT64:
+        raise RedisError(NOT_INTEGER)
+    return n
+
+
+def _cursor_key(cursor):
+    """
+    last key returned before a SCAN family cursor, None at the start
+    """
+    try:
+        n = int(cursor)
+    except ValueError:
+        n = -1
+    if n == 0:
+        return None
+    data = n.to_bytes((n.bit_length() + 7) // 8, "big") if n > 0 else b""
+    if data[:1] != b"\x01":
+        raise RedisError("ERR invalid cursor")
+    return data[1:]
+
+
+def _key_cursor(key):
+    # decimal cursor resuming after key, big for long keys
+    return b"%d" % int.from_bytes(b"\x01" + key, "big")
+
+
+def _arity_error(name):
+    return RedisError("ERR wrong number of arguments for '%s' command" % (
+        name))
+
+
+def _arity(method):
+    """
+    (min, max) arguments of a cmd_ method after the client, max is
+    infinite with *args
+    """
+    code = method.__code__
+    # self and client
+    positional = code.co_argcount - 2
+    least = positional - len(method.__defaults__ or ())
+    if code.co_flags & inspect.CO_VARARGS:
+        return least, float("inf")
+    return least, positional
+
+
+def _float(value):
+    try:
+        f = float(value)
+    except ValueError:
+        raise RedisError(NOT_FLOAT)
+    if f != f:
+        raise RedisError(NOT_FLOAT)
+    return f
+
+
+def _score(f):
+    """
+    bulk string of a score or float
+    """
+    if f - f != 0:
+        return b"inf" if f > 0 else b"-inf"
+    if f == int(f) and abs(f) < 1e17:
+        return b"%d" % f
+    return repr(f).encode("ascii")
+
+
+def _bound(value):
+    """
+    (score, exclusive) of a ZRANGEBYSCORE bound: 1.5, (1.5, -inf, +inf
+    """
+    if value[:1] == b"(":
+        return _bound_value(value[1:]), True
+    return _bound_value(value), False
+
+
+def _bound_value(value):
+    try:
+        f = float(value)
+    except ValueError:
+        raise RedisError("ERR min or max is not a float")
+    if f != f:
+        raise RedisError("ERR min or max is not a float")
+    return f
+
+
+def _slice(start, stop, n):
+    """
+    python slice bounds of the inclusive redis indexes start and stop
+    """
+    if start < 0:
+        start = max(start + n, 0)
+    if stop < 0:
+        stop += n
+    stop = min(stop, n - 1)
+    if start > stop:
+        return 0, 0
+    return start, stop + 1
+
+
+def _now():
+    # expiry times are unix times in milliseconds, as PEXPIREAT
+    return int(time.time() * 1000)
+
+
+class _Top(object):
+    # greater than any member, upper bound of (score, member) items
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+
+_TOP = _Top()
+
+
+class ZSet(object):
+    """
+    sorted set: score by member and (score, member) items kept sorted
+    """
+
+    __slots__ = ("scores", "items")
+
+    def __init__(self):
+        self.scores = {}
+        self.items = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, member, score):
+        old = self.scores.get(member)
+        if old is not None:
+            if old == score:
+                return
+            del self.items[bisect.bisect_left(self.items, (old, member))]
+        self.scores[member] = score
+        bisect.insort(self.items, (score, member))
+
+    def remove(self, member):
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        del self.items[bisect.bisect_left(self.items, (score, member))]
+        return True
+
+    def rank(self, member):
+        score = self.scores.get(member)
+        if score is None:
+            return None
+        return bisect.bisect_left(self.items, (score, member))
+
+    def between(self, low, high):
+        """
+        slice bounds of the items with scores between the _bound low and
+        high
+        """
+        (low, lowex), (high, highex) = low, high
+        if lowex:
+            start = bisect.bisect_right(self.items, (low, _TOP))
+        else:
+            start = bisect.bisect_left(self.items, (low,))
+        if highex:
+            stop = bisect.bisect_left(self.items, (high,))
+        else:
+            stop = bisect.bisect_right(self.items, (high, _TOP))
+        return start, max(start, stop)
+
+
+TYPES = {bytes: b"string", dict: b"hash", deque: b"list", set: b"set",
+         ZSet: b"zset"}
+
+
+class Database(object):
+    """
+    keys of one database, their expiry times and the clients watching them
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.watchers = {}
+        # sorted keys walked by SCAN, kept up to date once it is built
+        self.index = None
+
+    def lookup(self, key):
+        expires = self.expires
+        if expires and key in expires and expires[key] <= _now():
+            self.remove(key)
+        return self.data.get(key)
+
+    def store(self, key, value, keepttl=False):
+        if self.index is not None and key not in self.data:
+            bisect.insort(self.index, key)
+        self.data[key] = value
+        if not keepttl:
+            self.expires.pop(key, None)
+        self.touch(key)
+
+    def remove(self, key):
+        if key not in self.data:
+            return False
+        del self.data[key]
+        self.expires.pop(key, None)
+        if self.index is not None:
+            del self.index[bisect.bisect_left(self.index, key)]
+        self.touch(key)
+        return True
+
+    def touch(self, key):
+        # a modified key fails the transactions WATCHing it
+        clients = self.watchers.get(key)
+        if clients:
+            for client in clients:
+                client.dirty = True
+
+    def keys(self):
+        if self.expires:
+            now = _now()
+            for key, when in list(self.expires.items()):
+                if when <= now:
+                    self.remove(key)
+        return list(self.data)
+
+    def after(self, key, count):
+        """
+        up to count keys sorted after key (from the first when None)
+        """
+        if self.index is None:
+            self.index = sorted(self.data)
+        index = self.index
+        start = 0 if key is None else bisect.bisect_right(index, key)
+        return index[start:start + count]
+
+    def flush(self):
+        for key in self.data:
+            self.touch(key)
+        self.data.clear()
+        self.expires.clear()
+        self.index = None
+
+
+class MemoryBackend(object):
+    """
+    databases shared by the clients (MemoryNode) using them. Commands run
+    one at a time under a lock as on the single threaded server, blocking
+    pops wait for pushes from other threads.
+    """
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, databases=DATABASES):
+        self.dbs = [Database() for i in range(databases)]
+        self.lock = threading.RLock()
+        self._pushed = threading.Condition(self.lock)
+        # channel and pattern -> subscribed clients
+        self.channels = {}
+        self.patterns = {}
+        # command name as given -> _command
+        self._commands = {}
+
+    @classmethod
+    def default(cls):
+        """
+        backend shared by every Redis(backend="memory") of the process
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def execute(self, client, cmdname, args):
+        """
+        reply of a command run for client, a RedisError instance for an
+        error reply
+        """
+        try:
+            name, prefix, method, arity = self._commands[cmdname]
+        except KeyError:
+            name, prefix, method, arity = self._command(cmdname)
+        args = [arg if type(arg) is bytes else _bytes(arg) for arg in args]
+        if prefix:
+            args = prefix + args
+        error = None
+        if method is None:
+            error = self._unknown(name)
+        elif not arity[0] <= len(args) <= arity[1]:
+            error = _arity_error(name.lower())
+        with self.lock:
+            if client.multi is not None and name not in TRANSACTION_COMMANDS:
+                if error is not None:
+                    client.multi_error = True
+                    return error
+                client.multi.append((name, method, args))
+                return QUEUED
+            if ((client.channels or client.patterns) and
+                    name not in SUBSCRIBED_COMMANDS):
+                return RedisError(
+                    "ERR Can't execute '%s': only (P)SUBSCRIBE / "
+                    "(P)UNSUBSCRIBE / PING are allowed in this context"
+                    % name.lower())
+            if error is not None:
+                return error
+            return self._run(client, method, args)
+
+    def _command(self, cmdname):
+        """
+        (name, leading arguments, method, (min, max) arguments) of a
+        command name as given, container commands ("CLIENT LIST") are split
+        """
+        parts = cmdname.upper().split()
+        method = getattr(self, "cmd_" + parts[0].lower(), None)
+        command = (parts[0], [_bytes(part) for part in parts[1:]], method,
+                   _arity(method) if method is not None else None)
+        if len(self._commands) < 4096:
+            self._commands[cmdname] = command
+        return command
+
+    def _unknown(self, name):
+        return RedisError("ERR unknown command '%s', not implemented by the "
+                          "memory backend" % name.lower())
+
+    def _run(self, client, method, args):
+        try:
+            return method(client, *args)
+        except RedisError as e:
+            return e
+
+    def release(self, client):
+        """
+        forget the subscriptions, transaction and WATCHed keys of a
+        disconnected client
+        """
+        with self.lock:
+            self._unsubscribe(client, self.channels, client.channels, (),
+                              b"unsubscribe")
+            self._unsubscribe(client, self.patterns, client.patterns, (),
+                              b"punsubscribe")
+            self._unwatch(client)
+            client.multi = None
+
+    # typed access to the keys of the database selected by client
+
+    def _get(self, client, key, kind):
+        value = self.dbs[client.selected].lookup(key)
+        if value is not None and type(value) is not kind:
+            raise RedisError(WRONGTYPE)
+        return value
+
+    def _update(self, client, key, kind, create=True):
+        """
+        value of key about to be modified, created empty when missing
+        with create
+        """
+        db = self.dbs[client.selected]
+        value = db.lookup(key)
+        if value is None:
+            if not create:
+                return None
+            value = kind()
+            db.store(key, value)
+        elif type(value) is not kind:
+            raise RedisError(WRONGTYPE)
+        db.touch(key)
+        return value
+
+    def _prune(self, client, key, value):
+        # emptied containers are removed
+        if not value:
+            self.dbs[client.selected].remove(key)
+
+    def _block(self, client, timeout, attempt):
+        """
+        reply of attempt, retried on pushes until timeout seconds (0 waits
+        forever), None on timeout
+        """
+        timeout = _float(timeout)
+        if timeout < 0:
+            raise RedisError("ERR timeout is negative")
+        reply = attempt()
+        if reply is not None or client.atomic:
+            return reply
+        deadline = time.monotonic() + timeout if timeout else None
+        while reply is None:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+            self._pushed.wait(remaining)
+            reply = attempt()
+        return reply
+
+    # connection and server
+
+    def cmd_ping(self, client, message=None):
+        if client.channels or client.patterns:
+            return [b"pong", message or b""]
+        return b"PONG" if message is None else message
+
+    def cmd_echo(self, client, message):
+        return message
+
+    def cmd_select(self, client, index):
+        index = _int(index)
+        if not 0 <= index < len(self.dbs):
+            raise RedisError("ERR DB index is out of range")
+        client.selected = index
+        return OK
+
+    def cmd_dbsize(self, client):
+        return len(self.dbs[client.selected].keys())
+
+    def cmd_flushdb(self, client, *options):
+        self.dbs[client.selected].flush()
+        return OK
+
+    def cmd_flushall(self, client, *options):
+        for db in self.dbs:
+            db.flush()
+        return OK
+
+    def cmd_time(self, client):
+        now = time.time()
+        return [b"%d" % now, b"%d" % (now % 1 * 1000000)]
+
+    # keys
+
+    def cmd_del(self, client, key, *keys):
+        db = self.dbs[client.selected]
+        n = 0
+        for key in (key,) + keys:
+            if db.lookup(key) is not None:
+                n += db.remove(key)
+        return n
+
+    cmd_unlink = cmd_del
+
+    def cmd_exists(self, client, key, *keys):
+        db = self.dbs[client.selected]
+        return sum(db.lookup(k) is not None for k in (key,) + keys)
+
+    def cmd_type(self, client, key):
+        value = self.dbs[client.selected].lookup(key)
+        return b"none" if value is None else TYPES[type(value)]
+
+    def cmd_keys(self, client, pattern):
+        return [key for key in self.dbs[client.selected].keys()
+                if fnmatch.fnmatchcase(key, pattern)]
+
+    def cmd_rename(self, client, key, newkey):
+        db = self.dbs[client.selected]
+        value = db.lookup(key)
+        if value is None:
+            raise RedisError("ERR no such key")
+        when = db.expires.get(key)
+        db.remove(key)
+        db.remove(newkey)
+        db.store(newkey, value)
+        if when is not None:
+            db.expires[newkey] = when
+        return OK
+
+    def cmd_renamenx(self, client, key, newkey):
+        db = self.dbs[client.selected]
+        if db.lookup(key) is None:
+            raise RedisError("ERR no such key")
+        if db.lookup(newkey) is not None:
+            return 0
+        self.cmd_rename(client, key, newkey)
+        return 1
+
+    def _expire(self, client, key, when):
+        db = self.dbs[client.selected]
+        if db.lookup(key) is None:
+            return 0
+        if when <= _now():
+            db.remove(key)
+        else:
+            db.expires[key] = when
+            db.touch(key)
+        return 1
+
+    def cmd_expire(self, client, key, seconds):
+        return self._expire(client, key, _now() + _int(seconds) * 1000)
+
+    def cmd_pexpire(self, client, key, milliseconds):
+        return self._expire(client, key, _now() + _int(milliseconds))
+
+    def cmd_expireat(self, client, key, timestamp):
+        return self._expire(client, key, _int(timestamp) * 1000)
+
+    def cmd_pexpireat(self, client, key, timestamp):
+        return self._expire(client, key, _int(timestamp))
+
+    def cmd_pttl(self, client, key):
+        db = self.dbs[client.selected]
+        if db.lookup(key) is None:
+            return -2
+        when = db.expires.get(key)
+        if when is None:
+            return -1
+        return max(when - _now(), 0)
+
+    def cmd_ttl(self, client, key):
+        ttl = self.cmd_pttl(client, key)
+        return ttl if ttl < 0 else (ttl + 500) // 1000
+
+    def cmd_persist(self, client, key):
+        db = self.dbs[client.selected]
+        if db.lookup(key) is None or db.expires.pop(key, None) is None:
+            return 0
+        db.touch(key)
+        return 1
+
+    def _scan(self, items, cursor, options, key=None, typeof=None):
+        """
+        SCAN family page of the items sorted after the cursor, items
+        gives up to count of them after a key (None at the start) and key
+        gives the key of an item (what MATCH applies to), typeof the type
+        of an item for TYPE. The cursor encodes the last key of the page,
+        so items added or removed meanwhile shift nothing.
+        """
+        last = _cursor_key(cursor)
+        match, count, kind = None, 10, None
+        options = list(options)
+        while options:
+            option = options.pop(0).upper()
+            if not options:
+                raise RedisError(SYNTAX)
+            value = options.pop(0)
+            if option == b"MATCH":
+                match = value
+            elif option == b"COUNT":
+                count = _int(value)
+                if count < 1:
+                    raise RedisError(SYNTAX)
+            elif option == b"TYPE" and typeof is not None:
+                kind = value.lower()
+            else:
+                raise RedisError(SYNTAX)
+        page = items(last, count)
+        cursor = b"0"
+        if len(page) == count:
+            cursor = _key_cursor(key(page[-1]) if key else page[-1])
+        if match is not None:
+            page = [item for item in page
+                    if fnmatch.fnmatchcase(key(item) if key else item,
+                                           match)]
+        if kind is not None:
+            page = [item for item in page if typeof(item) == kind]
+        return cursor, page
+
+    def cmd_scan(self, client, cursor, *options):
+        db = self.dbs[client.selected]
+        cursor, keys = self._scan(db.after, cursor, options,
+                                  typeof=lambda k: TYPES[type(db.data[k])])
+        # expired keys are removed by lookup
+        return [cursor, [k for k in keys if db.lookup(k) is not None]]
+
+    def cmd_hscan(self, client, key, cursor, *options):
+        value = self._get(client, key, dict) or {}
+
+        def items(last, count):
+            fields = value if last is None else (
+                field for field in value if field > last)
+            return [(field, value[field])
+                    for field in heapq.nsmallest(count, fields)]
+        cursor, items = self._scan(items, cursor, options,
+                                   lambda item: item[0])
+        return [cursor, [v for item in items for v in item]]
+
+    def cmd_sscan(self, client, key, cursor, *options):
+        value = self._get(client, key, set) or ()
+
+        def members(last, count):
+            if last is not None:
+                return heapq.nsmallest(count, (member for member in value
+                                               if member > last))
+            return heapq.nsmallest(count, value)
+        cursor, members = self._scan(members, cursor, options)
+        return [cursor, members]
+
+    def cmd_zscan(self, client, key, cursor, *options):
+        value = self._get(client, key, ZSet)
+        members = dict((m, s) for s, m in value.items) if value else {}
+
+        def items(last, count):
+            names = members if last is None else (
+                m for m in members if m > last)
+            return [(m, members[m]) for m in heapq.nsmallest(count, names)]
+        cursor, items = self._scan(items, cursor, options,
+                                   lambda item: item[0])
+        return [cursor, [v for m, s in items for v in (m, _score(s))]]
+
+    # strings
+
+    def cmd_get(self, client, key):
+        return self._get(client, key, bytes)
+
+    def cmd_set(self, client, key, value, *options):
+        db = self.dbs[client.selected]
+        when = None
+        keepttl = get = False
+        condition = None
+        options = list(options)
+        while options:
+            option = options.pop(0).upper()
+            if option in (b"NX", b"XX") and condition is None:
+                condition = option
+            elif option == b"KEEPTTL":
+                keepttl = True
+            elif option == b"GET":
+                get = True
+            elif option in (b"EX", b"PX", b"EXAT", b"PXAT") and options:
+                n = _int(options.pop(0))
+                if n <= 0:
+                    raise RedisError("ERR invalid expire time in 'set' "
+                                     "command")
+                if option in (b"EX", b"EXAT"):
+                    n *= 1000
+                when = n + _now() if option in (b"EX", b"PX") else n
+            else:
+                raise RedisError(SYNTAX)
+        old = db.lookup(key)
+        if get and old is not None and type(old) is not bytes:
+            raise RedisError(WRONGTYPE)
+        if ((condition == b"NX" and old is not None) or
+                (condition == b"XX" and old is None)):
+            return old if get else None
+        db.store(key, value, keepttl and when is None)
+        if when is not None:
+            db.expires[key] = when
+        return old if get else OK
+
+    def cmd_setnx(self, client, key, value):
+        return int(self.cmd_set(client, key, value, b"NX") is not None)
+
+    def cmd_setex(self, client, key, seconds, value):
+        return self.cmd_set(client, key, value, b"EX", seconds)
+
+    def cmd_psetex(self, client, key, milliseconds, value):
+        return self.cmd_set(client, key, value, b"PX", milliseconds)
+
+    def cmd_getset(self, client, key, value):
+        return self.cmd_set(client, key, value, b"GET")
+
+    def cmd_getdel(self, client, key):
+        value = self._get(client, key, bytes)
+        if value is not None:
+            self.dbs[client.selected].remove(key)
+        return value
+
+    def cmd_mget(self, client, key, *keys):
+        lookup = self.dbs[client.selected].lookup
+        return [v if type(v) is bytes else None
+                for v in map(lookup, (key,) + keys)]
+
+    def cmd_mset(self, client, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise _arity_error("mset")
+        store = self.dbs[client.selected].store
+        for i in range(0, len(pairs), 2):
+            store(pairs[i], pairs[i + 1])
+        return OK
+
+    def cmd_msetnx(self, client, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise _arity_error("msetnx")
+        lookup = self.dbs[client.selected].lookup
+        if any(lookup(key) is not None for key in pairs[::2]):
+            return 0
+        self.cmd_mset(client, *pairs)
+        return 1
+
+    def cmd_append(self, client, key, value):
+        value = (self._get(client, key, bytes) or b"") + value
+        self.dbs[client.selected].store(key, value, True)
+        return len(value)
+
+    def cmd_strlen(self, client, key):
+        return len(self._get(client, key, bytes) or b"")
+
+    def cmd_getrange(self, client, key, start, end):
+        value = self._get(client, key, bytes) or b""
+        start, stop = _slice(_int(start), _int(end), len(value))
+        return value[start:stop]
+
+    def cmd_setrange(self, client, key, offset, value):
+        offset = _int(offset)
+        if offset < 0:
+            raise RedisError("ERR offset is out of range")
+        old = self._get(client, key, bytes) or b""
+        if not value:
+            return len(old)
+        new = old[:offset].ljust(offset, b"\0") + value + \
+            old[offset + len(value):]
+        self.dbs[client.selected].store(key, new, True)
+        return len(new)
+
+    def cmd_incrby(self, client, key, increment):
+        value = self._get(client, key, bytes)
+        n = _int(increment) + (0 if value is None else _int(value))
+        if not -_INT64 <= n < _INT64:
+            raise RedisError("ERR increment or decrement would overflow")
+        self.dbs[client.selected].store(key, b"%d" % n, True)
+        return n
+
+    def cmd_incr(self, client, key):
+        return self.cmd_incrby(client, key, 1)
+
+    def cmd_decrby(self, client, key, decrement):
+        return self.cmd_incrby(client, key, -_int(decrement))
+
+    def cmd_decr(self, client, key):
+        return self.cmd_incrby(client, key, -1)
+
+    def cmd_incrbyfloat(self, client, key, increment):
+        value = self._get(client, key, bytes)
+        f = _float(increment) + (0.0 if value is None else _float(value))
+        if f - f != 0:
+            raise RedisError("ERR increment would produce NaN or Infinity")
+        value = _score(f)
+        self.dbs[client.selected].store(key, value, True)
+        return value
+
+    # hashes
+
+    def cmd_hset(self, client, key, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise _arity_error("hset")
+        h = self._update(client, key, dict)
+        n = len(h)
+        for i in range(0, len(pairs), 2):
+            h[pairs[i]] = pairs[i + 1]
+        return len(h) - n
+
+    def cmd_hmset(self, client, key, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise _arity_error("hmset")
+        self.cmd_hset(client, key, *pairs)
+        return OK
+
+    def cmd_hsetnx(self, client, key, field, value):
+        h = self._get(client, key, dict)
+        if h is not None and field in h:
+            return 0
+        self._update(client, key, dict)[field] = value
+        return 1
+
+    def cmd_hget(self, client, key, field):
+        return (self._get(client, key, dict) or {}).get(field)
+
+    def cmd_hmget(self, client, key, field, *fields):
+        h = self._get(client, key, dict) or {}
+        return [h.get(f) for f in (field,) + fields]
+
+    def cmd_hgetall(self, client, key):
+        h = self._get(client, key, dict) or {}
+        return [v for item in h.items() for v in item]
+
+    def cmd_hkeys(self, client, key):
+        return list(self._get(client, key, dict) or ())
+
+    def cmd_hvals(self, client, key):
+        return list((self._get(client, key, dict) or {}).values())
+
+    def cmd_hlen(self, client, key):
+        return len(self._get(client, key, dict) or ())
+
+    def cmd_hexists(self, client, key, field):
+        return int(field in (self._get(client, key, dict) or ()))
+
+    def cmd_hstrlen(self, client, key, field):
+        return len((self._get(client, key, dict) or {}).get(field, b""))
+
+    def cmd_hdel(self, client, key, field, *fields):
+        h = self._update(client, key, dict, False)
+        if h is None:
+            return 0
+        n = sum(h.pop(f, None) is not None for f in (field,) + fields)
+        self._prune(client, key, h)
+        return n
+
+    def cmd_hincrby(self, client, key, field, increment):
+        h = self._get(client, key, dict) or {}
+        value = h.get(field)
+        try:
+            n = _int(increment) + (0 if value is None else _int(value))
+        except RedisError:
+            raise RedisError("ERR hash value is not an integer")
+        if not -_INT64 <= n < _INT64:
+            raise RedisError("ERR increment or decrement would overflow")
+        self._update(client, key, dict)[field] = b"%d" % n
+        return n
+
+    def cmd_hincrbyfloat(self, client, key, field, increment):
+        h = self._get(client, key, dict) or {}
+        value = h.get(field)
+        f = _float(increment) + (0.0 if value is None else _float(value))
+        if f - f != 0:
+            raise RedisError("ERR increment would produce NaN or Infinity")
+        value = self._update(client, key, dict)[field] = _score(f)
+        return value
+
+    # lists, the left is index 0 of the deque
+
+    def _push(self, client, key, values, left, create=True):
+        lst = self._update(client, key, deque, create)
+        if lst is None:
+            return 0
+        if left:
+            lst.extendleft(values)
+        else:
+            lst.extend(values)
+        self._pushed.notify_all()
+        return len(lst)
+
+    def cmd_lpush(self, client, key, value, *values):
+        return self._push(client, key, (value,) + values, True)
+
+    def cmd_rpush(self, client, key, value, *values):
+        return self._push(client, key, (value,) + values, False)
+
+    def cmd_lpushx(self, client, key, value, *values):
+        return self._push(client, key, (value,) + values, True, False)
+
+    def cmd_rpushx(self, client, key, value, *values):
+        return self._push(client, key, (value,) + values, False, False)
+
+    def _pop(self, client, key, left, count=None):
+        lst = self._update(client, key, deque, False)
+        if lst is None:
+            return None
+        pop = lst.popleft if left else lst.pop
+        if count is None:
+            value = pop()
+        else:
+            value = [pop() for i in range(min(count, len(lst)))]
+        self._prune(client, key, lst)
+        return value
+
+    def _count(self, count):
+        if count is None:
+            return None
+        count = _int(count)
+        if count < 0:
+            raise RedisError("ERR value is out of range, must be positive")
+        return count
+
+    def cmd_lpop(self, client, key, count=None):
+        return self._pop(client, key, True, self._count(count))
+
+    def cmd_rpop(self, client, key, count=None):
+        return self._pop(client, key, False, self._count(count))
+
+    def cmd_llen(self, client, key):
+        return len(self._get(client, key, deque) or ())
+
+    def cmd_lrange(self, client, key, start, stop):
+        lst = self._get(client, key, deque)
+        if not lst:
+            return []
+        start, stop = _slice(_int(start), _int(stop), len(lst))
+        if start == 0 and stop == len(lst):
+            return list(lst)
+        return [lst[i] for i in range(start, stop)]
+
+    def cmd_lindex(self, client, key, index):
+        lst = self._get(client, key, deque) or ()
+        index = _int(index)
+        if -len(lst) <= index < len(lst):
+            return lst[index]
+        return None
+
+    def cmd_lset(self, client, key, index, value):
+        lst = self._get(client, key, deque)
+        if lst is None:
+            raise RedisError("ERR no such key")
+        index = _int(index)
+        if not -len(lst) <= index < len(lst):
+            raise RedisError("ERR index out of range")
+        self._update(client, key, deque)[index] = value
+        return OK
+
+    def cmd_lrem(self, client, key, count, value):
+        count = _int(count)
+        lst = self._update(client, key, deque, False)
+        if lst is None:
+            return 0
+        items = list(lst) if count >= 0 else list(reversed(lst))
+        kept = []
+        removed = 0
+        for item in items:
+            if item == value and (count == 0 or removed < abs(count)):
+                removed += 1
+            else:
+                kept.append(item)
+        if count < 0:
+            kept.reverse()
+        lst.clear()
+        lst.extend(kept)
+        self._prune(client, key, lst)
+        return removed
+
+    def cmd_ltrim(self, client, key, start, stop):
+        start, stop = _int(start), _int(stop)
+        lst = self._update(client, key, deque, False)
+        if lst is None:
+            return OK
+        start, stop = _slice(start, stop, len(lst))
+        kept = [lst[i] for i in range(start, stop)]
+        lst.clear()
+        lst.extend(kept)
+        self._prune(client, key, lst)
+        return OK
+
+    def cmd_linsert(self, client, key, where, pivot, value):
+        where = where.upper()
+        if where not in (b"BEFORE", b"AFTER"):
+            raise RedisError(SYNTAX)
+        lst = self._get(client, key, deque)
+        if lst is None:
+            return 0
+        try:
+            index = lst.index(pivot)
+        except ValueError:
+            return -1
+        lst = self._update(client, key, deque)
+        lst.insert(index if where == b"BEFORE" else index + 1, value)
+        self._pushed.notify_all()
+        return len(lst)
+
+    def _move(self, client, source, destination, left, toleft):
+        value = self._pop(client, source, left)
+        if value is not None:
+            try:
+                self._push(client, destination, (value,), toleft)
+            except RedisError:
+                # restored when destination is not a list
+                self._push(client, source, (value,), left)
+                raise
+        return value
+
+    def _sides(self, wherefrom, whereto):
+        sides = (wherefrom.upper(), whereto.upper())
+        for side in sides:
+            if side not in (b"LEFT", b"RIGHT"):
+                raise RedisError(SYNTAX)
+        return sides[0] == b"LEFT", sides[1] == b"LEFT"
+
+    def cmd_rpoplpush(self, client, source, destination):
+        return self._move(client, source, destination, False, True)
+
+    def cmd_lmove(self, client, source, destination, wherefrom, whereto):
+        left, toleft = self._sides(wherefrom, whereto)
+        return self._move(client, source, destination, left, toleft)
+
+    def cmd_brpoplpush(self, client, source, destination, timeout):
+        return self._block(client, timeout, lambda: self._move(
+            client, source, destination, False, True))
+
+    def cmd_blmove(self, client, source, destination, wherefrom, whereto,
+                   timeout):
+        left, toleft = self._sides(wherefrom, whereto)
+        return self._block(client, timeout, lambda: self._move(
+            client, source, destination, left, toleft))
+
+    def _bpop(self, client, args, left):
+        if len(args) < 2:
+            raise _arity_error("blpop" if left else "brpop")
+
+        def attempt():
+            for key in args[:-1]:
+                value = self._pop(client, key, left)
+                if value is not None:
+                    return [key, value]
+        return self._block(client, args[-1], attempt)
+
+    def cmd_blpop(self, client, *args):
+        return self._bpop(client, args, True)
+
+    def cmd_brpop(self, client, *args):
+        return self._bpop(client, args, False)
+
+    # sets
+
+    def cmd_sadd(self, client, key, member, *members):
+        s = self._update(client, key, set)
+        n = len(s)
+        s.update((member,) + members)
+        return len(s) - n
+
+    def cmd_srem(self, client, key, member, *members):
+        s = self._update(client, key, set, False)
+        if s is None:
+            return 0
+        n = len(s)
+        s.difference_update((member,) + members)
+        self._prune(client, key, s)
+        return n - len(s)
+
+    def cmd_smembers(self, client, key):
+        return list(self._get(client, key, set) or ())
+
+    def cmd_sismember(self, client, key, member):
+        return int(member in (self._get(client, key, set) or ()))
+
+    def cmd_smismember(self, client, key, member, *members):
+        s = self._get(client, key, set) or ()
+        return [int(m in s) for m in (member,) + members]
+
+    def cmd_scard(self, client, key):
+        return len(self._get(client, key, set) or ())
+
+    def cmd_spop(self, client, key, count=None):
+        count = self._count(count)
+        s = self._update(client, key, set, False)
+        if s is None:
+            return None if count is None else []
+        if count is None:
+            value = s.pop()
+        else:
+            value = [s.pop() for i in range(min(count, len(s)))]
+        self._prune(client, key, s)
+        return value
+
+    def cmd_srandmember(self, client, key, count=None):
+        s = list(self._get(client, key, set) or ())
+        if count is None:
+            return random.choice(s) if s else None
+        count = _int(count)
+        if count >= 0:
+            return random.sample(s, min(count, len(s)))
+        return [random.choice(s) for i in range(-count)] if s else []
+
+    def _sets(self, client, keys):
+        return [self._get(client, key, set) or set() for key in keys]
+
+    def cmd_sinter(self, client, key, *keys):
+        return list(set.intersection(*self._sets(client, (key,) + keys)))
+
+    def cmd_sunion(self, client, key, *keys):
+        return list(set.union(*self._sets(client, (key,) + keys)))
+
+    def cmd_sdiff(self, client, key, *keys):
+        return list(set.difference(*self._sets(client, (key,) + keys)))
+
+    def _store(self, client, destination, members):
+        db = self.dbs[client.selected]
+        db.remove(destination)
+        if members:
+            db.store(destination, set(members))
+        return len(members)
+
+    def cmd_sinterstore(self, client, destination, key, *keys):
+        return self._store(client, destination,
+                           self.cmd_sinter(client, key, *keys))
+
+    def cmd_sunionstore(self, client, destination, key, *keys):
+        return self._store(client, destination,
+                           self.cmd_sunion(client, key, *keys))
+
+    def cmd_sdiffstore(self, client, destination, key, *keys):
+        return self._store(client, destination,
+                           self.cmd_sdiff(client, key, *keys))
+
+    def cmd_smove(self, client, source, destination, member):
+        s = self._get(client, source, set)
+        self._get(client, destination, set)
+        if s is None or member not in s:
+            return 0
+        self.cmd_srem(client, source, member)
+        self.cmd_sadd(client, destination, member)
+        return 1
+
+    # sorted sets
+
+    def cmd_zadd(self, client, key, *args):
+        args = list(args)
+        flags = set()
+        while args and args[0].upper() in (b"NX", b"XX", b"GT", b"LT",
+                                           b"CH", b"INCR"):
+            flags.add(args.pop(0).upper())
+        if not args:
+            raise _arity_error("zadd")
+        if len(args) % 2:
+            raise RedisError(SYNTAX)
+        if ((b"NX" in flags and (b"XX" in flags or b"GT" in flags or
+                                 b"LT" in flags)) or
+                (b"GT" in flags and b"LT" in flags)):
+            raise RedisError("ERR XX, NX, GT and LT options at the same "
+                             "time are not compatible")
+        incr = b"INCR" in flags
+        if incr and len(args) != 2:
+            raise RedisError("ERR INCR option supports a single "
+                             "increment-element pair")
+        pairs = [(_float(args[i]), args[i + 1])
+                 for i in range(0, len(args), 2)]
+        z = self._get(client, key, ZSet)
+        if z is None and b"XX" in flags:
+            return None if incr else 0
+        z = self._update(client, key, ZSet)
+        added = changed = skipped = 0
+        for score, member in pairs:
+            old = z.scores.get(member)
+            if old is None:
+                if b"XX" in flags:
+                    skipped += 1
+                    continue
+                added += 1
+            else:
+                if b"NX" in flags:
+                    skipped += 1
+                    continue
+                if incr:
+                    score += old
+                if ((b"GT" in flags and score <= old) or
+                        (b"LT" in flags and score >= old)):
+                    skipped += 1
+                    continue
+                if score != old:
+                    changed += 1
+            if score != score:
+                raise RedisError("ERR resulting score is not a number (NaN)")
+            z.add(member, score)
+        self._prune(client, key, z)
+        if incr:
+            if skipped:
+                return None
+            return _score(z.scores[pairs[0][1]])
+        return added + changed if b"CH" in flags else added
+
+    def cmd_zincrby(self, client, key, increment, member):
+        return self.cmd_zadd(client, key, b"INCR", increment, member)
+
+    def cmd_zrem(self, client, key, member, *members):
+        z = self._update(client, key, ZSet, False)
+        if z is None:
+            return 0
+        n = sum(z.remove(m) for m in (member,) + members)
+        self._prune(client, key, z)
+        return n
+
+    def cmd_zscore(self, client, key, member):
+        score = (self._get(client, key, ZSet) or ZSet()).scores.get(member)
+        return None if score is None else _score(score)
+
+    def cmd_zmscore(self, client, key, member, *members):
+        scores = (self._get(client, key, ZSet) or ZSet()).scores
+        return [None if s is None else _score(s)
+                for s in (scores.get(m) for m in (member,) + members)]
+
+    def cmd_zcard(self, client, key):
+        return len(self._get(client, key, ZSet) or ())
+
+    def cmd_zcount(self, client, key, min, max):
+        z = self._get(client, key, ZSet) or ZSet()
+        start, stop = z.between(_bound(min), _bound(max))
+        return stop - start
+
+    def _zrank(self, client, key, member, rev):
+        z = self._get(client, key, ZSet) or ZSet()
+        rank = z.rank(member)
+        if rank is None or not rev:
+            return rank
+        return len(z) - 1 - rank
+
+    def cmd_zrank(self, client, key, member):
+        return self._zrank(client, key, member, False)
+
+    def cmd_zrevrank(self, client, key, member):
+        return self._zrank(client, key, member, True)
+
+    def _items(self, items, withscores):
+        if withscores:
+            return [v for s, m in items for v in (m, _score(s))]
+        return [m for s, m in items]
+
+    def cmd_zrange(self, client, key, start, stop, *options):
+        byscore = rev = withscores = False
+        limit = None
+        options = list(options)
+        while options:
+            option = options.pop(0).upper()
+            if option == b"BYSCORE":
+                byscore = True
+            elif option == b"REV":
+                rev = True
+            elif option == b"WITHSCORES":
+                withscores = True
+            elif option == b"LIMIT" and len(options) >= 2:
+                limit = _int(options.pop(0)), _int(options.pop(0))
+            elif option == b"BYLEX":
+                raise RedisError("ERR ZRANGE BYLEX is not implemented by "
+                                 "the memory backend")
+            else:
+                raise RedisError(SYNTAX)
+        if limit is not None and not byscore:
+            raise RedisError("ERR syntax error, LIMIT is only supported in "
+                             "combination with either BYSCORE or BYLEX")
+        z = self._get(client, key, ZSet)
+        if z is None:
+            return []
+        items = z.items
+        if byscore:
+            low, high = _bound(start), _bound(stop)
+            if rev:
+                low, high = high, low
+            i, j = z.between(low, high)
+            items = items[i:j]
+            if rev:
+                items.reverse()
+            if limit is not None:
+                offset, count = limit
+                if offset < 0:
+                    return []
+                items = items[offset:] if count < 0 else \
+                    items[offset:offset + count]
+        else:
+            n = len(items)
+            i, j = _slice(_int(start), _int(stop), n)
+            if rev:
+                items = items[n - j:n - i]
+                items.reverse()
+            else:
+                items = items[i:j]
+        return self._items(items, withscores)
+
+    def cmd_zrevrange(self, client, key, start, stop, *options):
+        return self.cmd_zrange(client, key, start, stop, b"REV", *options)
+
+    def cmd_zrangebyscore(self, client, key, min, max, *options):
+        return self.cmd_zrange(client, key, min, max, b"BYSCORE", *options)
+
+    def cmd_zrevrangebyscore(self, client, key, max, min, *options):
+        return self.cmd_zrange(client, key, max, min, b"BYSCORE", b"REV",
+                               *options)
+
+    def _zremove(self, client, key, items):
+        z = self._update(client, key, ZSet, False)
+        for score, member in list(items):
+            z.remove(member)
+        self._prune(client, key, z)
+        return len(items)
+
+    def cmd_zremrangebyrank(self, client, key, start, stop):
+        z = self._get(client, key, ZSet)
+        if z is None:
+            return 0
+        i, j = _slice(_int(start), _int(stop), len(z))
+        return self._zremove(client, key, z.items[i:j])
+
+    def cmd_zremrangebyscore(self, client, key, min, max):
+        z = self._get(client, key, ZSet)
+        if z is None:
+            return 0
+        i, j = z.between(_bound(min), _bound(max))
+        return self._zremove(client, key, z.items[i:j])
+
+    def _zpop(self, client, key, count, max):
+        count = 1 if count is None else self._count(count)
+        z = self._get(client, key, ZSet)
+        if z is None or not count:
+            return []
+        items = z.items[-count:][::-1] if max else z.items[:count]
+        self._zremove(client, key, items)
+        return self._items(items, True)
+
+    def cmd_zpopmin(self, client, key, count=None):
+        return self._zpop(client, key, count, False)
+
+    def cmd_zpopmax(self, client, key, count=None):
+        return self._zpop(client, key, count, True)
+
+    # transactions
+
+    def cmd_multi(self, client):
+        if client.multi is not None:
+            raise RedisError("ERR MULTI calls can not be nested")
+        client.multi = []
+        client.multi_error = False
+        return OK
+
+    def cmd_exec(self, client):
+        commands = client.multi
+        if commands is None:
+            raise RedisError("ERR EXEC without MULTI")
+        client.multi = None
+        dirty = client.dirty
+        self._unwatch(client)
+        if client.multi_error:
+            raise RedisError("EXECABORT Transaction discarded because of "
+                             "previous errors.")
+        if dirty:
+            return None
+        # blocking commands do not wait inside a transaction
+        client.atomic = True
+        try:
+            return [self._run(client, method, args)
+                    for name, method, args in commands]
+        finally:
+            client.atomic = False
+
+    def cmd_discard(self, client):
+        if client.multi is None:
+            raise RedisError("ERR DISCARD without MULTI")
+        client.multi = None
+        self._unwatch(client)
+        return OK
+
+    def cmd_watch(self, client, key, *keys):
+        if client.multi is not None:
+            raise RedisError("ERR WATCH inside MULTI is not allowed")
+        db = self.dbs[client.selected]
+        for key in (key,) + keys:
+            db.lookup(key)
+            db.watchers.setdefault(key, set()).add(client)
+            client.watched.append((db, key))
+        return OK
+
+    def cmd_unwatch(self, client):
+        self._unwatch(client)
+        return OK
+
+    def _unwatch(self, client):
+        for db, key in client.watched:
+            clients = db.watchers.get(key)
+            if clients is not None:
+                clients.discard(client)
+                if not clients:
+                    del db.watchers[key]
+        client.watched = []
+        client.dirty = False
+
+    # pub/sub
+
+    def _subscribe(self, client, index, keys, names, kind):
+        replies = Replies()
+        for name in names:
+            keys.add(name)
+            index.setdefault(name, set()).add(client)
+            replies.append([kind, name,
+                            len(client.channels) + len(client.patterns)])
+        return replies
+
+    def _unsubscribe(self, client, index, keys, names, kind):
+        replies = Replies()
+        for name in names or list(keys):
+            keys.discard(name)
+            clients = index.get(name)
+            if clients is not None:
+                clients.discard(client)
+                if not clients:
+                    del index[name]
+            replies.append([kind, name,
+                            len(client.channels) + len(client.patterns)])
+        if not replies:
+            replies.append([kind, None,
+                            len(client.channels) + len(client.patterns)])
+        return replies
+
+    def cmd_subscribe(self, client, channel, *channels):
+        return self._subscribe(client, self.channels, client.channels,
+                               (channel,) + channels, b"subscribe")
+
+    def cmd_psubscribe(self, client, pattern, *patterns):
+        return self._subscribe(client, self.patterns, client.patterns,
+                               (pattern,) + patterns, b"psubscribe")
+
+    def cmd_unsubscribe(self, client, *channels):
+        return self._unsubscribe(client, self.channels, client.channels,
+                                 channels, b"unsubscribe")
+
+    def cmd_punsubscribe(self, client, *patterns):
+        return self._unsubscribe(client, self.patterns, client.patterns,
+                                 patterns, b"punsubscribe")
+
+    def cmd_publish(self, client, channel, message):
+        n = 0
+        for subscriber in self.channels.get(channel, ()):
+            subscriber.deliver([b"message", channel, message])
+            n += 1
+        for pattern, subscribers in self.patterns.items():
+            if fnmatch.fnmatchcase(channel, pattern):
+                for subscriber in subscribers:
+                    subscriber.deliver([b"pmessage", pattern, channel,
+                                        message])
+                    n += 1
+        return n
+
+    def cmd_pubsub(self, client, subcommand, *args):
+        subcommand = subcommand.upper()
+        if subcommand == b"CHANNELS" and len(args) <= 1:
+            return [channel for channel in self.channels
+                    if not args or fnmatch.fnmatchcase(channel, args[0])]
+        if subcommand == b"NUMSUB":
+            return [v for channel in args
+                    for v in (channel, len(self.channels.get(channel, ())))]
+        if subcommand == b"NUMPAT" and not args:
+            return len(self.patterns)
+        raise RedisError("ERR Unknown PUBSUB subcommand or wrong number of "
+                         "arguments for '%s'" % subcommand.decode())
+
+
+class MemoryNode(object):
+    """
+    Node running its commands on a MemoryBackend: replies are queued
+    until read with parse_resp as they would be on a socket, runcmd
+    executes the command as a function call.
+    """
+
+    onconnect = None
+    ondisconnect = None
+    onpush = None
+    metrics = None
+
+    def __init__(self, backend, db=0, timeout=None):
+        self.backend = backend
+        self.host = "memory"
+        self.port = 0
+        self.db = db
+        self.timeout = timeout
+        self.password = None
+        self.protocol = 2
+        # kept empty, messages are replies as with RESP2
+        self.pushes = deque()
+        self._replies = deque()
+        self._cond = threading.Condition()
+        self._connected = False
+        # client state kept by the backend
+        self.selected = db
+        self.multi = None
+        self.multi_error = False
+        self.watched = []
+        self.dirty = False
+        self.atomic = False
+        self.channels = set()
+        self.patterns = set()
+
+    def __connected__(self):
+        return self._connected
+
+    def connect(self):
+        if self._connected:
+            return
+        self._connected = True
+        self.selected = self.db
+        if self.metrics is not None:
+            self.metrics.connected(self)
+        if self.onconnect is not None:
+            self.onconnect(self)
+
+    def disconnect(self):
+        if not self._connected:
+            return
+        self.backend.release(self)
+        with self._cond:
+            self._connected = False
+            self._replies.clear()
+            self._cond.notify_all()
+        if self.ondisconnect is not None:
+            self.ondisconnect(self)
+
+    def deliver(self, reply):
+        with self._cond:
+            self._replies.append(reply)
+            self._cond.notify()
+
+    def sendcmd(self, cmdname, *args):
+        self.connect()
+        reply = self.backend.execute(self, cmdname, args)
+        with self._cond:
+            if type(reply) is Replies:
+                self._replies.extend(reply)
+            else:
+                self._replies.append(reply)
+
+    def sendcommands(self, commands):
+        for cmdname, args in commands:
+            self.sendcmd(cmdname, *args)
+
+    def _next(self, timeout=None):
+        with self._cond:
+            if not self._replies:
+                if not (self.channels or self.patterns):
+                    raise NodeError("No reply pending on %s" % self.host)
+                if not self._cond.wait_for(
+                        lambda: self._replies or not self._connected,
+                        timeout):
+                    return NOREPLY
+                if not self._replies:
+                    raise NodeError("Connection closed")
+            return self._replies.popleft()
+
+    def parse_resp(self, raise_errors=True, out=None, views=False):
+        """
+        next reply, see Node.parse_resp
+        """
+        reply = self._next()
+        if raise_errors:
+            _raise(reply)
+        if out is not None and type(reply) is bytes:
+            n = len(reply)
+            view = memoryview(out).cast("B")
+            if n > view.nbytes:
+                raise ValueError("buffer of %d bytes too small for %d "
+                                 "bytes" % (view.nbytes, n))
+            view[:n] = reply
+            return n
+        if views:
+            return _views(reply)
+        return reply
+
+    def parse_push(self):
+        if self.pushes:
+            return self.pushes.popleft()
+        return self._next()
+
+    def parse_pushes(self, max_count, timeout=None):
+        frames = []
+        while self.pushes and len(frames) < max_count:
+            frames.append(self.pushes.popleft())
+        if not frames:
+            reply = self._next(timeout)
+            if reply is NOREPLY:
+                return frames
+            frames.append(reply)
+        with self._cond:
+            while self._replies and len(frames) < max_count:
+                frames.append(self._replies.popleft())
+        return frames
+
+    def runcmd(self, cmdname, *args):
+        if self.metrics is not None:
+            return self.replies(self.request([(cmdname, args)], cmdname))
+        if self._replies:
+            # replies of former commands or messages come first
+            self.sendcmd(cmdname, *args)
+            return self.parse_resp()
+        self.connect()
+        reply = self.backend.execute(self, cmdname, args)
+        if type(reply) is Replies:
+            with self._cond:
+                self._replies.extend(reply[1:])
+            reply = reply[0]
+        return _raise(reply)
+
+    def runcommands(self, commands, name="PIPELINE"):
+        """
+        run a batch of (cmdname, args), errors are returned in place
+        """
+        if self.metrics is not None:
+            return self.replies(self.request(commands, name),
+                                len(commands), False)
+        self.sendcommands(commands)
+        return [self.parse_resp(raise_errors=False)
+                for i in range(len(commands))]
+
+    def request(self, commands, name="PIPELINE"):
+        """
+        see Node.request, no bytes are counted
+        """
+        metrics = self.metrics
+        if metrics is None:
+            self.sendcommands(commands)
+            return None
+        if metrics.before:
+            for hook in metrics.before:
+                hook(name, self)
+        start = time.perf_counter()
+        try:
+            self.sendcommands(commands)
+        except Exception as e:
+            self._record(name, start, e)
+            raise
+        return name, start
+
+    def replies(self, request, count=None, raise_errors=True, out=None,
+                views=False):
+        """
+        see Node.replies
+        """
+        if request is None:
+            return self._read(count, raise_errors, out, views)
+        name, start = request
+        error = None
+        try:
+            return self._read(count, raise_errors, out, views)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._record(name, start, error)
+
+    def _read(self, count, raise_errors, out, views):
+        if count is None:
+            return self.parse_resp(raise_errors, out, views)
+        return [self.parse_resp(raise_errors) for i in range(count)]
+
+    def _record(self, name, start, error):
+        metrics = self.metrics
+        elapsed = time.perf_counter() - start
+        metrics.record(name, self, elapsed, 0, 0, error)
+        if metrics.after:
+            for hook in metrics.after:
+                hook(name, self, elapsed, error)
+
+
+def _raise(reply):
+    # raises error replies as parse_resp does
+    if type(reply) is RedisError:
+        raise reply
+    if type(reply) is list:
+        for value in reply:
+            if type(value) is RedisError:
+                raise value
+    return reply
+
+
+def _views(reply):
+    if type(reply) is bytes:
+        return memoryview(reply)
+    if type(reply) is list:
+        return [_views(value) for value in reply]
+    return reply
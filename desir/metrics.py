@@ -0,0 +1,211 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Per command and per node counters and latency histograms
+"""
+
+import threading
+import time
+
+from .resp import NodeError
+
+# latency histograms have SUB_BUCKETS buckets per power of 2 of
+# microseconds (HDR style, values known within 25%)
+SUB_BUCKETS = 4
+_SUB_BITS = 2
+HISTOGRAM_SIZE = SUB_BUCKETS * 40
+
+
+def bucket(us):
+    """
+    histogram bucket of a latency in (integer) microseconds
+    """
+    shift = us.bit_length() - _SUB_BITS - 1
+    if shift <= 0:
+        return us
+    return shift * SUB_BUCKETS + (us >> shift)
+
+
+def bucket_bounds(index):
+    """
+    [low, high) latencies in microseconds of a histogram bucket
+    """
+    if index < 2 * SUB_BUCKETS:
+        return index, index + 1
+    shift = index // SUB_BUCKETS - 1
+    low = (index - shift * SUB_BUCKETS) << shift
+    return low, low + (1 << shift)
+
+
+class CommandStats(object):
+    """
+    counters of a command on a node, times in seconds
+    """
+
+    __slots__ = ("calls", "errors", "sent", "received", "total", "max",
+                 "histogram")
+
+    def __init__(self):
+        self.calls = self.errors = self.sent = self.received = 0
+        self.total = self.max = 0.0
+        self.histogram = [0] * HISTOGRAM_SIZE
+
+    def percentile(self, q):
+        """
+        upper bound of the latency (in seconds) of q percent of the calls
+        """
+        rank = self.calls * q / 100.0
+        seen = 0
+        for index, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= rank:
+                return min(bucket_bounds(index)[1] / 1e6, self.max)
+        return self.max
+
+    def todict(self):
+        histogram = dict((bucket_bounds(i)[1], n)
+                         for i, n in enumerate(self.histogram) if n)
+        return dict(calls=self.calls, errors=self.errors, sent=self.sent,
+                    received=self.received, total=self.total,
+                    mean=self.total / self.calls if self.calls else 0.0,
+                    p50=self.percentile(50), p99=self.percentile(99),
+                    max=self.max, histogram=histogram)
+
+
+class Metrics(object):
+    """
+    Calls, errors, bytes sent and received and latency histogram of every
+    command by node ("host:port"), connections and reconnections (after a
+    connection error) by node.
+
+    Give it to Redis(metrics=...) (metrics=True creates one): each of its
+    connections records the commands it runs, a pipeline is recorded as
+    one PIPELINE (or MULTI for a transaction) command. Connections without
+    metrics do not pay anything but an attribute test.
+
+    Callables added with add_hook are called before each command with
+    (cmdname, node) and after with (cmdname, node, seconds, error), error
+    being the exception raised or None.
+    """
+
+    def __init__(self):
+        # (cmdname, host, port) -> CommandStats
+        self.commands = {}
+        # (host, port) -> count
+        self.connections = {}
+        self.reconnects = {}
+        self.before = []
+        self.after = []
+        self.started = time.time()
+        # nodes whose last command failed with a connection error
+        self._lost = set()
+        self._lock = threading.Lock()
+
+    def add_hook(self, before=None, after=None):
+        if before is not None:
+            self.before.append(before)
+        if after is not None:
+            self.after.append(after)
+
+    def remove_hook(self, before=None, after=None):
+        if before is not None:
+            self.before.remove(before)
+        if after is not None:
+            self.after.remove(after)
+
+    def record(self, cmdname, node, elapsed, sent, received, error=None):
+        key = (cmdname, node.host, node.port)
+        us = int(elapsed * 1000000)
+        shift = us.bit_length() - _SUB_BITS - 1
+        index = us if shift <= 0 else shift * SUB_BUCKETS + (us >> shift)
+        if index >= HISTOGRAM_SIZE:
+            index = HISTOGRAM_SIZE - 1
+        with self._lock:
+            stats = self.commands.get(key)
+            if stats is None:
+                stats = self.commands[key] = CommandStats()
+            stats.calls += 1
+            stats.sent += sent
+            stats.received += received
+            stats.total += elapsed
+            if elapsed > stats.max:
+                stats.max = elapsed
+            stats.histogram[index] += 1
+            if error is not None:
+                stats.errors += 1
+                if isinstance(error, NodeError):
+                    self._lost.add((node.host, node.port))
+
+    def connected(self, node):
+        address = (node.host, node.port)
+        with self._lock:
+            self.connections[address] = self.connections.get(address, 0) + 1
+            if address in self._lost:
+                self._lost.discard(address)
+                self.reconnects[address] = self.reconnects.get(
+                    address, 0) + 1
+
+    def snapshot(self):
+        """
+        {"commands": {cmdname: {node: counters}}, "connections": {node: n},
+        "reconnects": {node: n}}
+        """
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        commands = {}
+        for (cmdname, host, port), stats in self.commands.items():
+            commands.setdefault(cmdname, {})["%s:%s" % (host, port)] = (
+                stats.todict())
+        return dict(started=self.started, time=time.time(),
+                    commands=commands,
+                    connections=_bynode(self.connections),
+                    reconnects=_bynode(self.reconnects))
+
+    def reset(self):
+        """
+        start counting again, returns the snapshot of what was counted
+        """
+        with self._lock:
+            snapshot = self._snapshot()
+            self.commands = {}
+            self.connections = {}
+            self.reconnects = {}
+            self.started = time.time()
+        return snapshot
+
+
+def _bynode(counts):
+    return dict(("%s:%s" % address, n) for address, n in counts.items())
@@ -0,0 +1,181 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+import time
+from .resp import NodeError, RedisError
+
+# idle connections older than this (in seconds) are closed
+DEFAULT_IDLE_TIMEOUT = 300
+# connections idle for longer than this are PINGed on checkout
+DEFAULT_HEALTH_CHECK_INTERVAL = 30
+
+
+class PoolTimeoutError(NodeError):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Thread safe bounded pool of connections.
+
+    factory is called without argument to create a new (not yet
+    connected) Node. Connections are handed out with checkout and given
+    back with release, or dropped with discard when they failed.
+    checkout blocks up to timeout seconds when max_connections are in use
+    (forever if timeout is None).
+    """
+
+    def __init__(self, factory, max_connections=None, timeout=None,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL):
+        self.factory = factory
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        # (node, generation, released at), most recently used last
+        self._idle = []
+        self._generations = {}
+        self._created = 0
+        self._generation = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def __len__(self):
+        return self._created
+
+    def idle(self):
+        return len(self._idle)
+
+    def _reap(self, now):
+        if self.idle_timeout is None:
+            return
+        limit = now - self.idle_timeout
+        n = 0
+        while n < len(self._idle) and self._idle[n][2] < limit:
+            n += 1
+        if n:
+            for node, generation, used in self._idle[:n]:
+                node.disconnect()
+            del self._idle[:n]
+            self._created -= n
+            self._cond.notify(n)
+
+    def checkout(self):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    self._reap(now)
+                    if self._idle:
+                        node, generation, used = self._idle.pop()
+                        break
+                    if (self.max_connections is None or
+                            self._created < self.max_connections):
+                        self._created += 1
+                        node = None
+                        generation = self._generation
+                        break
+                    if deadline is None:
+                        self._cond.wait()
+                    elif now >= deadline or not self._cond.wait(
+                            deadline - now):
+                        raise PoolTimeoutError(
+                            "No connection available after %ss" % (
+                                self.timeout))
+            if node is None:
+                try:
+                    node = self.factory()
+                except Exception:
+                    with self._cond:
+                        self._created -= 1
+                        self._cond.notify()
+                    raise
+            elif (self.health_check_interval is not None and
+                  now - used > self.health_check_interval and
+                  node.__connected__()):
+                try:
+                    node.runcmd("PING")
+                except (NodeError, RedisError):
+                    # not handed out yet, discard would ignore it
+                    node.disconnect()
+                    with self._cond:
+                        self._created -= 1
+                        self._cond.notify()
+                    continue
+            with self._cond:
+                self._generations[id(node)] = generation
+            return node
+
+    def release(self, node):
+        """
+        give back a checked out connection, nodes the pool did not hand
+        out (or already released) are ignored
+        """
+        with self._cond:
+            generation = self._generations.pop(id(node), None)
+            if generation is None:
+                return
+            if generation != self._generation:
+                node.disconnect()
+                self._created -= 1
+            else:
+                self._idle.append((node, generation, time.monotonic()))
+            self._cond.notify()
+
+    def discard(self, node):
+        """
+        drop a checked out connection, typically after a NodeError
+        """
+        with self._cond:
+            if self._generations.pop(id(node), None) is None:
+                return
+            self._created -= 1
+            self._cond.notify()
+        node.disconnect()
+
+    def reset(self):
+        """
+        close idle connections, checked out ones are closed on release
+        """
+        with self._cond:
+            self._generation += 1
+            for node, generation, used in self._idle:
+                node.disconnect()
+            self._created -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+    disconnect = reset
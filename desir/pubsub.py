@@ -0,0 +1,334 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Pub/sub multiplexer: any number of subscriptions over one connection
+"""
+
+import queue
+import threading
+import time
+import traceback
+
+from .resp import NodeError, RedisError
+
+# pause before reconnecting, doubled up to RECONNECT_MAX_DELAY
+RECONNECT_DELAY = 0.1
+RECONNECT_MAX_DELAY = 5
+
+
+def _keybytes(key):
+    if type(key) is bytes:
+        return key
+    if isinstance(key, (bytearray, memoryview)):
+        return bytes(key)
+    return str(key).encode("utf-8")
+
+
+def _keys(keys):
+    if isinstance(keys, (list, tuple, set, frozenset)):
+        return [_keybytes(k) for k in keys]
+    return [_keybytes(keys)]
+
+
+class Message(object):
+    """
+    pub/sub message. Indexing and iterating give the fields of the reply
+    it was made of: type, channel, data (type, pattern, channel, data for
+    pmessage), so it compares equal to that reply.
+    """
+
+    __slots__ = ("type", "pattern", "channel", "data")
+
+    def __init__(self, type, channel, data, pattern=None):
+        self.type = type
+        self.pattern = pattern
+        self.channel = channel
+        self.data = data
+
+    def _fields(self):
+        if self.pattern is not None:
+            return (self.type, self.pattern, self.channel, self.data)
+        if self.channel is None:
+            return (self.type, self.data)
+        return (self.type, self.channel, self.data)
+
+    def __getitem__(self, index):
+        return self._fields()[index]
+
+    def __len__(self):
+        return len(self._fields())
+
+    def __iter__(self):
+        return iter(self._fields())
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            other = other._fields()
+        elif isinstance(other, list):
+            other = tuple(other)
+        return self._fields() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Message(%r)" % (list(self._fields()),)
+
+    def todict(self):
+        return dict(type=self.type, pattern=self.pattern,
+                    channel=self.channel, data=self.data)
+
+
+def pubsub_message(reply):
+    """
+    Message of a pub/sub reply (message, pmessage, subscribe...)
+    """
+    if len(reply) == 3:
+        return Message(reply[0], reply[1], reply[2])
+    if len(reply) == 4:
+        return Message(reply[0], reply[2], reply[3], reply[1])
+    # pong of a subscribed connection
+    return Message(reply[0], None, reply[-1] if len(reply) > 1 else None)
+
+
+class PubSub(object):
+    """
+    Subscriptions to channels and patterns sharing a single connection.
+
+    subscribe/psubscribe register a callback and send SUBSCRIBE/PSUBSCRIBE
+    at once, a reader thread dispatches each message to the callbacks of
+    its channel, or of the pattern the server matched, with a dict lookup.
+    Callbacks run on workers threads, messages of a channel (or pattern)
+    always go to the same worker so they are handled in order; with
+    workers=0 they run on the reader thread. After a connection loss every
+    channel and pattern is subscribed again on a new connection.
+    """
+
+    def __init__(self, redis, workers=4):
+        self._redis = redis
+        # channel/pattern -> list of callbacks
+        self._channels = {}
+        self._patterns = {}
+        # channel/pattern -> number of messages received
+        self.counts = {}
+        self.errors = 0
+        self.reconnects = 0
+        self._snapshot = ({}, time.monotonic())
+        self._lock = threading.RLock()
+        self._node = None
+        self._thread = None
+        self._closed = False
+        self._queues = [queue.SimpleQueue() for i in range(workers)]
+        self._workers = []
+        for q in self._queues:
+            worker = threading.Thread(target=self._work, args=(q,))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def channels(self):
+        return list(self._channels)
+
+    @property
+    def patterns(self):
+        return list(self._patterns)
+
+    def subscribe(self, channels, callback):
+        """
+        call callback with each message published on channels (a channel
+        or a list of channels)
+        """
+        self._add(self._channels, "SUBSCRIBE", channels, callback)
+
+    def psubscribe(self, patterns, callback):
+        """
+        call callback with each message of the channels matching patterns
+        """
+        self._add(self._patterns, "PSUBSCRIBE", patterns, callback)
+
+    def unsubscribe(self, channels, callback=None):
+        """
+        remove callback from channels, every callback when None
+        """
+        self._remove(self._channels, "UNSUBSCRIBE", channels, callback)
+
+    def punsubscribe(self, patterns, callback=None):
+        self._remove(self._patterns, "PUNSUBSCRIBE", patterns, callback)
+
+    def _add(self, index, cmdname, keys, callback):
+        keys = _keys(keys)
+        with self._lock:
+            new = [key for key in keys if key not in index]
+            for key in keys:
+                index.setdefault(key, []).append(callback)
+                self.counts.setdefault(key, 0)
+            if new:
+                self._send(cmdname, new)
+
+    def _remove(self, index, cmdname, keys, callback):
+        keys = _keys(keys)
+        with self._lock:
+            gone = []
+            for key in keys:
+                callbacks = index.get(key)
+                if callbacks is None:
+                    continue
+                if callback is not None and callback in callbacks:
+                    callbacks.remove(callback)
+                if callback is None or not callbacks:
+                    del index[key]
+                    self.counts.pop(key, None)
+                    gone.append(key)
+            if gone:
+                self._send(cmdname, gone)
+
+    def _send(self, cmdname, keys):
+        if self._closed:
+            raise NodeError("PubSub is closed")
+        if self._node is None:
+            # subscribes everything registered so far
+            self._connect()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+            return
+        try:
+            self._node.sendcmd(cmdname, *keys)
+        except NodeError:
+            # the reader reconnects and subscribes everything again
+            pass
+
+    def _connect(self):
+        node = self._redis._newnode()
+        # not a data connection, no client side caching hooks
+        node.onconnect = node.ondisconnect = None
+        node.timeout = None
+        commands = []
+        if self._channels:
+            commands.append(("SUBSCRIBE", list(self._channels)))
+        if self._patterns:
+            commands.append(("PSUBSCRIBE", list(self._patterns)))
+        if commands:
+            node.sendcommands(commands)
+        else:
+            node.connect()
+        self._node = node
+
+    def _reconnect(self):
+        delay = RECONNECT_DELAY
+        while not self._closed:
+            try:
+                with self._lock:
+                    self._connect()
+                self.reconnects += 1
+                return
+            except (NodeError, RedisError, OSError):
+                if self._redis.sentinels:
+                    # the master may have changed
+                    self._redis.master = None
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _run(self):
+        while not self._closed:
+            try:
+                msg = self._node.parse_push()
+            except RedisError:
+                traceback.print_exc()
+                continue
+            except (NodeError, AttributeError):
+                # AttributeError: disconnected by a failed send meanwhile
+                if self._closed:
+                    break
+                self._reconnect()
+                continue
+            kind = msg[0]
+            if kind == b"message":
+                self._dispatch(self._channels, msg[1],
+                               Message(kind, msg[1], msg[2]))
+            elif kind == b"pmessage":
+                self._dispatch(self._patterns, msg[1],
+                               Message(kind, msg[2], msg[3], msg[1]))
+
+    def _dispatch(self, index, key, msg):
+        callbacks = index.get(key)
+        if not callbacks:
+            # unsubscribed meanwhile
+            return
+        self.counts[key] = self.counts.get(key, 0) + 1
+        if self._queues:
+            self._queues[hash(key) % len(self._queues)].put((callbacks, msg))
+        else:
+            self._call(callbacks, msg)
+
+    def _call(self, callbacks, msg):
+        for callback in list(callbacks):
+            try:
+                callback(msg)
+            except Exception:
+                self.errors += 1
+                traceback.print_exc()
+
+    def _work(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            self._call(*item)
+
+    def stats(self):
+        """
+        messages received and rate (per second since the previous call)
+        by channel and pattern
+        """
+        now = time.monotonic()
+        counts = dict(self.counts)
+        last, since = self._snapshot
+        self._snapshot = (counts, now)
+        elapsed = (now - since) or 1e-9
+        return dict((key, dict(count=count,
+                               rate=(count - last.get(key, 0)) / elapsed))
+                    for key, count in counts.items())
+
+    def close(self):
+        """
+        drop the connection and stop the threads, queued messages are
+        still handled
+        """
+        self._closed = True
+        for q in self._queues:
+            q.put(None)
+        with self._lock:
+            if self._node is not None:
+                self._node.disconnect()
@@ -0,0 +1,226 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Read only commands served by the replicas of the master
+"""
+
+import itertools
+import threading
+import time
+
+from .pool import ConnectionPool
+from .resp import NodeError, RedisError
+
+STRATEGIES = ("round-robin", "latency")
+
+
+def _fields(entry):
+    # SENTINEL REPLICAS entry: flat name, value list (or RESP3 map)
+    if type(entry) is dict:
+        items = entry.items()
+    else:
+        items = zip(entry[::2], entry[1::2])
+    return dict((k.decode("utf8"), v.decode("utf8") if type(v) is bytes
+                 else v) for k, v in items)
+
+
+class Replicas(object):
+    """
+    Connection pools to the replicas of the master of a redis instance.
+
+    Replicas are listed with SENTINEL REPLICAS when the instance uses
+    sentinels (those seen down or with a broken link to the master are
+    left out, as well as the ones the sentinel watcher saw down), with
+    ROLE on the master otherwise, again every REFRESH_INTERVAL seconds.
+    Each command goes to the next replica with the "round-robin"
+    strategy, or to the one with the lowest average latency with
+    "latency" (every PROBE_INTERVAL commands go round robin to keep the
+    latencies of the others up to date). A command is run on the master
+    when there is no replica or its replica fails, a failed replica is
+    left out for REFRESH_INTERVAL seconds.
+    """
+
+    # seconds between two listings of the replicas
+    REFRESH_INTERVAL = 10
+    PROBE_INTERVAL = 16
+    # weight of the last command in the average latency
+    LATENCY_WEIGHT = 0.2
+
+    def __init__(self, redis, strategy="round-robin", commands=None):
+        if strategy is True:
+            strategy = "round-robin"
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown replica strategy %r" % (strategy,))
+        if commands is None:
+            from .desir3 import readonly_commands, redisCommands
+            commands = readonly_commands(redisCommands)
+        self.redis = redis
+        self.strategy = strategy
+        self.commands = commands
+        # replica address -> ConnectionPool
+        self.pools = {}
+        self.addresses = []
+        # replica address -> average latency in seconds
+        self.latency = {}
+        self.fallbacks = 0
+        # replica address -> time it failed, left out for REFRESH_INTERVAL
+        self.failed = {}
+        self._picks = itertools.count()
+        self._refreshed = None
+        self._lock = threading.Lock()
+
+    def discover(self):
+        """
+        addresses of the healthy replicas of the master
+        """
+        redis = self.redis
+        if not redis.sentinels:
+            role = redis._runpooled("ROLE")
+            return [(host.decode("utf8"), int(port))
+                    for host, port, offset in role[2]]
+        with redis._sentinel_lock:
+            for node in redis.sentinels:
+                try:
+                    try:
+                        res = node.runcmd("sentinel", "replicas",
+                                          redis.service_name)
+                    except RedisError:
+                        # sentinel < 5
+                        res = node.runcmd("sentinel", "slaves",
+                                          redis.service_name)
+                except NodeError:
+                    continue
+                addresses = []
+                for entry in res:
+                    fields = _fields(entry)
+                    flags = fields.get("flags", "").split(",")
+                    if ("s_down" in flags or "o_down" in flags or
+                            "disconnected" in flags or
+                            fields.get("master-link-status") != "ok"):
+                        continue
+                    addresses.append((fields["ip"], int(fields["port"])))
+                return addresses
+        raise NodeError("unable to list the replicas from a sentinel")
+
+    def refresh(self):
+        try:
+            addresses = self.discover()
+        except (NodeError, RedisError):
+            # keep the known replicas
+            addresses = self.addresses
+        with self._lock:
+            self._refreshed = time.monotonic()
+            for address in addresses:
+                if address not in self.pools:
+                    self.pools[address] = ConnectionPool(
+                        self._factory(address),
+                        self.redis.pool.max_connections,
+                        self.redis.pool.timeout)
+            for address in list(self.pools):
+                if address not in addresses:
+                    self.pools.pop(address).reset()
+                    self.latency.pop(address, None)
+            self.addresses = addresses
+
+    def invalidate(self):
+        """
+        list the replicas again before the next command
+        """
+        self._refreshed = None
+
+    def _factory(self, address):
+        redis = self.redis
+
+        def factory():
+            from .desir3 import Node
+            node = Node(address[0], address[1], redis.db, redis.password,
+                        redis.timeout, protocol=redis.protocol)
+            node.metrics = redis.metrics
+            return node
+        return factory
+
+    def pick(self):
+        """
+        address of the replica for the next command, None for the master
+        """
+        refreshed = self._refreshed
+        if (refreshed is None or
+                time.monotonic() - refreshed > self.REFRESH_INTERVAL):
+            self.refresh()
+        addresses = self.addresses
+        watcher = self.redis.sentinel_watcher
+        if watcher is not None and watcher.down:
+            addresses = [a for a in addresses if a not in watcher.down]
+        if self.failed:
+            now = time.monotonic()
+            for address, failed in list(self.failed.items()):
+                if now - failed > self.REFRESH_INTERVAL:
+                    self.failed.pop(address, None)
+            addresses = [a for a in addresses if a not in self.failed]
+        if not addresses:
+            return None
+        n = next(self._picks)
+        if self.strategy == "latency" and n % self.PROBE_INTERVAL:
+            latency = self.latency
+            return min(addresses, key=lambda a: latency.get(a, 0))
+        return addresses[n % len(addresses)]
+
+    def runcmd(self, cmdname, *args):
+        address = self.pick()
+        pool = None
+        if address is not None:
+            pool = self.pools.get(address)
+        if pool is None:
+            return self.redis._runpooled(cmdname, *args)
+        node = pool.checkout()
+        start = time.monotonic()
+        try:
+            rsp = node.runcmd(cmdname, *args)
+        except NodeError:
+            pool.discard(node)
+            self.failed[address] = time.monotonic()
+            self.fallbacks += 1
+            return self.redis._runpooled(cmdname, *args)
+        except RedisError:
+            pool.release(node)
+            raise
+        pool.release(node)
+        elapsed = time.monotonic() - start
+        average = self.latency.get(address)
+        if average is None:
+            self.latency[address] = elapsed
+        else:
+            self.latency[address] = average + self.LATENCY_WEIGHT * (
+                elapsed - average)
+        return rsp
@@ -0,0 +1,666 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+"""
+RESP protocol readers and command encoder used by Node
+"""
+
+import select
+
+DEFAULT_BUFFER_SIZE = 65536
+
+# arguments larger than this are sent as their own buffer instead of
+# being copied into the command frame
+BUFFER_CUTOFF = 16384
+
+# max number of buffers handed to a single sendmsg call
+IOV_MAX = 1024
+
+# returned by RespReader.gets when the buffer does not hold a full reply yet
+NOREPLY = object()
+
+# arrays with fewer pending elements are parsed element by element
+FASTPATH_MIN_ELEMENTS = 8
+
+
+# RESP3 aggregate kinds that are not plain lists
+_MAP = 37  # %
+_SET = 126  # ~
+_ATTRIBUTE = 124  # |
+
+
+class RedisError(Exception):
+    pass
+
+
+class NodeError(Exception):
+    pass
+
+
+class Push(list):
+    """
+    RESP3 out of band push frame (pub/sub message, invalidation...)
+    """
+
+
+def _aggregate(lst, kind):
+    try:
+        if kind == _SET:
+            return set(lst)
+        return dict(zip(lst[::2], lst[1::2]))
+    except TypeError:
+        # unhashable members (aggregates) are kept as a flat list
+        return lst
+
+
+# command name -> (number of parts, RESP encoded parts)
+_headers = {}
+
+
+def command_header(cmdname):
+    """
+    RESP encoding of a command name, split on spaces for container
+    commands: "CLIENT LIST" gives (2, b"$6\\r\\nCLIENT\\r\\n$4\\r\\nLIST\\r\\n")
+    """
+    try:
+        return _headers[cmdname]
+    except KeyError:
+        pass
+    parts = cmdname.split()
+    header = b""
+    for part in parts:
+        if type(part) is not bytes:
+            part = part.encode("utf-8")
+        header += b"$%d\r\n%s\r\n" % (len(part), part)
+    if len(_headers) < 4096:
+        _headers[cmdname] = (len(parts), header)
+    return len(parts), header
+
+
+def pack_commands(commands):
+    """
+    encode (cmdname, args) pairs in a single pass, returns a list of
+    buffers to be sent in order. Arguments bigger than BUFFER_CUTOFF
+    which already are bytes like objects are not copied.
+    """
+    buffers = []
+    out = bytearray()
+    for cmdname, args in commands:
+        nparts, header = command_header(cmdname)
+        out += b"*%d\r\n" % (nparts + len(args))
+        out += header
+        for arg in args:
+            t = type(arg)
+            if t is bytes or t is bytearray:
+                n = len(arg)
+            elif t is str:
+                arg = arg.encode("utf-8")
+                n = len(arg)
+            elif t is int:
+                arg = b"%d" % arg
+                n = len(arg)
+            elif t is memoryview:
+                n = arg.nbytes
+            elif isinstance(arg, (bytes, bytearray, memoryview)):
+                arg = memoryview(arg)
+                n = arg.nbytes
+            else:
+                arg = str(arg).encode("utf-8")
+                n = len(arg)
+            out += b"$%d\r\n" % n
+            if n > BUFFER_CUTOFF:
+                buffers.append(out)
+                buffers.append(arg)
+                out = bytearray(b"\r\n")
+            else:
+                out += arg
+                out += b"\r\n"
+    buffers.append(out)
+    return buffers
+
+
+def arg_bytes(arg):
+    """
+    bytes sent for a command argument, as encoded by pack_commands
+    """
+    t = type(arg)
+    if t is bytes:
+        return arg
+    if t is str:
+        return arg.encode("utf-8")
+    if t is int:
+        return b"%d" % arg
+    if isinstance(arg, (bytes, bytearray, memoryview)):
+        return bytes(arg)
+    return str(arg).encode("utf-8")
+
+
+def pack_command(cmdname, *args):
+    return pack_commands([(cmdname, args)])
+
+
+def sendbuffers(sock, buffers):
+    """
+    send a list of buffers, with a single sendmsg call when possible
+    """
+    if len(buffers) == 1:
+        return sock.sendall(buffers[0])
+    if not hasattr(sock, "sendmsg"):
+        for buf in buffers:
+            sock.sendall(buf)
+        return
+    views = [memoryview(buf).cast("B") for buf in buffers]
+    i = 0
+    while i < len(views):
+        sent = sock.sendmsg(views[i:i + IOV_MAX])
+        while sent:
+            n = views[i].nbytes
+            if sent >= n:
+                sent -= n
+                i += 1
+            else:
+                views[i] = views[i][sent:]
+                sent = 0
+        # skip empty buffers so they do not stall the loop
+        while i < len(views) and not views[i].nbytes:
+            i += 1
+
+
+class SocketReader(object):
+    """
+    file object based reader, one readline/read call per reply element
+    and one recursion level per multi-bulk element
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._fp = sock.makefile('rb')
+
+    def read(self, length):
+        return self._fp.read(length)
+
+    def wait(self, timeout):
+        """
+        True once data is buffered or received, False after timeout seconds
+        """
+        timeout_ = self._sock.gettimeout()
+        self._sock.settimeout(0)
+        try:
+            # a non blocking peek does not mark the file as timed out
+            if self._fp.peek(1):
+                return True
+        finally:
+            self._sock.settimeout(timeout_)
+        return bool(select.select([self._sock], [], [], timeout)[0])
+
+    def readline(self):
+        return self._fp.readline()
+
+    def parse(self, raise_errors=True):
+        resp = self.readline()
+        if not resp:
+            raise ConnectionError('Empty response')
+        if resp[:-2] in [b"$-1", b"*-1"]:
+            return None
+        fb, resp = resp[0], resp[1:]
+        if fb == 43:  # +
+            return resp[:-2]
+        if fb == 45:  # -
+            err = RedisError(resp.decode("UTF-8").strip())
+            if raise_errors:
+                raise err
+            return err
+        if fb == 58:  # :
+            return int(resp)
+        if fb == 36:  # $
+            resp = self.read(int(resp))
+            self.read(2)
+            return resp
+        if fb == 42:  # *
+            return [self.parse(raise_errors) for i in range(int(resp))]
+        raise NodeError("Protocol error, unexpected type byte %r" % (
+            chr(fb)))
+
+
+class RespReader(object):
+    """
+    Incremental RESP reader owning its receive buffer.
+
+    Data is pulled from the socket in large chunks with recv_into (or
+    pushed with feed), and aggregate replies are parsed in one pass with
+    an explicit stack. A partially received aggregate keeps its stack
+    between calls so that nothing is parsed twice.
+
+    RESP3 types are understood as well: maps give dicts, sets give sets,
+    doubles floats, booleans bools, push frames Push lists. Attributes
+    are not part of the reply, the last ones are kept in attributes.
+    """
+
+    attributes = None
+    # bytes received so far
+    received = 0
+
+    def __init__(self, sock=None, bufsize=DEFAULT_BUFFER_SIZE):
+        self._sock = sock
+        self._buf = bytearray()
+        self._chunk = bytearray(bufsize)
+        self._chunkview = memoryview(self._chunk)
+        # pending aggregates: (list, expected length, kind)
+        self._stack = []
+        self._error = None
+        # parse_views scanning state: position, pending element counts
+        self._scanpos = 0
+        self._scanstack = []
+
+    def feed(self, data):
+        self._buf += data
+        self.received += len(data)
+
+    def fill(self):
+        """
+        receive one chunk from the socket into the buffer
+        """
+        n = self._sock.recv_into(self._chunk)
+        if not n:
+            raise ConnectionError("Connection closed by server")
+        self._buf += self._chunkview[:n]
+        self.received += n
+        return n
+
+    def buffered(self):
+        return len(self._buf)
+
+    def read(self, length):
+        buf = self._buf
+        while len(buf) < length:
+            self.fill()
+        data = bytes(buf[:length])
+        del buf[:length]
+        return data
+
+    def readline(self):
+        buf = self._buf
+        start = 0
+        while True:
+            eol = buf.find(b"\n", start)
+            if eol >= 0:
+                break
+            start = len(buf)
+            self.fill()
+        data = bytes(buf[:eol + 1])
+        del buf[:eol + 1]
+        return data
+
+    def _bulks(self, view, pos, end, lst, count):
+        """
+        append up to count consecutive bulk strings found at pos to lst,
+        splitting the buffer once instead of walking it element by
+        element, returns the position following the last one appended
+        """
+        size = min(end - pos, max(count * 32, 4096))
+        while True:
+            parts = view[pos:pos + size].tobytes().split(b"\r\n", 2 * count)
+            if len(parts) > 2 * count or pos + size >= end:
+                break
+            size = min(end - pos, size * 2)
+        # a pair is complete when its payload is followed by a crlf
+        npairs = (len(parts) - 1) // 2
+        headers = parts[0:2 * npairs:2]
+        values = parts[1:2 * npairs:2]
+        expected = [b"$%d" % len(v) for v in values]
+        if headers != expected:
+            # a payload holding a crlf, a nil or a non bulk element
+            # shortens or breaks the pair, stop just before it
+            for npairs, (h, e) in enumerate(zip(headers, expected)):
+                if h != e:
+                    break
+            del values[npairs:]
+        lst.extend(values)
+        return pos + sum(map(len, parts[:2 * npairs])) + 4 * npairs
+
+    def gets(self, raise_errors=True):
+        """
+        parse one reply from the buffered data, NOREPLY if incomplete
+        """
+        buf = self._buf
+        stack = self._stack
+        find = buf.find
+        end = len(buf)
+        pos = 0
+        view = memoryview(buf)
+        # try the bulk string fast path when resuming or entering an array
+        fast = bool(stack)
+        try:
+            while True:
+                val = NOREPLY
+                if fast:
+                    fast = False
+                    lst, n, kind = stack[-1]
+                    if (n - len(lst) >= FASTPATH_MIN_ELEMENTS and pos < end
+                            and buf[pos] == 36):
+                        pos = self._bulks(view, pos, end, lst, n - len(lst))
+                        if len(lst) < n:
+                            continue
+                        stack.pop()
+                        if kind is None:
+                            val = lst
+                        elif kind == _ATTRIBUTE:
+                            # not a reply element, parse what it annotates
+                            self.attributes = _aggregate(lst, kind)
+                            continue
+                        else:
+                            val = _aggregate(lst, kind)
+                if val is NOREPLY:
+                    eol = find(b"\r\n", pos)
+                    if eol < 0:
+                        return NOREPLY
+                    fb = buf[pos]
+                    if fb == 36:  # $
+                        n = int(buf[pos + 1:eol])
+                        if n < 0:
+                            val = None
+                            pos = eol + 2
+                        else:
+                            start = eol + 2
+                            if start + n + 2 > end:
+                                return NOREPLY
+                            val = bytes(view[start:start + n])
+                            pos = start + n + 2
+                    elif fb == 42:  # *
+                        n = int(buf[pos + 1:eol])
+                        pos = eol + 2
+                        if n > 0:
+                            stack.append(([], n, None))
+                            fast = True
+                            continue
+                        val = None if n < 0 else []
+                    elif fb == 58:  # :
+                        val = int(buf[pos + 1:eol])
+                        pos = eol + 2
+                    elif fb == 43:  # +
+                        val = bytes(view[pos + 1:eol])
+                        pos = eol + 2
+                    elif fb == 45:  # -
+                        val = RedisError(
+                            bytes(view[pos + 1:eol]).decode("UTF-8").strip())
+                        pos = eol + 2
+                        if stack and self._error is None:
+                            self._error = val
+                    elif fb == 37 or fb == 126 or fb == 124:  # % ~ |
+                        n = int(buf[pos + 1:eol])
+                        pos = eol + 2
+                        if fb != 126:
+                            n *= 2
+                        if n > 0:
+                            stack.append(([], n, fb))
+                            fast = True
+                            continue
+                        if fb == _ATTRIBUTE:
+                            self.attributes = {}
+                            continue
+                        val = set() if fb == _SET else {}
+                    elif fb == 62:  # >
+                        n = int(buf[pos + 1:eol])
+                        pos = eol + 2
+                        if n > 0:
+                            stack.append((Push(), n, None))
+                            fast = True
+                            continue
+                        val = Push()
+                    elif fb == 95:  # _
+                        val = None
+                        pos = eol + 2
+                    elif fb == 44:  # ,
+                        val = float(buf[pos + 1:eol])
+                        pos = eol + 2
+                    elif fb == 35:  # #
+                        val = buf[pos + 1] == 116  # t
+                        pos = eol + 2
+                    elif fb == 40:  # (
+                        val = int(buf[pos + 1:eol])
+                        pos = eol + 2
+                    elif fb == 61 or fb == 33:  # = !
+                        n = int(buf[pos + 1:eol])
+                        start = eol + 2
+                        if start + n + 2 > end:
+                            return NOREPLY
+                        pos = start + n + 2
+                        if fb == 61:
+                            # verbatim string, drop the "txt:" format
+                            val = bytes(view[start + 4:start + n])
+                        else:
+                            val = RedisError(bytes(
+                                view[start:start + n]).decode("UTF-8").strip())
+                            if stack and self._error is None:
+                                self._error = val
+                    else:
+                        raise NodeError(
+                            "Protocol error, unexpected type byte %r" % (
+                                chr(fb)))
+                while stack:
+                    lst, n, kind = stack[-1]
+                    lst.append(val)
+                    if len(lst) < n:
+                        break
+                    stack.pop()
+                    if kind is None:
+                        val = lst
+                    elif kind == _ATTRIBUTE:
+                        # not a reply element, parse what it annotates
+                        self.attributes = _aggregate(lst, kind)
+                        break
+                    else:
+                        val = _aggregate(lst, kind)
+                else:
+                    break
+        finally:
+            view.release()
+            if pos:
+                del buf[:pos]
+        error, self._error = self._error, None
+        if raise_errors:
+            if type(val) is RedisError:
+                raise val
+            if error is not None:
+                raise error
+        return val
+
+    def parse(self, raise_errors=True):
+        """
+        read one full reply, receiving from the socket as needed
+        """
+        while True:
+            reply = self.gets(raise_errors)
+            if reply is not NOREPLY:
+                return reply
+            self.fill()
+
+    def parse_into(self, out, raise_errors=True):
+        """
+        read a bulk string reply straight into the writable buffer out,
+        the part not yet received goes from the socket to out with
+        recv_into. Returns its length, None for a nil reply, other
+        replies are returned as parse does.
+        """
+        # a buffer that is not writable fails before anything is consumed
+        view = memoryview(out).cast("B")
+        if view.readonly:
+            raise TypeError("cannot receive into a read-only buffer")
+        buf = self._buf
+        while True:
+            eol = buf.find(b"\r\n")
+            if eol >= 0:
+                break
+            self.fill()
+        if self._stack or buf[0] != 36:  # $
+            return self.parse(raise_errors)
+        n = int(buf[1:eol])
+        del buf[:eol + 2]
+        if n < 0:
+            return None
+        if n > view.nbytes:
+            # keep the connection usable
+            self.read(n + 2)
+            raise ValueError("buffer of %d bytes too small for %d bytes" % (
+                view.nbytes, n))
+        pos = min(len(buf), n)
+        view[:pos] = buf[:pos]
+        del buf[:pos]
+        while pos < n:
+            received = self._sock.recv_into(view[pos:n])
+            if not received:
+                raise ConnectionError("Connection closed by server")
+            self.received += received
+            pos += received
+        self.read(2)
+        return n
+
+    def _scan(self):
+        """
+        end of the first complete reply in the buffer, -1 when incomplete.
+        The position and the pending element counts are kept between calls.
+        """
+        buf = self._buf
+        end = len(buf)
+        pos = self._scanpos
+        pending = self._scanstack
+        while True:
+            eol = buf.find(b"\r\n", pos)
+            if eol < 0:
+                break
+            fb = buf[pos]
+            if fb == 36 or fb == 61 or fb == 33:  # $ = !
+                n = int(buf[pos + 1:eol])
+                following = eol + 2 + (n + 2 if n >= 0 else 0)
+                if following > end:
+                    break
+                pos = following
+            elif fb == 42 or fb == 62 or fb == 126:  # * > ~
+                n = int(buf[pos + 1:eol])
+                pos = eol + 2
+                if n > 0:
+                    pending.append(n)
+                    continue
+            elif fb == 37 or fb == 124:  # % |
+                n = int(buf[pos + 1:eol])
+                pos = eol + 2
+                # attributes are followed by the element they annotate
+                n = 2 * n + (fb == 124)
+                if n > 0:
+                    pending.append(n)
+                    continue
+            else:
+                pos = eol + 2
+            while pending:
+                pending[-1] -= 1
+                if pending[-1]:
+                    break
+                pending.pop()
+            else:
+                self._scanpos = 0
+                return pos
+        self._scanpos = pos
+        return -1
+
+    def _build(self, data, view, pos):
+        """
+        (reply at pos, following position), bulk strings are memoryview
+        slices of view
+        """
+        eol = data.find(b"\r\n", pos)
+        fb = data[pos]
+        if fb == 36:  # $
+            n = int(data[pos + 1:eol])
+            if n < 0:
+                return None, eol + 2
+            return view[eol + 2:eol + 2 + n], eol + 4 + n
+        if fb == 42 or fb == 62 or fb == 126:  # * > ~
+            n = int(data[pos + 1:eol])
+            if n < 0:
+                return None, eol + 2
+            lst = Push() if fb == 62 else []
+            pos = eol + 2
+            for i in range(n):
+                val, pos = self._build(data, view, pos)
+                lst.append(val)
+            if fb == _SET:
+                # memoryviews are not hashable
+                lst = _aggregate([v.tobytes() if type(v) is memoryview
+                                  else v for v in lst], _SET)
+            return lst, pos
+        if fb == 37 or fb == 124:  # % |
+            n = int(data[pos + 1:eol])
+            pos = eol + 2
+            lst = []
+            for i in range(2 * n):
+                val, pos = self._build(data, view, pos)
+                # memoryviews are not hashable
+                if not i % 2 and type(val) is memoryview:
+                    val = val.tobytes()
+                lst.append(val)
+            val = _aggregate(lst, fb)
+            if fb == _ATTRIBUTE:
+                self.attributes = val
+                return self._build(data, view, pos)
+            return val, pos
+        # other types are parsed as usual
+        reader = RespReader()
+        if fb == 61 or fb == 33:  # = !
+            eol = eol + 2 + int(data[pos + 1:eol])
+        reader.feed(view[pos:eol + 2])
+        return reader.gets(False), eol + 2
+
+    def parse_views(self, raise_errors=True):
+        """
+        read one full reply whose bulk strings are memoryview slices of a
+        single buffer holding the whole reply, instead of one bytes object
+        per element
+        """
+        while True:
+            end = self._scan()
+            if end >= 0:
+                break
+            self.fill()
+        if end == len(self._buf):
+            data, self._buf = self._buf, bytearray()
+        else:
+            data = self._buf[:end]
+            del self._buf[:end]
+        reply, pos = self._build(data, memoryview(data), 0)
+        if raise_errors:
+            if type(reply) is RedisError:
+                raise reply
+            if type(reply) is list or type(reply) is Push:
+                for val in reply:
+                    if type(val) is RedisError:
+                        raise val
+        return reply
@@ -0,0 +1,187 @@
+#
+# Copyright (c) 2010, Abdelkader ALLAM <abdelkader.allam at gmail dot com>
+# All rights reserved.
+#
+# This source also contains source code from Redis
+# developped by Salvatore Sanfilippo <antirez at gmail dot com>
+# available at http://github.com/antirez/redis
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of Redis nor the names of its contributors may be used
+#      to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Sentinel event watcher keeping the master address of a Redis up to date
+"""
+
+import threading
+import time
+
+from .resp import NodeError, RedisError
+
+# sentinel pub/sub channels followed
+SENTINEL_CHANNELS = ("+switch-master", "+sdown", "-sdown", "+sentinel")
+
+# pause before trying the sentinels again when none answered
+RETRY_DELAY = 1
+
+
+class SentinelWatcher(object):
+    """
+    Follows the events published by the sentinels of a Redis instance on
+    a connection to one of them (the next one when it fails):
+
+    - +switch-master of the service changes the master address at once
+      and resets the connection pool, commands then go to the new master
+      without waiting for a failure
+    - +sdown/-sdown keep the set of instances (ip, port) seen down, down
+      sentinels are asked last
+    - +sentinel adds the new sentinels of the service
+
+    Events missed while disconnected are caught up by asking the master
+    address again after each connection.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.down = set()
+        self.switches = 0
+        # optional callable receiving (old, new) master addresses
+        self.onswitch = None
+        self._node = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _sentinels(self):
+        # sentinels seen down last
+        return sorted(self.redis.sentinels,
+                      key=lambda node: (node.host, node.port) in self.down)
+
+    def _connect(self):
+        from .desir3 import DEFAULT_SENTINEL_TIMEOUT, Node
+        for sentinel in self._sentinels():
+            node = Node(sentinel.host, sentinel.port, 0, None,
+                        sentinel.timeout or DEFAULT_SENTINEL_TIMEOUT)
+            try:
+                node.sendcmd("SUBSCRIBE", *SENTINEL_CHANNELS)
+                for channel in SENTINEL_CHANNELS:
+                    node.parse_push()
+                # events are waited for without timeout
+                node.timeout = None
+                node._sock.settimeout(None)
+                self._node = node
+                self._resync(sentinel)
+                return node
+            except (NodeError, RedisError, OSError):
+                node.disconnect()
+        return None
+
+    def _resync(self, sentinel):
+        redis = self.redis
+        try:
+            with redis._sentinel_lock:
+                res = sentinel.runcmd("sentinel", "get-master-addr-by-name",
+                                      redis.service_name)
+        except (NodeError, RedisError):
+            return
+        if type(res) is list and len(res) == 2:
+            self._switch((res[0].decode("utf8"), int(res[1])))
+
+    def _switch(self, master):
+        redis = self.redis
+        with redis._sentinel_lock:
+            old = redis.master
+            if old == master:
+                return
+            redis.host, redis.port = master
+            redis.master = master
+        self.switches += 1
+        if redis.debug:
+            print("master of %s switched to %s %d" % (
+                redis.service_name, master[0], master[1]))
+        redis.pool.reset()
+        if redis.replicas is not None:
+            redis.replicas.invalidate()
+        if self.onswitch is not None:
+            self.onswitch(old, master)
+
+    def _run(self):
+        while not self._closed:
+            node = self._node
+            if node is None:
+                node = self._connect()
+                if node is None:
+                    time.sleep(RETRY_DELAY)
+                continue
+            try:
+                msg = node.parse_push()
+            except (NodeError, RedisError, AttributeError):
+                # AttributeError: disconnected by close
+                node.disconnect()
+                self._node = None
+                continue
+            if msg[0] == b"message":
+                self.event(msg[1].decode("utf8"),
+                           msg[2].decode("utf8").split())
+
+    def event(self, channel, fields):
+        """
+        apply a sentinel event, fields are the words of the message
+        """
+        redis = self.redis
+        if channel == "+switch-master":
+            # <master name> <old ip> <old port> <new ip> <new port>
+            if fields[0] == redis.service_name:
+                self._switch((fields[3], int(fields[4])))
+        elif channel in ("+sdown", "-sdown"):
+            # <instance type> <name> <ip> <port> [@ <master name> ...]
+            addr = (fields[2], int(fields[3]))
+            if channel == "+sdown":
+                self.down.add(addr)
+            else:
+                self.down.discard(addr)
+                if fields[0] == "slave" and redis.replicas is not None:
+                    redis.replicas.invalidate()
+        elif channel == "+sentinel":
+            # sentinel <name> <ip> <port> @ <master name> <ip> <port>
+            if len(fields) > 5 and fields[5] != redis.service_name:
+                return
+            addr = (fields[2], int(fields[3]))
+            with redis._sentinel_lock:
+                if any((node.host, node.port) == addr
+                       for node in redis.sentinels):
+                    return
+                from .desir3 import DEFAULT_SENTINEL_TIMEOUT, Node
+                redis.sentinels.append(
+                    Node(addr[0], addr[1], 0, None,
+                         redis.timeout or DEFAULT_SENTINEL_TIMEOUT))
+            if redis.debug:
+                print("discovered sentinel %s %d" % addr)
+
+    def close(self):
+        self._closed = True
+        if self._node is not None:
+            self._node.disconnect()
@@ -35,8 +35,11 @@ try:
 except ImportError:
     import json
 import time
-from uuid import uuid4
 import os
+import threading
+import traceback
+
+from .resp import RedisError, arg_bytes
 
 
 class ConnectorError(Exception):
@@ -64,11 +67,22 @@ class SWM(dict):
 
 
 class ConnectorProxy(object):
+    """
+    proxy.func(*args) calls func on the worker and waits for its result,
+    proxy.func_async(*args) returns a concurrent.futures.Future of it
+    """
     def __init__(self, connector, remotename):
         self.connector = connector
         self.remotename = remotename
 
     def __getattr__(self, item):
+        if item.endswith("_async"):
+            def func(*args, **kwargs):
+                return self.connector.run_async(self.remotename,
+                                                item[:-6],
+                                                *args, **kwargs)
+            return func
+
         def func(*args, **kwargs):
             return self.connector.run(self.remotename,
                                       item,
@@ -79,9 +93,56 @@ class ConnectorProxy(object):
         return self.connector.run(self.remotename, '__dir__')
 
 
+def _resolve(future, value, exception):
+    """
+    set the outcome of a concurrent.futures or asyncio future
+    """
+    if hasattr(future, "get_loop"):
+        try:
+            future.get_loop().call_soon_threadsafe(
+                _resolve_aio, future, value, exception)
+        except RuntimeError:
+            # loop closed
+            pass
+    elif future.set_running_or_notify_cancel():
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(value)
+
+
+def _resolve_aio(future, value, exception):
+    if future.done():
+        # cancelled
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(value)
+
+
 class Counter:
-    def __init__(self, name, seed=0):
+    """
+    Unique counter shared by every client of the redis instance, each
+    next() gives a new value (seed + 1 first).
+
+    With block set, values are reserved block ids at a time with a single
+    INCRBY and handed out locally, the block size then doubles up to
+    max_block while blocks last less than REFILL_INTERVAL seconds and
+    halves back when they last much longer. Values stay unique across
+    clients but are no longer consecutive between them.
+    """
+
+    # target duration of a reserved block (in seconds)
+    REFILL_INTERVAL = 0.1
+
+    def __init__(self, name, seed=0, block=None, max_block=65536):
         self.name = name
+        self.block = block
+        self.max_block = max_block
+        self._next, self._last = 1, 0
+        self._refilled = None
+        self._lock = threading.Lock()
         if seed is not None:
             self._redis.set(self.name, seed)
 
@@ -95,7 +156,26 @@ class Counter:
         return self._redis.get(self.name)
 
     def __next__(self):
-        return self._redis.incr(self.name)
+        if not self.block:
+            return self._redis.incr(self.name)
+        with self._lock:
+            if self._next > self._last:
+                self._reserve()
+            value = self._next
+            self._next += 1
+            return value
+
+    def _reserve(self):
+        now = time.monotonic()
+        if self._refilled is not None:
+            elapsed = now - self._refilled
+            if elapsed < self.REFILL_INTERVAL:
+                self.block = min(self.block * 2, self.max_block)
+            elif elapsed > 4 * self.REFILL_INTERVAL and self.block > 1:
+                self.block //= 2
+        self._refilled = now
+        self._last = self._redis.incrby(self.name, self.block)
+        self._next = self._last - self.block + 1
 
 
 class String(object):
@@ -119,8 +199,10 @@ class Connector(object):
     CONNECTORNAME:PID:TIMESTAMP
     """
     def __init__(self, name=None, ctype="", timeout=0, fifo=True,
-                 safe=False, secret=None, serializer=json):
+                 safe=False, secret=None, serializer=json, codec=None,
+                 codecs=None):
         if name is None:
+            from uuid import uuid4
             self.name = str(uuid4())
         else:
             self.name = name
@@ -137,8 +219,39 @@ class Connector(object):
         self.ctype = ctype
         self.secret = secret
         self.serializer = serializer
+        # messages are json documents made with serializer, or binary
+        # envelopes when a codec (name or desir.codec.Codec) is given
+        # received envelopes are only decoded with codec, or with those of
+        # codecs when given: the sender does not choose (pickle runs code)
+        self.codec = None
+        self._codecs = {}
+        if codec is not None or codecs is not None:
+            from .codec import accepted_codecs, get_codec
+            if codec is not None:
+                self.codec = get_codec(codec)
+            if codecs is None:
+                codecs = [self.codec]
+            self._codecs = accepted_codecs(codecs)
+        # HMAC state of the secret, copied for each message
+        self._hmac = None
+        if secret:
+            import hashlib
+            import hmac
+            if type(secret) is str:
+                secret = secret.encode("utf-8")
+            self._hmac = hmac.new(secret, digestmod=hashlib.sha1)
         self.pipeline = None
         self.callback = {}
+        # gauges of worker(concurrency=...)
+        self.inflight = 0
+        self.processed = 0
+        # calls in flight: replies are all sent to one queue read by a
+        # background thread, correlation id -> (future, deadline)
+        self._replies = None
+        self._pending = {}
+        self._cid = 0
+        self._reader = None
+        self._lock = threading.Lock()
 
     def register(self, func):
         # def wrapper(*args, **kwargs):
@@ -157,12 +270,48 @@ class Connector(object):
         return self
 
     def sendreceive(self, name, val=None, timeout=0, funcname=None):
+        from uuid import uuid4
         srcreply = "%s:%s:%s" % (self.name, str(time.time()), str(uuid4()))
         self.send(name, val, srcreply, funcname=funcname)
         return self.receive(timeout=timeout, srcreply=srcreply)
 
     def send(self, name, val=None, srcreply=None, funcname=None,
-             exception=False):
+             exception=False, cid=None):
+        vp = self._encode(name, val, srcreply, funcname, exception, cid)
+        if self.fifo:
+            return self.redis.lpush(name, vp)
+        else:
+            return self.redis.rpush(name, vp)
+
+    def send_many(self, name, values, funcname=None):
+        """
+        send a message per value of values with a single variadic push
+        """
+        vps = [self._encode(name, val, None, funcname, False)
+               for val in values]
+        if not vps:
+            return None
+        if self.fifo:
+            return self.redis.lpush(name, *vps)
+        else:
+            return self.redis.rpush(name, *vps)
+
+    def _encode(self, name, val, srcreply, funcname, exception, cid=None):
+        if self.codec is not None:
+            from .codec import pack_envelope
+            vp = pack_envelope(self.codec, srcreply or self.name, self.ctype,
+                               name, time.time(), val, funcname, exception,
+                               cid)
+        else:
+            vp = self._serialize(name, val, srcreply, funcname, exception,
+                                 cid)
+        if self._hmac is not None:
+            vs = self._hmac.copy()
+            vs.update(vp)
+            vp = vs.digest() + vp
+        return vp
+
+    def _serialize(self, name, val, srcreply, funcname, exception, cid):
         if srcreply:
             vd = SWM(src=srcreply, srctype=self.ctype,
                      dst=name, time=time.time(), val=val)
@@ -176,58 +325,123 @@ class Connector(object):
             vd.funcname = funcname
         if exception:
             vd.exception = True
+        if cid is not None:
+            vd.cid = cid
         vp = self.serializer.dumps(vd)
-        if self.secret:
-            import hashlib
-            vs = hashlib.sha1()
-            vs.update(vp)
-            vs.update(self.secret)
-            vp = vs.digest() + vp
-        if self.fifo:
-            return self.redis.lpush(vd.dst, vp)
-        else:
-            return self.redis.rpush(vd.dst, vp)
+        if type(vp) is str:
+            vp = vp.encode("utf-8")
+        return vp
+
+    def _tmpname(self):
+        return "%s:%d:%d" % (self.name, os.getpid(), int(time.time()))
+
+    def _pop(self, srcreply, tmpname, timeout):
+        if self.safe:
+            if timeout == -1:
+                return self.redis.rpoplpush(srcreply, tmpname)
+            return self.redis.brpoplpush(srcreply, tmpname, timeout)
+        if timeout == -1:
+            return self.redis.rpop(srcreply)
+        resp = self.redis.brpop(srcreply, timeout)
+        return resp and resp[1]
 
     def receive(self, timeout=0, srcreply=None):
-        tmpname = "%s:%d:%d" % (self.name, os.getpid(), int(time.time()))
+        tmpname = self._tmpname()
         if srcreply is None:
             srcreply = self.name
-        if self.safe:
-            if timeout == -1:
-                resp = self.redis.rpoplpush(srcreply, tmpname)
-            else:
-                resp = self.redis.brpoplpush(srcreply, tmpname, timeout)
-        else:
-            if timeout == -1:
-                resp = self.redis.rpop(srcreply)
+        return self._decode(self._pop(srcreply, tmpname, timeout), tmpname)
+
+    def receive_many(self, max_count, timeout=0, srcreply=None):
+        """
+        receive up to max_count messages at once, waiting up to timeout
+        for the first one only (-1 does not wait). In safe mode every
+        message is moved atomically to the tmp list as with receive.
+        """
+        tmpname = self._tmpname()
+        if srcreply is None:
+            srcreply = self.name
+        resps = []
+        if timeout != -1:
+            # block for the first message, take the others as available
+            resp = self._pop(srcreply, tmpname, timeout)
+            if not resp:
+                return []
+            resps.append(resp)
+            max_count -= 1
+        if max_count > 0:
+            resps.extend(self._popmany(srcreply, tmpname, max_count))
+        return [self._decode(resp, tmpname) for resp in resps]
+
+    # False once the server refused RPOP with a count (redis < 6.2)
+    _rpopcount = True
+
+    def _popmany(self, srcreply, tmpname, count):
+        if not self.safe and self._rpopcount:
+            try:
+                return self._redis.rpop(srcreply, count) or []
+            except RedisError:
+                self._rpopcount = False
+        pipeline = self._redis.pipeline()
+        for i in range(count):
+            if self.safe:
+                pipeline.rpoplpush(srcreply, tmpname)
             else:
-                resp = self.redis.brpop(srcreply, timeout)
-                resp = resp and resp[1]
+                pipeline.rpop(srcreply)
+        resps = []
+        for resp in pipeline.execute():
+            if isinstance(resp, RedisError):
+                raise resp
+            # a message pushed meanwhile can follow an empty pop
+            if resp is not None:
+                resps.append(resp)
+        return resps
+
+    def _decode(self, resp, tmpname):
         if resp:
-            if self.secret:
-                import hashlib
-                vs = hashlib.sha1()
-                vs.update(resp[20:])
-                vs.update(self.secret)
-                if resp[:20] != vs.digest():
+            raw = resp
+            if self._hmac is not None:
+                import hmac
+                vs = self._hmac.copy()
+                vs.update(memoryview(resp)[20:])
+                if not hmac.compare_digest(resp[:20], vs.digest()):
                     raise ConnectorError("Digest signature failed")
-                resp = resp[20:]
-            resp = self.serializer.loads(resp)
+                resp = memoryview(resp)[20:]
+            from .codec import is_envelope, unpack_envelope
+            if is_envelope(resp):
+                try:
+                    resp = unpack_envelope(resp, self._codecs)
+                except ValueError as e:
+                    raise ConnectorError("Rejected message: %s" % e)
+            else:
+                resp = self.serializer.loads(bytes(resp))
             if type(resp) is dict:
                 resp = SWM(resp)
             if self.safe:
+                # the tmp list entry is acknowledged by value, several
+                # messages can be in flight from one tmp list
                 resp["srcack"] = tmpname
+                resp["srcraw"] = bytes(raw)
         return resp
 
     def unreceive(self, val):
         if "srcack" in val:
-            return self._redis.rpoplpush(val.srcack, self.name)
+            if "srcraw" not in val:
+                return self._redis.rpoplpush(val.srcack, self.name)
+            pipeline = self._redis.pipeline(transaction=True)
+            pipeline.lrem(val.srcack, 1, val.srcraw)
+            pipeline.lpush(self.name, val.srcraw)
+            removed, n = pipeline.execute()
+            if not removed:
+                # already released or unreceived, take the copy back
+                self._redis.lrem(self.name, 1, val.srcraw)
+                return None
+            return val.srcraw
 
     def transfer(self, name, val, newval, force=True):
         res = None
         while not res:
             self.redis.watch(val.srcack)
-            self.pipeline = self.redis.pipeline()
+            self.pipeline = self.redis.pipeline(transaction=True)
             self.release(val)
             self.send(name, newval)
             res = self.pipeline.execute()
@@ -241,16 +455,30 @@ class Connector(object):
         while not res:
             if "srcack" in val:
                 self.redis.watch(val.srcack)
-            self.pipeline = self.redis.pipeline()
+            self.pipeline = self.redis.pipeline(transaction=True)
             self.release(val)
-            self.send(val.src, newval, exception=exception)
+            self.send(val.src, newval, exception=exception,
+                      cid=val.get("cid"))
             res = self.pipeline.execute()
             self.pipeline = None
             if not force:
                 break
         return res
 
-    def worker(self, is_running=lambda: True):
+    # seconds the dispatcher of a worker pool waits for a task to complete
+    # when there is nothing else to do
+    POLL_INTERVAL = 0.05
+
+    def worker(self, is_running=lambda: True, concurrency=None,
+               executor="thread"):
+        """
+        serve the registered functions. With concurrency, up to that many
+        calls run at once on a pool ("thread", "process" or an Executor),
+        messages are prefetched to keep it busy and replies are sent in
+        completion order, one pipeline per batch of completed calls.
+        """
+        if concurrency:
+            return self._poolworker(is_running, concurrency, executor)
         while is_running():
             res = self.receive(timeout=1)
             if res:
@@ -272,22 +500,237 @@ class Connector(object):
                                "No such function name %s" % (res.funcname),
                                exception=True)
 
+    def _poolworker(self, is_running, concurrency, executor):
+        import queue
+        from concurrent import futures
+        if executor == "thread":
+            pool = futures.ThreadPoolExecutor(concurrency)
+        elif executor == "process":
+            pool = futures.ProcessPoolExecutor(concurrency)
+        else:
+            pool = None
+        done = queue.Queue()
+        running = True
+        try:
+            while True:
+                running = running and is_running()
+                if not running and not self.inflight:
+                    break
+                received = []
+                if running and self.inflight < concurrency:
+                    # only block when there is nothing running
+                    received = self.receive_many(
+                        concurrency - self.inflight,
+                        timeout=-1 if self.inflight else 1)
+                completed = []
+                for res in received:
+                    if res.funcname in self.callback:
+                        future = (pool or executor).submit(
+                            self.callback[res.funcname],
+                            *res.val.get("args", []),
+                            **res.val.get("kwargs", {}))
+                        self.inflight += 1
+                        future.add_done_callback(
+                            lambda f, res=res: done.put((res, f)))
+                    elif res.funcname == '__dir__':
+                        completed.append(
+                            (res, list(self.callback.keys()), False))
+                    else:
+                        completed.append(
+                            (res, "No such function name %s" % (
+                                res.funcname), True))
+                wait = self.inflight and not received and not completed
+                while self.inflight:
+                    try:
+                        res, future = done.get(
+                            timeout=self.POLL_INTERVAL if wait else 0)
+                    except queue.Empty:
+                        break
+                    wait = False
+                    self.inflight -= 1
+                    try:
+                        completed.append((res, future.result(), False))
+                    except Exception as e:
+                        completed.append((res, repr(e), True))
+                if completed:
+                    self._replymany(completed)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def _replymany(self, completed):
+        """
+        acknowledge and reply a batch of (message, value, exception) in
+        one pipeline, a transaction in safe mode
+        """
+        self.pipeline = self._redis.pipeline(transaction=self.safe)
+        try:
+            for res, value, exception in completed:
+                self.release(res)
+                self.send(res.src, value, exception=exception,
+                          cid=res.get("cid"))
+            self.pipeline.execute()
+        finally:
+            self.pipeline = None
+        self.processed += len(completed)
+
+    def queue_depth(self):
+        return self._redis.llen(self.name)
+
+    def gauges(self):
+        return dict(queue_depth=self.queue_depth(), inflight=self.inflight,
+                    processed=self.processed)
+
     def run(self, name, funcname, *args, **kwargs):
-        val = dict(args=args, kwargs=kwargs)
-        res = self.sendreceive(name, val=val,
-                               timeout=self.timeout,
-                               funcname=funcname)
-        if res is None and self.timeout:
-            raise ConnectorError("Timeout")
-        if res.get("exception"):
-            raise ConnectorError("Error on worker side: %s" % (res.val))
-        return res.val
+        return self.run_async(name, funcname, *args, **kwargs).result()
+
+    def run_async(self, name, funcname, *args, **kwargs):
+        """
+        call funcname on worker name without waiting for the result, given
+        by the returned concurrent.futures.Future. The replies of every call
+        go to a single queue of this Connector, read by a background thread
+        which resolves the futures by correlation id. Calls fail with a
+        ConnectorError after timeout seconds when it is set.
+        """
+        from concurrent.futures import Future
+        future = Future()
+        self._call(name, funcname, args, kwargs, future)
+        return future
+
+    async def arun(self, name, funcname, *args, **kwargs):
+        """
+        run as a coroutine, the call is resolved on the running loop
+        """
+        import asyncio
+        future = asyncio.get_running_loop().create_future()
+        self._call(name, funcname, args, kwargs, future)
+        return await future
+
+    # replies taken at once by the reply reader
+    REPLY_BATCH = 100
+
+    def _call(self, name, funcname, args, kwargs, future):
+        deadline = None
+        if self.timeout:
+            deadline = time.monotonic() + self.timeout
+        with self._lock:
+            if self._replies is None:
+                from uuid import uuid4
+                self._replies = "%s:%d:%s" % (self.name, os.getpid(),
+                                              uuid4())
+            self._cid += 1
+            cid = self._cid
+            self._pending[cid] = (future, deadline)
+            if self._reader is None:
+                self._reader = threading.Thread(target=self._readreplies)
+                self._reader.daemon = True
+                self._reader.start()
+        try:
+            self.send(name, dict(args=args, kwargs=kwargs), self._replies,
+                      funcname=funcname, cid=cid)
+        except BaseException:
+            with self._lock:
+                self._pending.pop(cid, None)
+            raise
+
+    def _readreplies(self):
+        """
+        resolve the calls in flight, stops when there are none left
+        """
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._reader = None
+                    return
+                batch = len(self._pending) > 1
+            try:
+                resps = self._receivereplies(1, batch)
+            except Exception as e:
+                # connection lost, fail every call in flight
+                with self._lock:
+                    pending, self._pending = self._pending, {}
+                    self._reader = None
+                for future, deadline in pending.values():
+                    _resolve(future, None, e)
+                return
+            now = time.monotonic()
+            with self._lock:
+                resolved = []
+                for res in resps:
+                    cid = res.get("cid")
+                    if cid is None:
+                        # from a worker ignoring correlation ids: it can
+                        # only be matched when a single call is in flight
+                        if len(self._pending) == 1:
+                            cid, = self._pending
+                        else:
+                            error = ConnectorError(
+                                "Reply without correlation id with %d "
+                                "calls in flight, the worker does not "
+                                "support concurrent calls" % (
+                                    len(self._pending)))
+                            for future, deadline in self._pending.values():
+                                resolved.append((future, error))
+                            self._pending.clear()
+                            continue
+                    resolved.append((self._pending.pop(cid, (None,))[0],
+                                     res))
+                expired = [cid for cid, (future, deadline)
+                           in self._pending.items()
+                           if deadline is not None and deadline < now]
+                for cid in expired:
+                    resolved.append((self._pending.pop(cid)[0], None))
+            for future, res in resolved:
+                # replies of expired calls are dropped
+                if future is None:
+                    continue
+                if res is None:
+                    _resolve(future, None, ConnectorError("Timeout"))
+                elif type(res) is ConnectorError:
+                    _resolve(future, None, res)
+                elif res.get("exception"):
+                    _resolve(future, None, ConnectorError(
+                        "Error on worker side: %s" % (res.val)))
+                else:
+                    _resolve(future, res.val, None)
+
+    def _receivereplies(self, timeout, batch):
+        """
+        decoded replies waiting in the reply queue
+        """
+        resp = self._redis.brpop(self._replies, timeout)
+        if not resp:
+            return []
+        resps = [resp[1]]
+        if batch and self._rpopcount:
+            try:
+                resps.extend(self._redis.rpop(self._replies,
+                                              self.REPLY_BATCH) or [])
+            except RedisError:
+                self._rpopcount = False
+        replies = []
+        for resp in resps:
+            try:
+                replies.append(self._decode(resp, None))
+            except Exception:
+                # dropped alone, the other replies are still delivered
+                traceback.print_exc()
+        return replies
 
     def proxy(self, name):
         return ConnectorProxy(self, name)
 
+    def close(self):
+        """
+        delete the reply queue of the calls made by this connector
+        """
+        if self._replies is not None:
+            self._redis.delete(self._replies)
+
     def release(self, val):
         if "srcack" in val:
+            if "srcraw" in val:
+                return self.pipeline.lrem(val.srcack, 1, val.srcraw)
             return self.pipeline.rpop(val.srcack)
 
     def __next__(self):
@@ -298,9 +741,212 @@ class Connector(object):
             raise StopIteration
 
 
+class StreamConnector(Connector):
+    """
+    Connector carried by redis streams and consumer groups instead of
+    lists: messages are added with XADD (trimmed with MAXLEN ~ maxlen when
+    set), read in batches with XREADGROUP and acknowledged with XACK (and
+    deleted) when replied, in the same transaction as the reply. Entries
+    left pending by a consumer for more than claim_idle seconds are taken
+    over with XAUTOCLAIM. Replies go to a private stream read with XREAD
+    and deleted.
+    """
+
+    def __init__(self, name=None, ctype="", timeout=0, group="desir",
+                 consumer=None, maxlen=None, claim_idle=60, secret=None,
+                 serializer=json, codec=None, codecs=None):
+        Connector.__init__(self, name, ctype, timeout, True, True, secret,
+                           serializer, codec, codecs)
+        self.group = group
+        self.consumer = consumer or "%s:%d" % (self.name, os.getpid())
+        self.maxlen = maxlen
+        self.claim_idle = claim_idle
+        self._claimed = time.monotonic()
+        self._replyid = "0-0"
+
+    def send(self, name, val=None, srcreply=None, funcname=None,
+             exception=False, cid=None):
+        return self._xadd(name, [self._encode(name, val, srcreply, funcname,
+                                              exception, cid)])
+
+    def send_many(self, name, values, funcname=None):
+        return self._xadd(name, [self._encode(name, val, None, funcname,
+                                              False) for val in values])
+
+    def _xadd(self, name, vps):
+        options = ()
+        if self.maxlen is not None:
+            options = ("MAXLEN", "~", self.maxlen)
+        if len(vps) == 1:
+            return self.redis.xadd(name, *(options + ("*", "m", vps[0])))
+        pipeline = self.redis
+        if self.pipeline is None:
+            pipeline = self._redis.pipeline()
+        for vp in vps:
+            pipeline.xadd(name, *(options + ("*", "m", vp)))
+        if self.pipeline is None:
+            return pipeline.execute()
+
+    def _block(self, timeout):
+        if timeout == -1:
+            return ()
+        return ("BLOCK", int(timeout * 1000))
+
+    def _messages(self, stream, entries, dropbad=False):
+        messages = []
+        for entry in entries:
+            # entries deleted while pending come back empty
+            if not entry or not entry[1]:
+                continue
+            fields = entry[1]
+            if type(fields) is list:
+                fields = dict(zip(fields[::2], fields[1::2]))
+            try:
+                resp = self._decode(fields[b"m"], None)
+            except Exception:
+                if not dropbad:
+                    raise
+                traceback.print_exc()
+                continue
+            resp["srcack"] = entry[0]
+            resp["srcstream"] = stream
+            messages.append(resp)
+        return messages
+
+    def _streams(self, reply, dropbad=False):
+        if not reply:
+            return []
+        if type(reply) is dict:
+            # RESP3 map
+            reply = reply.items()
+        messages = []
+        for stream, entries in reply:
+            messages.extend(self._messages(stream, entries, dropbad))
+        return messages
+
+    def receive(self, timeout=0, srcreply=None):
+        if srcreply is None:
+            messages = self.receive_many(1, timeout)
+            return messages[0] if messages else None
+        # private reply stream
+        reply = self._redis.xread(*(("COUNT", 1) + self._block(timeout) +
+                                    ("STREAMS", srcreply, 0)))
+        self._redis.delete(srcreply)
+        messages = self._streams(reply)
+        return messages[0] if messages else None
+
+    def receive_many(self, max_count, timeout=0, srcreply=None):
+        if time.monotonic() - self._claimed > self.claim_idle:
+            messages = self.claim_stalled(max_count)
+            if messages:
+                return messages
+        args = (("GROUP", self.group, self.consumer, "COUNT", max_count) +
+                self._block(timeout) + ("STREAMS", srcreply or self.name, ">"))
+        try:
+            reply = self._redis.xreadgroup(*args)
+        except RedisError as e:
+            if not str(e).startswith("NOGROUP"):
+                raise
+            self.create_group(srcreply or self.name)
+            reply = self._redis.xreadgroup(*args)
+        return self._streams(reply)
+
+    def create_group(self, name=None):
+        """
+        create the consumer group of the stream, from its first entry
+        """
+        try:
+            self._redis.xgroup("CREATE", name or self.name, self.group, 0,
+                               "MKSTREAM")
+        except RedisError as e:
+            if not str(e).startswith("BUSYGROUP"):
+                raise
+
+    def claim_stalled(self, count=100):
+        """
+        take over entries pending for more than claim_idle seconds with
+        XAUTOCLAIM (redis >= 6.2)
+        """
+        self._claimed = time.monotonic()
+        try:
+            reply = self._redis.runcmd(
+                "XAUTOCLAIM", self.name, self.group, self.consumer,
+                int(self.claim_idle * 1000), "0-0", "COUNT", count)
+        except RedisError as e:
+            if str(e).startswith("NOGROUP"):
+                return []
+            raise
+        return self._messages(self.name, reply[1])
+
+    def release(self, val):
+        if "srcack" in val:
+            self.redis.xack(val.srcstream, self.group, val.srcack)
+            return self.redis.xdel(val.srcstream, val.srcack)
+
+    def unreceive(self, val):
+        if "srcack" in val:
+            pipeline = self._redis.pipeline(transaction=True)
+            pipeline.xack(val.srcstream, self.group, val.srcack)
+            pipeline.xdel(val.srcstream, val.srcack)
+            pipeline.xadd(val.srcstream, "*", "m", self._encode(
+                val.dst, val.val, val.src, val.get("funcname"),
+                val.get("exception", False), val.get("cid")))
+            return pipeline.execute()
+
+    def transfer(self, name, val, newval, force=True):
+        return self.reply(val, newval, dst=name)
+
+    def reply(self, val, newval, force=True, exception=False, dst=None):
+        self.pipeline = self._redis.pipeline(transaction=True)
+        try:
+            self.release(val)
+            self.send(dst or val.src, newval, exception=exception,
+                      cid=None if dst else val.get("cid"))
+            return self.pipeline.execute()
+        finally:
+            self.pipeline = None
+
+    def _receivereplies(self, timeout, batch):
+        # the reply stream is read from the last reply received, entries
+        # are deleted once read
+        reply = self._redis.xread(
+            "COUNT", self.REPLY_BATCH, "BLOCK", int(timeout * 1000),
+            "STREAMS", self._replies, self._replyid)
+        if not reply:
+            return []
+        if type(reply) is dict:
+            reply = list(reply.items())
+        # replies that cannot be decoded are dropped, skipped all the same
+        ids = [entry[0] for stream, entries in reply
+               for entry in entries if entry]
+        messages = self._streams(reply, dropbad=True)
+        if ids:
+            self._replyid = ids[-1]
+            self._redis.xdel(self._replies, *ids)
+        return messages
+
+    def queue_depth(self):
+        return self._redis.xlen(self.name)
+
+
 class Hash(object):
-    def __init__(self, name):
+    """
+    Redis hash whose fields are attributes.
+
+    By default every attribute read or write is a HGET/HSET. With
+    buffered=True the fields are loaded at once on first read (HMGET of
+    fields when given, HGETALL otherwise, HSCAN with scan=True for large
+    hashes), writes are kept locally and sent in a single HSET by save(),
+    which is also called when leaving a with block without error.
+    """
+
+    def __init__(self, name, buffered=False, fields=None, scan=False):
         self._keyid = name
+        self._buffered = buffered
+        self._fields = fields
+        self._scan = scan
+        self._data = None
+        self._dirty = {}
 
     def __repr__(self):
         return str(self.items())
@@ -308,7 +954,13 @@ class Hash(object):
     def __getattr__(self, item):
         if item.startswith("_"):
             return object.__getattribute__(self, item)
-        resp = self._redis.hget(self._keyid, item)
+        if self._buffered:
+            field = arg_bytes(item)
+            if field in self._dirty:
+                return arg_bytes(self._dirty[field])
+            resp = self.load().get(field)
+        else:
+            resp = self._redis.hget(self._keyid, item)
         if resp:
             return resp
         else:
@@ -318,16 +970,81 @@ class Hash(object):
     def __setattr__(self, item, value):
         if item.startswith("_"):
             return object.__setattr__(self, item, value)
+        elif self._buffered:
+            self._dirty[arg_bytes(item)] = value
         else:
             self._redis.hset(self._keyid, item, value)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.save()
+
+    def __iter__(self):
+        """
+        (field, value) pairs read with HSCAN
+        """
+        return self._redis.hscan_iter(self._keyid)
+
+    def load(self):
+        """
+        local copy of the fields (by bytes name as HGETALL gives them),
+        read in one round trip
+        """
+        if self._data is None:
+            if self._fields:
+                resp = self._redis.hmget(self._keyid, *self._fields)
+                pairs = [(arg_bytes(f), v)
+                         for f, v in zip(self._fields, resp)
+                         if v is not None]
+            elif self._scan:
+                pairs = self._redis.hscan_iter(self._keyid)
+            else:
+                resp = self._redis.hgetall(self._keyid) or []
+                if type(resp) is dict:
+                    pairs = resp.items()
+                else:
+                    pairs = zip(resp[::2], resp[1::2])
+            self._data = dict(pairs)
+        return self._data
+
+    def save(self):
+        """
+        send the locally modified fields in a single HSET
+        """
+        if not self._dirty:
+            return
+        args = []
+        for item, value in self._dirty.items():
+            args.extend((item, value))
+        self._redis.hset(self._keyid, *args)
+        if self._data is not None:
+            # as they would be read back
+            for item, value in self._dirty.items():
+                self._data[item] = arg_bytes(value)
+        self._dirty = {}
+
     def keys(self):
+        if self._buffered:
+            return list(set(self.load()) | set(self._dirty))
         return self._redis.hkeys(self._keyid)
 
     def values(self):
+        if self._buffered:
+            return [v for k, v in self.items()]
         return self._redis.hvals(self._keyid)
 
     def items(self):
+        if self._buffered:
+            data = dict(self.load())
+            for field, value in self._dirty.items():
+                data[field] = arg_bytes(value)
+            return data.items()
         resp = self._redis.hgetall(self._keyid)
         if resp:
+            if type(resp) is dict:
+                # RESP3 map
+                return resp.items()
             return zip(resp[::2], resp[1::2])
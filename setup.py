@@ -22,7 +22,7 @@ sdict = {
     'maintainer_email': 'abdelkader.allam@gmail.com',
     'keywords': ['Redis', 'key-value store'],
     'license': 'New BSD License',
-    'packages': ['desir'],
+    'packages': ['desir', 'desir.bench'],
     'package_data': {
         '': ['*.json'],
     },
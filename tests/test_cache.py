@@ -0,0 +1,48 @@
+"""
+Client side caching against the bench stand-in server, which sends no
+invalidation messages: a client must still read its own writes.
+"""
+
+import unittest
+
+from desir import Redis
+from desir.bench import StandinServer
+
+
+class OwnWritesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandinServer()
+        host, port = self.server.start()
+        self.redis = Redis(host, port, client_cache=100)
+
+    def tearDown(self):
+        self.redis.cache.close()
+        self.server.stop()
+
+    def test_set_get(self):
+        r = self.redis
+        r.set("a", "1")
+        self.assertEqual(r.get("a"), b"1")
+        self.assertEqual(r.get("a"), b"1")
+        self.assertEqual(r.cache.stats()["hits"], 1)
+        r.set("a", "2")
+        self.assertEqual(r.get("a"), b"2")
+
+    def test_pipeline(self):
+        r = self.redis
+        r.set("b", "1")
+        self.assertEqual(r.get("b"), b"1")
+        r.pipeline().set("b", "2").incr("b").execute()
+        self.assertEqual(r.get("b"), b"3")
+
+    def test_delete(self):
+        r = self.redis
+        r.set("c", "1")
+        self.assertEqual(r.get("c"), b"1")
+        r.delete("c")
+        self.assertIsNone(r.get("c"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+"""
+Connector calls resolved by the reply reader, on the memory backend.
+"""
+
+import threading
+import unittest
+
+from desir import Redis
+
+
+class ReplyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Redis(backend="memory")
+        self.client = self.redis.Connector()
+
+    def serve(self, count, before=None):
+        worker = self.redis.Connector("worker")
+        messages = [worker.receive(timeout=2) for i in range(count)]
+        if before is not None:
+            before()
+        for msg in messages:
+            worker.reply(msg, msg.val["args"][0] * 2)
+
+    def calls(self, count, before=None):
+        futures = [self.client.run_async("worker", "double", i)
+                   for i in range(count)]
+        worker = threading.Thread(target=self.serve, args=(count, before))
+        worker.start()
+        worker.join()
+        return [future.result(timeout=2) for future in futures]
+
+    def test_replies(self):
+        self.assertEqual(self.calls(3), [0, 2, 4])
+
+    def test_bad_reply(self):
+        def garbage():
+            self.redis.lpush(self.client._replies, b"{not json")
+        self.assertEqual(self.calls(3, garbage), [0, 2, 4])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,283 @@
+"""
+The memory backend replies as a server would, and the client features
+built on top of it (pipelines, transactions, listen, PubSub, Counter,
+Hash and Connector) work unchanged.
+"""
+
+import threading
+import time
+import unittest
+
+from desir import MemoryBackend, Redis, RedisError
+
+
+class MemoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Redis(backend=MemoryBackend())
+
+    def client(self):
+        # another connection to the same databases
+        return Redis(backend=self.redis.backend)
+
+
+class CommandsTest(MemoryTest):
+
+    def test_strings(self):
+        r = self.redis
+        self.assertEqual(r.set("a", "1"), b"OK")
+        self.assertEqual(r.get("a"), b"1")
+        self.assertEqual(r.incr("a"), 2)
+        self.assertEqual(r.incrbyfloat("a", 0.5), b"2.5")
+        self.assertIsNone(r.set("a", "z", "NX"))
+        self.assertEqual(r.mset("x", 1, "y", 2), b"OK")
+        self.assertEqual(r.mget("x", "y", "z"), [b"1", b"2", None])
+        self.assertIsNone(r.get("missing"))
+
+    def test_expiry(self):
+        r = self.redis
+        r.set("e", "v", "EX", 100)
+        self.assertTrue(99 <= r.ttl("e") <= 100)
+        r.pexpire("e", 1)
+        time.sleep(0.01)
+        self.assertIsNone(r.get("e"))
+        self.assertEqual(r.ttl("e"), -2)
+
+    def test_containers(self):
+        r = self.redis
+        self.assertEqual(r.hset("h", "f", 1, "g", 2), 2)
+        self.assertEqual(r.hgetall("h"), [b"f", b"1", b"g", b"2"])
+        self.assertEqual(r.rpush("l", 1, 2, 3), 3)
+        self.assertEqual(r.lrange("l", 0, -1), [b"1", b"2", b"3"])
+        self.assertEqual(r.rpop("l", 5), [b"3", b"2", b"1"])
+        self.assertEqual(r.exists("l"), 0)
+        self.assertEqual(r.sadd("s", "a", "b", "a"), 2)
+        self.assertEqual(sorted(r.smembers("s")), [b"a", b"b"])
+        self.assertEqual(r.zadd("z", 1, "a", 2.5, "b", 2, "c"), 3)
+        self.assertEqual(r.zrange("z", 0, -1, "WITHSCORES"),
+                         [b"a", b"1", b"c", b"2", b"b", b"2.5"])
+        self.assertEqual(r.zrangebyscore("z", "(1", "+inf"), [b"c", b"b"])
+
+    def test_errors(self):
+        r = self.redis
+        r.hset("h", "f", 1)
+        self.assertRaisesRegex(RedisError, "^WRONGTYPE", r.get, "h")
+        self.assertRaisesRegex(RedisError, "wrong number of arguments",
+                               r.runcmd, "GET")
+        self.assertRaisesRegex(RedisError, "wrong number of arguments",
+                               r.runcmd, "MSET", "a")
+        self.assertRaisesRegex(RedisError, "not implemented",
+                               r.runcmd, "XADD", "st", "*", "a", 1)
+
+    def test_databases(self):
+        r = self.redis
+        r.set("k", "zero")
+        r.select(2)
+        self.assertIsNone(r.get("k"))
+        r.set("k", "two")
+        r.select(0)
+        self.assertEqual(r.get("k"), b"zero")
+
+    def test_blocking_pop(self):
+        def push():
+            time.sleep(0.05)
+            self.client().lpush("q", "job")
+        threading.Thread(target=push).start()
+        self.assertEqual(self.redis.brpop("q", 2), [b"q", b"job"])
+        self.assertIsNone(self.redis.brpop("q", 0.05))
+
+    def test_get_into(self):
+        r = self.redis
+        r.set("b", b"hello")
+        out = bytearray(8)
+        self.assertEqual(r.get_into("b", out), 5)
+        self.assertEqual(out[:5], b"hello")
+
+
+class ScanTest(MemoryTest):
+
+    def test_scan(self):
+        r = self.redis
+        keys = set(b"k%04d" % i for i in range(1000))
+        r.mset(*[v for key in keys for v in (key, 1)])
+        r.hset("h", "f", 1)
+        self.assertEqual(set(r.scan_iter(count=7)), keys | {b"h"})
+        self.assertEqual(list(r.scan_iter(type="hash")), [b"h"])
+        self.assertEqual(sorted(r.scan_iter(match="k000*")),
+                         sorted(k for k in keys if k < b"k0010"))
+
+    def test_changes_during_scan(self):
+        # keys there for the whole scan are all seen, once
+        r = self.redis
+        kept = [b"k%04d" % i for i in range(0, 1000, 2)]
+        r.mset(*[v for key in kept for v in (key, 1)])
+        seen = []
+        for i, key in enumerate(r.scan_iter(count=10)):
+            seen.append(key)
+            r.set(b"k%04d" % (2 * i + 1), 1)
+            r.set(b"a%04d" % i, 1)
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertTrue(set(kept) <= set(seen))
+
+    def test_containers(self):
+        r = self.redis
+        r.hset("h", *[v for i in range(100) for v in (b"f%d" % i, i)])
+        r.sadd("s", *range(100))
+        r.zadd("z", *[v for i in range(100) for v in (i, b"m%d" % i)])
+        self.assertEqual(len(dict(r.hscan_iter("h", count=7))), 100)
+        self.assertEqual(len(set(r.sscan_iter("s", count=7))), 100)
+        self.assertEqual(dict(r.zscan_iter("z", count=7))[b"m42"], b"42")
+
+    def test_invalid_cursor(self):
+        self.assertRaisesRegex(RedisError, "invalid cursor",
+                               self.redis.scan, 12345)
+
+
+class TransactionTest(MemoryTest):
+
+    def test_pipeline(self):
+        r = self.redis
+        r.set("x", 1)
+        self.assertEqual(r.pipeline().incr("x").get("x").execute(),
+                         [2, b"2"])
+
+    def test_transaction(self):
+        r = self.redis
+        p = r.pipeline(True)
+        p.set("t", 1)
+        p.incr("t")
+        p.get("t")
+        self.assertEqual(p.execute(), [b"OK", 2, b"2"])
+
+    def test_watch(self):
+        r = self.redis
+        r.set("x", 1)
+        r.watch("x")
+        self.client().set("x", 100)
+        p = r.pipeline(True)
+        p.incr("x")
+        self.assertIsNone(p.execute())
+        self.assertEqual(r.get("x"), b"100")
+
+    def test_queued_error(self):
+        r = self.redis
+        r.multi()
+        self.assertRaises(RedisError, r.runcmd, "GET")
+        self.assertRaisesRegex(RedisError, "^EXECABORT", r.execute)
+
+
+class PubSubTest(MemoryTest):
+
+    def test_listen(self):
+        received = []
+        ready = threading.Event()
+
+        def listen():
+            s = self.client()
+            s.subscribe("ch")
+            ready.set()
+            for msg in s.listen():
+                received.append(msg)
+                if msg.data == b"stop":
+                    s.unsubscribe()
+        thread = threading.Thread(target=listen)
+        thread.start()
+        ready.wait(2)
+        self.assertEqual(self.redis.publish("ch", "hi"), 1)
+        self.redis.publish("ch", "stop")
+        thread.join(2)
+        self.assertEqual([(m.type, m.data) for m in received],
+                         [(b"message", b"hi"), (b"message", b"stop")])
+
+    def test_listen_batch(self):
+        s = self.client()
+        s.subscribe("q")
+        for i in range(5):
+            self.redis.publish("q", i)
+        batches = []
+        for batch in s.listen_batch(3, 0.05):
+            batches.append([m.data for m in batch])
+            if not batch:
+                s.unsubscribe("q")
+        self.assertEqual(batches[:3], [[b"0", b"1", b"2"], [b"3", b"4"], []])
+
+    def test_multiplexer(self):
+        received = []
+        done = threading.Event()
+
+        def callback(msg):
+            received.append(msg.data)
+            done.set()
+        pubsub = self.redis.pubsub()
+        try:
+            pubsub.subscribe("c2", callback)
+            deadline = time.monotonic() + 2
+            while not done.is_set() and time.monotonic() < deadline:
+                self.redis.publish("c2", "x")
+                done.wait(0.05)
+        finally:
+            pubsub.close()
+        self.assertEqual(received[0], b"x")
+
+
+class SugarTest(MemoryTest):
+
+    def test_counter(self):
+        r = self.redis
+        counter = r.Counter("cnt", 0)
+        self.assertEqual([next(counter), next(counter)], [1, 2])
+        blocks = r.Counter("cb", 0, block=4)
+        self.assertEqual([next(blocks) for i in range(6)],
+                         [1, 2, 3, 4, 5, 6])
+
+    def test_hash(self):
+        r = self.redis
+        h = r.Hash("hh")
+        h.a = 1
+        self.assertEqual(h.a, b"1")
+        buffered = r.Hash("hh", buffered=True)
+        buffered.b = 2
+        buffered.save()
+        self.assertEqual(r.hgetall("hh"), [b"a", b"1", b"b", b"2"])
+        self.assertEqual(r.Hash("hh", buffered=True, scan=True).b, b"2")
+
+    def test_hash_fields(self):
+        # buffered or not, field names are bytes as HGETALL gives them
+        r = self.redis
+        r.hset("hf", "a", 1)
+        for buffered in (False, True):
+            h = r.Hash("hf", buffered=buffered)
+            h.b = 2
+            self.assertEqual(h.b, b"2")
+            self.assertEqual(sorted(h.keys()), [b"a", b"b"])
+            self.assertEqual(dict(h.items()), {b"a": b"1", b"b": b"2"})
+            h.save()
+        fields = r.Hash("hf", buffered=True, fields=["a", "b"])
+        self.assertEqual(dict(fields.items()), {b"a": b"1", b"b": b"2"})
+
+    def test_connector(self):
+        r = self.redis
+
+        def add(a, b):
+            return a + b
+        worker = r.Connector("worker")
+        worker.register(add)
+        running = threading.Event()
+        running.set()
+        thread = threading.Thread(target=worker.worker,
+                                  args=(running.is_set,))
+        thread.start()
+        try:
+            client = r.Connector()
+            self.assertEqual(client.run("worker", "add", 2, 3), 5)
+            futures = [client.run_async("worker", "add", i, 1)
+                       for i in range(20)]
+            self.assertEqual([f.result(timeout=2) for f in futures],
+                             list(range(1, 21)))
+        finally:
+            running.clear()
+            thread.join(5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+Node.parse_pushes with both readers, fed by a bare listening socket.
+"""
+
+import socket
+import unittest
+
+from desir.desir3 import Node
+from desir.resp import RespReader, SocketReader
+
+
+def message(data):
+    return (b"*3\r\n$7\r\nmessage\r\n$1\r\nc\r\n$%d\r\n%s\r\n" % (
+        len(data), data))
+
+
+class ParsePushesTest(unittest.TestCase):
+
+    readerclass = RespReader
+
+    def setUp(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.node = Node("127.0.0.1", listener.getsockname()[1],
+                         readerclass=self.readerclass)
+        self.node.connect()
+        self.peer, _ = listener.accept()
+        listener.close()
+
+    def tearDown(self):
+        self.node.disconnect()
+        self.peer.close()
+
+    def test_timeout(self):
+        self.assertEqual(self.node.parse_pushes(10, 0.05), [])
+
+    def test_batch(self):
+        self.peer.sendall(b"".join(message(b"m%d" % i) for i in range(3)))
+        frames = []
+        while len(frames) < 3:
+            frames += self.node.parse_pushes(10, 1)
+        self.assertEqual([f[2] for f in frames], [b"m0", b"m1", b"m2"])
+        self.assertEqual(self.node.parse_pushes(10, 0.05), [])
+
+    def test_max_count(self):
+        self.peer.sendall(b"".join(message(b"m%d" % i) for i in range(3)))
+        self.assertEqual(self.node.parse_pushes(1)[0][2], b"m0")
+        self.assertEqual(self.node.parse_pushes(1)[0][2], b"m1")
+        self.assertEqual(self.node.parse_pushes(1, 1)[0][2], b"m2")
+
+
+class SocketReaderParsePushesTest(ParsePushesTest):
+
+    readerclass = SocketReader
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+RESP3 aggregates parsed by RespReader.gets, below and above the size
+where runs of bulk strings take the fast path, and the bytes counted
+when bulk strings are read straight into a caller buffer.
+"""
+
+import socket
+import threading
+import unittest
+
+from desir.resp import FASTPATH_MIN_ELEMENTS, NOREPLY, RespReader
+
+
+def bulk(value):
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def parse(data, chunk=None):
+    reader = RespReader()
+    chunk = chunk or len(data)
+    reply = NOREPLY
+    for i in range(0, len(data), chunk):
+        reader.feed(data[i:i + chunk])
+        reply = reader.gets()
+    return reader, reply
+
+
+class AggregateTest(unittest.TestCase):
+
+    sizes = (1, FASTPATH_MIN_ELEMENTS // 2 - 1, FASTPATH_MIN_ELEMENTS // 2,
+             FASTPATH_MIN_ELEMENTS - 1, FASTPATH_MIN_ELEMENTS,
+             4 * FASTPATH_MIN_ELEMENTS)
+
+    def items(self, n):
+        return [(b"field%d" % i, b"value%d" % i) for i in range(n)]
+
+    def test_map(self):
+        for n in self.sizes:
+            items = self.items(n)
+            data = b"%%%d\r\n" % n + b"".join(bulk(k) + bulk(v)
+                                              for k, v in items)
+            for chunk in (None, 7):
+                reader, reply = parse(data, chunk)
+                self.assertEqual(reply, dict(items), (n, chunk))
+
+    def test_set(self):
+        for n in self.sizes:
+            members = [k for k, v in self.items(n)]
+            data = b"~%d\r\n" % n + b"".join(map(bulk, members))
+            for chunk in (None, 7):
+                reader, reply = parse(data, chunk)
+                self.assertEqual(reply, set(members), (n, chunk))
+
+    def test_attribute(self):
+        for n in self.sizes:
+            items = self.items(n)
+            data = (b"|%d\r\n" % n +
+                    b"".join(bulk(k) + bulk(v) for k, v in items) +
+                    b"*2\r\n" + bulk(b"a") + bulk(b"b"))
+            for chunk in (None, 7):
+                reader, reply = parse(data, chunk)
+                self.assertEqual(reply, [b"a", b"b"], (n, chunk))
+                self.assertEqual(reader.attributes, dict(items), (n, chunk))
+
+    def test_nested_map(self):
+        n = 2 * FASTPATH_MIN_ELEMENTS
+        items = self.items(n)
+        inner = b"%%%d\r\n" % n + b"".join(bulk(k) + bulk(v)
+                                           for k, v in items)
+        reader, reply = parse(b"*2\r\n" + inner + inner)
+        self.assertEqual(reply, [dict(items), dict(items)])
+
+
+class ParseIntoTest(unittest.TestCase):
+
+    def test_received(self):
+        value = b"x" * (4 * 65536 + 3)
+        data = bulk(value) + b"+OK\r\n"
+        sock, peer = socket.socketpair()
+        sender = threading.Thread(target=peer.sendall, args=(data,))
+        sender.start()
+        try:
+            reader = RespReader(sock, bufsize=1024)
+            out = bytearray(len(value))
+            self.assertEqual(reader.parse_into(out), len(value))
+            self.assertEqual(bytes(out), value)
+            self.assertEqual(reader.parse(), b"OK")
+            self.assertEqual(reader.received, len(data))
+        finally:
+            sender.join()
+            sock.close()
+            peer.close()
+
+    def test_readonly(self):
+        reader = RespReader()
+        reader.feed(bulk(b"abc"))
+        for out in (b"xxxxxxxx", memoryview(bytearray(8)).toreadonly()):
+            self.assertRaises(TypeError, reader.parse_into, out)
+        out = bytearray(8)
+        self.assertEqual(reader.parse_into(out), 3)
+        self.assertEqual(out[:3], b"abc")
+
+
+if __name__ == "__main__":
+    unittest.main()